@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+import numpy as np
+from line_item_table import as_line_item_table
+from line_items import parse_amount
+
+# Allowed gap between a stated amount and the one recomputed from the other columns:
+# whichever is larger of an absolute rupee amount or a fraction of the stated value
+ABS_TOLERANCE = 1.0
+REL_TOLERANCE = 0.005
+
+# Names of the checks, as arithmetic_errors reports them
+CHECK_MISSING = "missing amounts"
+CHECK_TAXABLE = "taxable value"
+CHECK_IGST = "igst amount"
+CHECK_TOTAL = "total"
+
+@dataclass(frozen=True)
+class ArithmeticTolerance:
+    """
+    Allowed gap between a stated amount and the one recomputed from the
+    other columns: whichever is larger of absolute rupees or relative, a
+    fraction of the stated value.
+    """
+    absolute: float = ABS_TOLERANCE
+    relative: float = REL_TOLERANCE
+
+    def close(self, expected, stated):
+        """Element-wise: expected is within tolerance of stated; False wherever either is NaN"""
+        return np.abs(expected - stated) <= np.maximum(self.absolute, self.relative * np.abs(stated))
+
+DEFAULT_TOLERANCE = ArithmeticTolerance()
+
+@dataclass(frozen=True)
+class ArithmeticRecheck:
+    """
+    Re-requests Gemini pages whose final answer still fails the arithmetic
+    checks, see extraction_engine.run_rechecks.
+
+    Attributes:
+        tolerance: ArithmeticTolerance of the checks
+        max_failing_fraction: Share of a page's line items allowed to fail
+            before the page is re-requested
+        attempts: Re-requests per page at most
+    """
+    tolerance: ArithmeticTolerance = DEFAULT_TOLERANCE
+    max_failing_fraction: float = 0.0
+    attempts: int = 1
+
+@dataclass
+class ArithmeticCheck:
+    """
+    Outcome of check_arithmetic, as boolean arrays with one entry per line
+    item. A row missing QTY, Rate, Taxable Value or Total fails as missing
+    and is not checked further.
+
+    Attributes:
+        page_indices: Page of each row
+        missing, taxable, igst, total: Rows failing each check
+    """
+    page_indices: np.ndarray
+    missing: np.ndarray
+    taxable: np.ndarray
+    igst: np.ndarray
+    total: np.ndarray
+
+    @property
+    def failed(self):
+        """Rows failing any check"""
+        return self.missing | self.taxable | self.igst | self.total
+
+    def page_failures(self, pages=None):
+        """
+        (pages, failing rows, rows) as arrays, one entry per page: the
+        distinct pages of the rows, or the given sorted pages, which must
+        cover every row's page and may include pages without rows
+        """
+        if pages is None:
+            pages = np.unique(self.page_indices)
+        pages = np.asarray(pages, dtype=np.int64)
+        positions = np.searchsorted(pages, self.page_indices)
+        rows = np.bincount(positions, minlength=len(pages))[:len(pages)]
+        failing = np.bincount(positions, weights=self.failed, minlength=len(pages))[:len(pages)].astype(np.int64)
+        return pages, failing, rows
+
+    def failed_pages(self, max_failing_fraction=0.0, pages=None):
+        """
+        (pages, mask) with mask True for the pages where more than
+        max_failing_fraction of the rows fail; pages as in page_failures
+        """
+        pages, failing, rows = self.page_failures(pages)
+        return pages, failing > max_failing_fraction * rows
+
+    def errors(self, row):
+        """The failed check names of one row, as arithmetic_errors returns them"""
+        checks = ((CHECK_MISSING, self.missing), (CHECK_TAXABLE, self.taxable), (CHECK_IGST, self.igst),
+                  (CHECK_TOTAL, self.total))
+        return [name for name, mask in checks if mask[row]]
+
+def check_arithmetic(line_items, page_indices=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Checks that every line item's amounts agree with each other, as whole
+    columns: QTY x Rate less the discount against Taxable Value, Taxable
+    Value x IGST Rate against IGST Amount, and Taxable Value plus IGST
+    Amount against Total.
+
+    Args:
+        line_items: List of line item dicts or a LineItemTable
+        page_indices: Page of each row, all 0 when omitted
+        tolerance: ArithmeticTolerance for every comparison
+
+    Returns:
+        ArithmeticCheck
+    """
+    table = as_line_item_table(line_items)
+    length = len(table)
+    if page_indices is None:
+        page_indices = np.zeros(length, dtype=np.int64)
+
+    def column(field):
+        if field not in table:
+            return np.full(length, np.nan)
+        return table.numbers(field, parse_amount)
+
+    qty, rate, taxable, total = (column(field) for field in ("QTY", "Rate", "Taxable Value", "Total"))
+    discount_value, discount_pct = column("Discount Value"), column("Discount%")
+    igst_rate, igst_amount = column("IGST Rate"), column("IGST Amount")
+    missing = np.isnan(qty) | np.isnan(rate) | np.isnan(taxable) | np.isnan(total)
+
+    with np.errstate(invalid="ignore", over="ignore"):
+        gross = qty * rate
+        # A stated discount amount wins over a percentage; some suppliers print it negative
+        has_value = ~np.isnan(discount_value) & (discount_value != 0)
+        has_pct = ~has_value & ~np.isnan(discount_pct) & (discount_pct != 0)
+        expected_taxable = np.where(has_value, gross - np.abs(discount_value),
+                                    np.where(has_pct, gross * (1 - discount_pct / 100), gross))
+        taxable_failed = ~tolerance.close(expected_taxable, taxable)
+
+        has_igst = ~np.isnan(igst_rate) & ~np.isnan(igst_amount)
+        igst_failed = has_igst & ~tolerance.close(taxable * igst_rate / 100, igst_amount)
+        total_failed = ~tolerance.close(taxable + np.nan_to_num(igst_amount, nan=0.0), total)
+
+    checked = ~missing
+    return ArithmeticCheck(np.asarray(page_indices, dtype=np.int64), missing, taxable_failed & checked,
+                           igst_failed & checked, total_failed & checked)
+
+def arithmetic_errors(item, tolerance=DEFAULT_TOLERANCE):
+    """
+    check_arithmetic of a single line item.
+
+    Returns:
+        List of failed check names, empty when the item is consistent.
+        A line item without QTY, Rate, Taxable Value and Total always fails.
+    """
+    return check_arithmetic([item], tolerance=tolerance).errors(0)
+
+def any_arithmetic_errors(line_items, tolerance=DEFAULT_TOLERANCE):
+    """True when any of the line items fails check_arithmetic"""
+    return bool(check_arithmetic(line_items, tolerance=tolerance).failed.any())
+
+def check_page_results(results, tolerance=DEFAULT_TOLERANCE):
+    """check_arithmetic over the line items of several PageResults at once, rows tagged with their page"""
+    line_items = [item for result in results for item in result.line_items]
+    page_indices = np.repeat([result.page_index for result in results],
+                             [len(result.line_items) for result in results]).astype(np.int64)
+    return check_arithmetic(line_items, page_indices, tolerance)
+
+def failing_pages(results, tolerance=DEFAULT_TOLERANCE, max_failing_fraction=0.0):
+    """
+    Page indices of the PageResults where more than max_failing_fraction of
+    the line items fail the arithmetic checks, checked in one pass. Failed
+    results and pages without line items are never included.
+    """
+    results = [result for result in results if not result.error and result.line_items]
+    if not results:
+        return set()
+    pages, failed = check_page_results(results, tolerance).failed_pages(
+        max_failing_fraction, sorted({result.page_index for result in results}))
+    return set(pages[failed].tolist())
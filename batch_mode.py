@@ -0,0 +1,338 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+import fitz  # PyMuPDF
+import google.generativeai as genai
+import requests
+from extraction_engine import (GENERATION_CONFIG, INPUT_TEXT, PageJob, PageResult, build_page_contents,
+                               combine_page_results, parse_line_items)
+from gemini_model import MODEL_NAME, load_system_prompt
+from line_items import validate_line_items
+from page_classifier import classify_page
+from page_render import DEFAULT_RENDER_SETTINGS, render_page
+from text_extractor import MIN_TEXT_WORDS, extract_text_line_items, page_layout_text
+
+# Batch job states, as reported by the Gemini Batch API
+STATE_PENDING = "BATCH_STATE_PENDING"
+STATE_RUNNING = "BATCH_STATE_RUNNING"
+STATE_SUCCEEDED = "BATCH_STATE_SUCCEEDED"
+FINAL_STATES = {STATE_SUCCEEDED, "BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED"}
+
+DEFAULT_POLL_INTERVAL = 60
+
+GEMINI_API_URL = "https://generativelanguage.googleapis.com"
+
+def document_hash(pdf_path):
+    """Content hash of a PDF, stable across renames and re-runs"""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+def request_key(doc_hash, page_index):
+    return f"{doc_hash}:{page_index}"
+
+def parse_request_key(key):
+    doc_hash, page_index = key.rsplit(":", 1)
+    return doc_hash, int(page_index)
+
+def _json_contents(contents):
+    """Request contents with inline image bytes base64 encoded, as the JSONL file needs"""
+    encoded = []
+    for turn in contents:
+        parts = []
+        for part in turn["parts"]:
+            if "inline_data" in part:
+                inline_data = part["inline_data"]
+                part = {"inline_data": {"mime_type": inline_data["mime_type"],
+                                        "data": base64.b64encode(inline_data["data"]).decode("ascii")}}
+            parts.append(part)
+        encoded.append({"role": turn["role"], "parts": parts})
+    return encoded
+
+def _list_pdfs(pdf_dir):
+    for root, _, files in os.walk(pdf_dir):
+        for file_name in sorted(files):
+            if file_name.lower().endswith(".pdf"):
+                yield os.path.join(root, file_name)
+
+def prepare_batch(pdf_dir, work_dir, system_prompt, render_settings=DEFAULT_RENDER_SETTINGS,
+                  use_text_layer=True, llm_input=INPUT_TEXT, skip_pages=True):
+    """
+    Writes one Batch API request line per page of every PDF under pdf_dir.
+    Pages the classifier skips or the text layer extractor resolves never
+    make it into the request file; their outcome goes into the manifest.
+    Identical copies of a PDF are requested once and share the answers.
+
+    Returns:
+        (requests_path, manifest_path) inside work_dir. The manifest maps
+        each PDF's path relative to pdf_dir to its full path, document
+        hash, page count and local results.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    requests_path = os.path.join(work_dir, "batch_requests.jsonl")
+    manifest_path = os.path.join(work_dir, "batch_manifest.json")
+    manifest = {}
+    # Manifest entry of the first copy of each document, by hash
+    prepared = {}
+    with open(requests_path, "w") as requests_file:
+        for pdf_path in _list_pdfs(pdf_dir):
+            relative_path = os.path.relpath(pdf_path, pdf_dir).replace(os.sep, "/")
+            try:
+                doc_hash = document_hash(pdf_path)
+                if doc_hash in prepared:
+                    manifest[relative_path] = {**prepared[doc_hash], "path": pdf_path}
+                    continue
+                with fitz.open(pdf_path) as pdf_document:
+                    local_results = {}
+                    for page_index, page in enumerate(pdf_document):
+                        words = page.get_text("words")
+                        has_text = len(words) >= MIN_TEXT_WORDS
+                        if skip_pages and not classify_page(page, words)[0]:
+                            local_results[page_index] = []
+                            continue
+                        if use_text_layer and has_text:
+                            line_items = extract_text_line_items(page)
+                            if line_items is not None:
+                                local_results[page_index] = line_items
+                                continue
+                        if llm_input == INPUT_TEXT and has_text:
+                            job = PageJob(page_index, text=page_layout_text(page))
+                        else:
+                            job = PageJob(page_index, image_bytes=render_page(page, render_settings))
+                        request = {
+                            "contents": _json_contents(build_page_contents(None, job)),
+                            "system_instruction": {"parts": [{"text": system_prompt}]},
+                            "generation_config": GENERATION_CONFIG,
+                        }
+                        requests_file.write(json.dumps({"key": request_key(doc_hash, page_index),
+                                                        "request": request}) + "\n")
+                    manifest[relative_path] = {"path": pdf_path, "hash": doc_hash, "pages": len(pdf_document),
+                                               "local_results": local_results}
+                    prepared[doc_hash] = manifest[relative_path]
+            except Exception as e:
+                print(f"Error preparing {pdf_path}: {e}")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return requests_path, manifest_path
+
+def _response_text(response):
+    """Joins the text parts of the first candidate of a GenerateContentResponse dict"""
+    candidates = response.get("candidates") or []
+    if not candidates:
+        raise ValueError("response has no candidates")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+def ingest_results(results_path, manifest_path, output_dir):
+    """
+    Reads a batch results file back into one {"LineItems": [...]} JSON file
+    per PDF, with pages in order. Outputs keep the PDFs' paths relative to
+    pdf_dir, so sub/invoice.pdf becomes sub/invoice.json in output_dir.
+
+    Returns:
+        Dict of relative PDF path -> list of failed page numbers (1-based)
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    # Model answers by document hash, shared by identical copies
+    results = {document["hash"]: [] for document in manifest.values()}
+
+    with open(results_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            doc_hash, page_index = parse_request_key(entry["key"])
+            if doc_hash not in results:
+                continue
+            try:
+                if "error" in entry:
+                    raise ValueError(entry["error"].get("message", "batch request failed"))
+                line_items = parse_line_items(_response_text(entry["response"]))
+                results[doc_hash].append(PageResult(page_index, line_items))
+            except Exception as e:
+                results[doc_hash].append(PageResult(page_index, error=str(e)))
+
+    failures = {}
+    for relative_path, document in manifest.items():
+        page_results = [PageResult(int(page_index), line_items)
+                        for page_index, line_items in document["local_results"].items()]
+        page_results += results[document["hash"]]
+        page_results.sort(key=lambda result: result.page_index)
+        seen = {result.page_index for result in page_results}
+        failed = [result.page_index + 1 for result in page_results if result.error]
+        failed += [page_index + 1 for page_index in range(document["pages"]) if page_index not in seen]
+        if failed:
+            failures[relative_path] = sorted(failed)
+        combined = combine_page_results(page_results)
+        combined["LineItems"] = validate_line_items(combined["LineItems"])
+        output_path = os.path.join(output_dir, *f"{os.path.splitext(relative_path)[0]}.json".split("/"))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(combined, f, indent=2)
+    return failures
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Gemini Batch API. Jobs live in work_dir and
+    are answered on the first poll, by model when one is given and with
+    empty line items otherwise, in the Batch API's results format.
+    """
+
+    def __init__(self, work_dir, model=None):
+        self.work_dir = work_dir
+        self.model = model
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _job_path(self, job_id, suffix):
+        return os.path.join(self.work_dir, f"{job_id}.{suffix}")
+
+    def submit(self, requests_path):
+        job_id = uuid.uuid4().hex[:12]
+        shutil.copyfile(requests_path, self._job_path(job_id, "requests.jsonl"))
+        return job_id
+
+    def poll(self, job_id):
+        results_path = self._job_path(job_id, "results.jsonl")
+        if not os.path.exists(results_path):
+            self._run(job_id, results_path)
+        return STATE_SUCCEEDED
+
+    def fetch_results(self, job_id, destination):
+        shutil.copyfile(self._job_path(job_id, "results.jsonl"), destination)
+        return destination
+
+    def _answer(self, request):
+        if self.model is None:
+            return json.dumps({"LineItems": []})
+        contents = []
+        for turn in request["contents"]:
+            parts = []
+            for part in turn["parts"]:
+                if "inline_data" in part:
+                    part = {"inline_data": {"mime_type": part["inline_data"]["mime_type"],
+                                            "data": base64.b64decode(part["inline_data"]["data"])}}
+                parts.append(part)
+            contents.append({"role": turn["role"], "parts": parts})
+        return self.model.generate_content(contents=contents,
+                                           generation_config=request.get("generation_config")).text
+
+    def _run(self, job_id, results_path):
+        temp_path = f"{results_path}.tmp"
+        with open(self._job_path(job_id, "requests.jsonl"), "r") as requests_file, open(temp_path, "w") as out:
+            for line in requests_file:
+                entry = json.loads(line)
+                try:
+                    text = self._answer(entry["request"])
+                    result = {"key": entry["key"],
+                              "response": {"candidates": [{"content": {"parts": [{"text": text}]}}]}}
+                except Exception as e:
+                    result = {"key": entry["key"], "error": {"message": str(e)}}
+                out.write(json.dumps(result) + "\n")
+        os.replace(temp_path, results_path)
+
+class GeminiBatchBackend:
+    """
+    Gemini Batch API over REST: the request file is uploaded with the File
+    API and a batchGenerateContent job is created from it.
+    """
+
+    def __init__(self, api_key, model_name=MODEL_NAME):
+        self.api_key = api_key
+        self.model_name = model_name
+
+    def _headers(self):
+        return {"x-goog-api-key": self.api_key, "Content-Type": "application/json"}
+
+    def submit(self, requests_path):
+        genai.configure(api_key=self.api_key)
+        uploaded = genai.upload_file(requests_path, mime_type="application/jsonl",
+                                     display_name=os.path.basename(requests_path))
+        response = requests.post(
+            f"{GEMINI_API_URL}/v1beta/models/{self.model_name}:batchGenerateContent",
+            headers=self._headers(),
+            json={"batch": {"display_name": f"invoice-line-items-{int(time.time())}",
+                            "input_config": {"file_name": uploaded.name}}},
+            timeout=60,
+        )
+        response.raise_for_status()
+        return response.json()["name"]
+
+    def _status(self, job_id):
+        response = requests.get(f"{GEMINI_API_URL}/v1beta/{job_id}", headers=self._headers(), timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def poll(self, job_id):
+        return self._status(job_id).get("metadata", {}).get("state", STATE_PENDING)
+
+    def fetch_results(self, job_id, destination):
+        status = self._status(job_id)
+        results_file = status.get("response", {}).get("responsesFile")
+        if not results_file:
+            raise ValueError(f"Batch {job_id} has no results file")
+        response = requests.get(f"{GEMINI_API_URL}/download/v1beta/{results_file}:download",
+                                params={"alt": "media"}, headers=self._headers(), timeout=600, stream=True)
+        response.raise_for_status()
+        with open(destination, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+        return destination
+
+def run_batch(pdf_dir, output_dir, backend, system_prompt=None, work_dir=None,
+              poll_interval=DEFAULT_POLL_INTERVAL, **prepare_options):
+    """
+    Extracts line items from every PDF under pdf_dir through a batch backend:
+    prepare the request file, submit it, poll until the job finishes and
+    ingest the results into output_dir.
+
+    Args:
+        backend: Object with submit(requests_path) -> job_id,
+            poll(job_id) -> state and fetch_results(job_id, destination),
+            e.g. GeminiBatchBackend or LocalBatchBackend
+        prepare_options: Passed on to prepare_batch
+
+    Returns:
+        Dict of relative PDF path -> failed page numbers, see ingest_results
+    """
+    if system_prompt is None:
+        system_prompt = load_system_prompt()
+    work_dir = work_dir or os.path.join(output_dir, ".batch")
+    requests_path, manifest_path = prepare_batch(pdf_dir, work_dir, system_prompt, **prepare_options)
+
+    job_id = backend.submit(requests_path)
+    print(f"Submitted batch {job_id}")
+    while True:
+        state = backend.poll(job_id)
+        if state in FINAL_STATES:
+            break
+        print(f"Batch {job_id}: {state}")
+        time.sleep(poll_interval)
+    if state != STATE_SUCCEEDED:
+        raise RuntimeError(f"Batch {job_id} ended in state {state}")
+
+    results_path = backend.fetch_results(job_id, os.path.join(work_dir, "batch_results.jsonl"))
+    return ingest_results(results_path, manifest_path, output_dir)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python batch_mode.py <pdf_directory> <output_directory> [--local]")
+        sys.exit(1)
+    pdf_dir, output_dir = sys.argv[1:3]
+    if "--local" in sys.argv[3:]:
+        backend = LocalBatchBackend(os.path.join(output_dir, ".batch", "local_jobs"))
+    else:
+        from dotenv import load_dotenv
+        load_dotenv()
+        backend = GeminiBatchBackend(os.environ["GEMINI_API_KEY"])
+    failures = run_batch(pdf_dir, output_dir, backend)
+    for relative_path, pages in failures.items():
+        print(f"{relative_path}: pages {', '.join(map(str, pages))} failed")
+    print(f"Wrote results to {output_dir}")
@@ -0,0 +1,467 @@
+import sys
+import re
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import fitz  # PyMuPDF
+import pandas as pd
+from arithmetic_checks import ArithmeticRecheck, arithmetic_errors, check_arithmetic, failing_pages
+from concurrency_control import AdaptiveConcurrency, describe
+from derived_rates import add_derived_rates
+from extraction_backend import FakeGeminiBackend
+from extraction_engine import PageJob, parse_line_items, run_cascade, run_page_jobs
+from line_item_table import LineItemTable
+from gemini_model import load_system_prompt
+from line_items import LINE_ITEM_FIELDS, validate_line_items
+from page_classifier import classify_page
+from retry_policy import ERROR_RATE_LIMIT, CircuitBreaker, RetryingModel, RetryPolicy, RetryRule
+from page_render import DEFAULT_RENDER_SETTINGS, render_page
+from text_extractor import page_layout_text
+
+# Column headers and widths (points) of the generated invoice table
+SAMPLE_COLUMNS = [
+    ("Description of Goods", 120), ("HSN/SAC", 40), ("Batch No", 44), ("Mfg Date", 44),
+    ("Expiry Date", 44), ("MRP", 36), ("QTY", 32), ("UOM", 24), ("Rate", 36),
+    ("Disc %", 28), ("Disc Amt", 36), ("Taxable Value", 52), ("IGST Rate", 32),
+    ("IGST Amt", 40), ("Total", 48),
+]
+
+def sample_line_item(page_num, row):
+    """A line item whose amounts are arithmetically consistent"""
+    qty = 5 + (page_num * 7 + row * 3) % 40
+    rate = 50 + (row * 13 % 90) + 0.56
+    taxable = round(qty * rate, 2)
+    igst_rate = (5, 12, 18)[row % 3]
+    igst = round(taxable * igst_rate / 100, 2)
+    return [
+        f"Item {row + 1} Vati 500mg", "30049011", f"B{page_num:03d}{row:02d}", "01.01.2025",
+        "31.12.2027", "150.00", f"{qty:.3f}", "PC", f"{rate:.2f}", "0.00", "0.00",
+        f"{taxable:,.2f}", f"{igst_rate:.2f}", f"{igst:,.2f}", f"{taxable + igst:,.2f}",
+    ]
+
+def make_sample_pdf(page_count=200, rows_per_page=30):
+    """
+    Builds an in-memory PDF that looks roughly like a dense, ruled invoice.
+
+    Args:
+        page_count: Number of pages to generate
+        rows_per_page: Number of line item rows drawn on each page
+
+    Returns:
+        Open fitz.Document
+    """
+    pdf_document = fitz.open()
+    row_height = 16
+    for page_num in range(page_count):
+        page = pdf_document.new_page(width=842, height=595)  # A4 landscape in points
+        page.insert_text((36, 30), "ACME AYURVEDA PVT LTD   GSTIN: 29ABCDE1234F1Z5", fontsize=10)
+        page.insert_text((36, 46), f"TAX INVOICE   Invoice No 29253{page_num:05d}   Page {page_num + 1}", fontsize=9)
+        rows = [[name for name, _ in SAMPLE_COLUMNS]]
+        rows += [sample_line_item(page_num, row) for row in range(rows_per_page)]
+        top = 60
+        x_edges = [36]
+        for _, width in SAMPLE_COLUMNS:
+            x_edges.append(x_edges[-1] + width)
+        bottom = top + row_height * len(rows)
+        for row_index in range(len(rows) + 1):
+            y = top + row_index * row_height
+            page.draw_line((x_edges[0], y), (x_edges[-1], y), width=0.5)
+        for x in x_edges:
+            page.draw_line((x, top), (x, bottom), width=0.5)
+        for row_index, row in enumerate(rows):
+            y = top + row_index * row_height + 11
+            for col_index, value in enumerate(row):
+                page.insert_text((x_edges[col_index] + 2, y), value, fontsize=5)
+    return pdf_document
+
+def _legacy_render(page):
+    """The old temp-file path: pixmap -> .jpg on disk -> Pillow -> JPEG bytes"""
+    from PIL import Image
+
+    pix = page.get_pixmap(alpha=False)
+    temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+    temp_path = temp_file.name
+    temp_file.close()
+    try:
+        pix.save(temp_path)
+        with Image.open(temp_path) as img:
+            img_bytes = io.BytesIO()
+            img.save(img_bytes, format="JPEG")
+            return img_bytes.getvalue()
+    finally:
+        os.unlink(temp_path)
+
+def _time_per_page(pdf_document, render):
+    """Returns (mean seconds per page, mean encoded bytes per page)"""
+    total_bytes = 0
+    start = time.perf_counter()
+    for page in pdf_document:
+        total_bytes += len(render(page))
+    elapsed = time.perf_counter() - start
+    return elapsed / len(pdf_document), total_bytes / len(pdf_document)
+
+def bench_render(page_count=200):
+    """Compares per-page render+encode time of the temp-file path and render_page"""
+    pdf_document = make_sample_pdf(page_count)
+    try:
+        legacy_time, legacy_size = _time_per_page(pdf_document, _legacy_render)
+        new_time, new_size = _time_per_page(pdf_document, lambda page: render_page(page, DEFAULT_RENDER_SETTINGS))
+    finally:
+        pdf_document.close()
+
+    print(f"Render+encode, {page_count} pages, {DEFAULT_RENDER_SETTINGS}")
+    print(f"  temp file + Pillow : {legacy_time * 1000:8.2f} ms/page  {legacy_size / 1024:7.1f} KiB/page")
+    print(f"  in-memory          : {new_time * 1000:8.2f} ms/page  {new_size / 1024:7.1f} KiB/page")
+    print(f"  speedup            : {legacy_time / new_time:8.2f}x")
+
+def _estimate_image_tokens(page, settings):
+    """Gemini bills images as 258 tokens per 768x768 tile"""
+    scale = settings.dpi / 72
+    tiles_x = -(-int(page.rect.width * scale) // 768)
+    tiles_y = -(-int(page.rect.height * scale) // 768)
+    return 258 * tiles_x * tiles_y
+
+def bench_llm_input(page_count=20):
+    """
+    Compares what one page costs to upload as an image and as layout text.
+    Token figures are rough estimates (one token per word, punctuation mark
+    or whitespace run); the real per-page counts are reported from
+    usage_metadata after a run.
+    """
+    pdf_document = make_sample_pdf(page_count)
+    image_bytes = text_bytes = image_tokens = text_tokens = 0
+    try:
+        for page in pdf_document:
+            image_bytes += len(render_page(page, DEFAULT_RENDER_SETTINGS))
+            image_tokens += _estimate_image_tokens(page, DEFAULT_RENDER_SETTINGS)
+            text = page_layout_text(page)
+            text_bytes += len(text.encode("utf-8"))
+            text_tokens += len(re.findall(r"\w+|[^\w\s]|\s+", text))
+    finally:
+        pdf_document.close()
+
+    print(f"Gemini page input, {page_count} pages")
+    print(f"  image : {image_bytes / page_count / 1024:7.1f} KiB/page  ~{image_tokens / page_count:6.0f} tokens/page")
+    print(f"  text  : {text_bytes / page_count / 1024:7.1f} KiB/page  ~{text_tokens / page_count:6.0f} tokens/page")
+
+TERMS_TEXT = [
+    "TERMS AND CONDITIONS",
+    "1. Goods once sold will not be taken back or exchanged under any circumstances.",
+    "2. Interest at 18% per annum will be charged on bills not paid within the due date.",
+    "3. All disputes are subject to the jurisdiction of the courts at the place of supply.",
+    "4. Our responsibility ceases once the goods leave our premises in good condition.",
+    "5. Please check the goods at the time of delivery and report any shortage immediately.",
+]
+
+def _add_text_page(pdf_document, lines):
+    page = pdf_document.new_page(width=842, height=595)
+    for line_num, line in enumerate(lines):
+        page.insert_text((36, 40 + line_num * 16), line, fontsize=9)
+
+def _add_eway_bill_page(pdf_document):
+    """An e-way bill carries an item table too, but must not be extracted"""
+    _add_text_page(pdf_document, [
+        "E-WAY BILL",
+        "E-Way Bill No: 3812 4455 6677   Generated Date: 02/01/2025   Valid Upto: 04/01/2025",
+        "Part A   GSTIN of Supplier 29ABCDE1234F1Z5   Place of Dispatch BENGALURU",
+        "HSN Code   Product Name   Quantity   Taxable Amount   Tax Rate",
+        "30049011   Vati 500mg   9   788.04   12",
+        "Part B   Mode Road   Vehicle No KA01AB1234",
+    ])
+
+def _add_scanned_page(pdf_document, source_page):
+    pix = source_page.get_pixmap(dpi=100)
+    page = pdf_document.new_page(width=source_page.rect.width, height=source_page.rect.height)
+    page.insert_image(page.rect, pixmap=pix)
+
+def make_sample_corpus(document_count=20):
+    """
+    Builds invoices mixing line item pages with pages that have none.
+
+    Returns:
+        List of (fitz.Document, list of bools telling which pages hold line items)
+    """
+    corpus = []
+    for doc_num in range(document_count):
+        invoice = make_sample_pdf(1 + doc_num % 3, rows_per_page=20)
+        expected = [True] * len(invoice)
+        if doc_num % 4 == 1:
+            _add_scanned_page(invoice, invoice[0])
+            expected.append(True)
+        if doc_num % 2 == 0:
+            _add_text_page(invoice, TERMS_TEXT)
+            expected.append(False)
+        if doc_num % 3 == 0:
+            _add_eway_bill_page(invoice)
+            expected.append(False)
+        if doc_num % 5 == 0:
+            invoice.new_page(width=842, height=595)
+            expected.append(False)
+        corpus.append((invoice, expected))
+    return corpus
+
+def bench_classifier(document_count=20):
+    """Reports the fraction of Gemini calls the page classifier avoids, and its mistakes"""
+    corpus = make_sample_corpus(document_count)
+    pages = skipped = missed = kept_wrongly = 0
+    elapsed = 0.0
+    for pdf_document, expected in corpus:
+        for page, has_line_items in zip(pdf_document, expected):
+            start = time.perf_counter()
+            keep, _ = classify_page(page)
+            elapsed += time.perf_counter() - start
+            pages += 1
+            skipped += not keep
+            missed += has_line_items and not keep
+            kept_wrongly += keep and not has_line_items
+        pdf_document.close()
+
+    print(f"Page classifier, {document_count} documents, {pages} pages")
+    print(f"  Gemini calls avoided   : {skipped} of {pages} ({skipped / pages:.1%})")
+    print(f"  line item pages missed : {missed}")
+    print(f"  non-item pages kept    : {kept_wrongly}")
+    print(f"  classifier time        : {elapsed / pages * 1000:.2f} ms/page")
+
+def _simulate(concurrency=None, max_concurrency=4, page_count=400, capacities=(12, 4)):
+    # Calls slow down past the capacity and get a 429 past twice of it
+    backend = FakeGeminiBackend(latency=0.02, capacity=capacities[0], rows_per_page=0)
+    policy = RetryPolicy(rules={ERROR_RATE_LIMIT: RetryRule(max_attempts=20, base_delay=0.02, max_delay=0.2)})
+    # The backend never goes down, only the retry cost of 429s is of interest
+    model = RetryingModel(backend, policy, CircuitBreaker(failure_threshold=page_count))
+    jobs = [PageJob(page_index, text=f"page {page_index}") for page_index in range(page_count)]
+
+    def switch_capacity(completed, total):
+        # Halfway through the API gets busier, as at month-end close
+        if completed == total // 2:
+            backend.set_capacity(capacities[1])
+
+    start = time.perf_counter()
+    results = run_page_jobs(model, jobs, "prompt", max_concurrency, switch_capacity, concurrency=concurrency)
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for result in results if result.error)
+    return elapsed, backend.rate_limited, failed
+
+def bench_concurrency(page_count=400):
+    """Compares fixed concurrency limits with the AIMD controller on a simulated rate-limited backend"""
+    print(f"Simulated backend, {page_count} pages, capacity 12 then 4 concurrent calls")
+    for max_concurrency in (2, 4, 16):
+        elapsed, rate_limited, failed = _simulate(max_concurrency=max_concurrency, page_count=page_count)
+        print(f"  fixed {max_concurrency:>2}   : {page_count / elapsed:6.1f} pages/s, {rate_limited:4d} 429s, {failed} failed pages")
+    controller = AdaptiveConcurrency()
+    elapsed, rate_limited, failed = _simulate(concurrency=controller, page_count=page_count)
+    print(f"  adaptive   : {page_count / elapsed:6.1f} pages/s, {rate_limited:4d} 429s, {failed} failed pages")
+    print(f"  final      : {describe(controller.snapshot())}, {controller.decreases} decreases")
+
+def _legacy_parse(response_text):
+    """Parsing before the response schema: json.loads, a dict walk, then validate_line_items"""
+    page_data = json.loads(response_text)
+    if isinstance(page_data, dict) and isinstance(page_data.get("LineItems"), list):
+        return validate_line_items(page_data["LineItems"])
+    return []
+
+def _free_form_responses(rows_per_page):
+    """Shapes seen from the prose-only prompt: extra keys, nested objects, numbers, missing fields"""
+    items = [dict(zip(LINE_ITEM_FIELDS, sample_line_item(0, row))) for row in range(rows_per_page)]
+    numbers = [{**item, "QTY": float(item["QTY"]), "IGST Rate": 12} for item in items]
+    nested = [{**item, "Batch No": {"No": item["Batch No"], "Expiry": item["Expiry Date"]}} for item in items]
+    missing = [{key: value for key, value in item.items() if key not in ("UOM", "Mfg Date")} for item in items]
+    return {
+        "extra keys": json.dumps({"InvoiceNo": "123", "LineItems": items, "Notes": "checked"}),
+        "numbers": json.dumps({"LineItems": numbers}),
+        "nested object": json.dumps({"LineItems": nested}),
+        "missing fields": json.dumps({"LineItems": missing}),
+        "bare list": json.dumps(items),
+    }
+
+def _well_formed(line_items):
+    return bool(line_items) and all(
+        set(item) == set(LINE_ITEM_FIELDS) and all(isinstance(value, str) for value in item.values())
+        for item in line_items)
+
+def bench_parse(page_count=2000, rows_per_page=30):
+    """Parse time per page and malformed results, before and after the pydantic response schema"""
+    items = [dict(zip(LINE_ITEM_FIELDS, sample_line_item(page, row)))
+             for page in range(4) for row in range(rows_per_page)]
+    responses = [json.dumps({"LineItems": items[page % 4 * rows_per_page:(page % 4 + 1) * rows_per_page]})
+                 for page in range(page_count)]
+
+    print(f"Response parsing, {page_count} schema-shaped pages of {rows_per_page} line items")
+    for label, parse in (("json + dict walk", _legacy_parse), ("pydantic schema", parse_line_items)):
+        start = time.perf_counter()
+        for response_text in responses:
+            parse(response_text)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<17}: {elapsed / page_count * 1000:.3f} ms/page")
+
+    print("Free-form answers from the prose prompt (what the response schema now rules out):")
+    for shape, response_text in _free_form_responses(rows_per_page).items():
+        outcomes = []
+        for parse in (_legacy_parse, parse_line_items):
+            try:
+                outcomes.append("ok" if _well_formed(parse(response_text)) else "malformed or empty, unnoticed")
+            except Exception as e:
+                outcomes.append(f"rejected ({type(e).__name__})")
+        print(f"  {shape:<15}: before {outcomes[0]}; after {outcomes[1]}")
+
+    prompt_sizes = [len(load_system_prompt(version)) for version in ("v1", "v2")]
+    print(f"System prompt: {prompt_sizes[0]} -> {prompt_sizes[1]} characters")
+
+def _legacy_process_json_data(input_json):
+    """streamlit_app_v1.process_json_data before add_derived_rates: parse, compute and rebuild item by item"""
+    for item in input_json["LineItems"]:
+        try:
+            rate = float(item["Rate"].replace(",", "")) if item["Rate"] else 0
+            mrp_rate = float(item["MRP"].replace(",", "")) if item["MRP"] else 0
+            gst_rate = float(item["IGST Rate"].replace(",", "")) if item["IGST Rate"] else 0
+            p_rate = round(rate * 1.06, 2)
+            b_rate = round(p_rate * 1.11, 2)
+            if mrp_rate > 0 and gst_rate >= 0:
+                calculated_rate = round(mrp_rate / (1.3 * 1.11 * 1.06 * (1 + gst_rate/100)), 2)
+                difference = round(rate - calculated_rate, 2)
+            else:
+                calculated_rate = 0
+                difference = 0
+            new_item = {}
+            for key, value in item.items():
+                new_item[key] = value
+                if key == "Rate":
+                    new_item["P Rate"] = f"{p_rate:.2f}"
+                elif key == "Total":
+                    new_item["B Rate"] = f"{b_rate:.2f}"
+                elif key == "MRP":
+                    new_item["Calculated Rate"] = f"{calculated_rate:.2f}"
+                    new_item["Difference"] = f"{difference:.2f}"
+            item.clear()
+            item.update(new_item)
+        except (ValueError, TypeError, ZeroDivisionError) as e:
+            print(f"Error processing item: {e}")
+            item["P Rate"] = "0.00"
+            item["B Rate"] = "0.00"
+            item["Calculated Rate"] = "0.00"
+            item["Difference"] = "0.00"
+    return input_json
+
+def _sample_line_items(row_count):
+    """Consolidation-like rows: 3000 distinct products repeated, with varied rates and MRPs"""
+    rows = [dict(zip(LINE_ITEM_FIELDS, sample_line_item(page, row))) for page in range(100) for row in range(30)]
+    for index, item in enumerate(rows):
+        item["MRP"] = f"{(index * 7919 % 100000) / 100 + 20:,.2f}"
+    return [dict(rows[index % len(rows)]) for index in range(row_count)]
+
+def bench_derived(row_counts=(1_000, 100_000, 1_000_000)):
+    """
+    Derived rate columns (P Rate, B Rate, Calculated Rate, Difference): the
+    per-item float path against add_derived_rates on exact integer paise,
+    and how many rows the float rounding put off by a paisa or more
+    """
+    print("Derived rate columns, per-item float vs fixed-point, every rate distinct within 4,000 rows")
+    for row_count in row_counts:
+        timings = {}
+        outputs = {}
+        for label, process in (("float", lambda items: _legacy_process_json_data({"LineItems": items})),
+                               ("fixed", add_derived_rates)):
+            # Small runs take milliseconds, the best of several keeps them out of the noise
+            timings[label] = float("inf")
+            for _ in range(max(1, 100_000 // row_count // 10)):
+                items = _sample_line_items(row_count)
+                # Rates ending in 25 or 75 paise put P Rate exactly on a half paisa, where float rounding drifts
+                for index, item in enumerate(items):
+                    item["Rate"] = f"{10 + index % 4000 // 2:,}.{(25, 75)[index % 2]}"
+                start = time.perf_counter()
+                process(items)
+                timings[label] = min(timings[label], time.perf_counter() - start)
+            outputs[label] = [tuple(item[field] for field in ("P Rate", "B Rate", "Calculated Rate", "Difference"))
+                              for item in items]
+            del items
+        drifted = sum(1 for float_row, fixed_row in zip(outputs["float"], outputs["fixed"]) if float_row != fixed_row)
+        print(f"  {row_count:>9,} rows: float {timings['float']:8.4f}s, fixed-point {timings['fixed']:8.4f}s "
+              f"({timings['float'] / timings['fixed']:.1f}x), {drifted:,} rows off by rounding on the float path")
+
+def _measure(build):
+    """(result, bytes allocated by build() and still held)"""
+    tracemalloc.start()
+    result = build()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, held
+
+def bench_table(row_count=100_000):
+    """Memory and processing time of a consolidation as a list of dicts and as a LineItemTable"""
+    # Round trip through JSON so every row owns its strings, like parsed model output
+    payload = json.dumps(_sample_line_items(row_count))
+    line_items, list_bytes = _measure(lambda: json.loads(payload))
+    table, table_bytes = _measure(lambda: LineItemTable.from_line_items(line_items))
+    start = time.perf_counter()
+    table = LineItemTable.from_line_items(line_items)
+    build_time = time.perf_counter() - start
+    print(f"Line item store, {row_count:,} rows")
+    print(f"  list of dicts   : {list_bytes / 2 ** 20:7.1f} MiB")
+    print(f"  LineItemTable   : {table_bytes / 2 ** 20:7.1f} MiB, built in {build_time:.3f}s")
+
+    timings = {}
+    for label, items in (("list of dicts", line_items), ("LineItemTable", table)):
+        start = time.perf_counter()
+        add_derived_rates(validate_line_items(items))
+        processed = time.perf_counter()
+        frame = items.to_frame() if isinstance(items, LineItemTable) else pd.DataFrame(items)
+        timings[label] = (processed - start, time.perf_counter() - processed, frame.to_csv(index=False))
+    for label, (process_time, frame_time, _) in timings.items():
+        print(f"  {label:<16}: validate + derived rates {process_time:.3f}s, to DataFrame {frame_time:.3f}s")
+    print(f"  identical CSV   : {timings['list of dicts'][2] == timings['LineItemTable'][2]}")
+
+def bench_validate(row_count=100_000, page_count=200, misread_rate=0.02, item_rows=2_000):
+    """
+    Arithmetic checks item by item with arithmetic_errors, timed on the
+    first item_rows rows and scaled up, against check_arithmetic on whole
+    columns, then how many pages of a fake extraction with misread totals
+    still fail after re-requesting only the failing ones
+    """
+    line_items = _sample_line_items(row_count)
+    # Every 50th row misread, so the masks have something to find
+    for item in line_items[::50]:
+        item["Total"] = "1.00"
+    start = time.perf_counter()
+    per_item = [bool(arithmetic_errors(item)) for item in line_items[:item_rows]]
+    item_time = (time.perf_counter() - start) * row_count / item_rows
+    table = LineItemTable.from_line_items(line_items)
+    timings = {}
+    for label, items in (("list of dicts", line_items), ("LineItemTable", table)):
+        start = time.perf_counter()
+        failed = check_arithmetic(items).failed
+        timings[label] = time.perf_counter() - start
+    print(f"Arithmetic checks, {row_count:,} rows, {int(failed.sum()):,} failing")
+    print(f"  per item        : {item_time:.3f}s (scaled from {item_rows:,} rows)")
+    for label, elapsed in timings.items():
+        print(f"  {label:<16}: {elapsed:.3f}s ({item_time / elapsed:.1f}x)")
+    print(f"  same rows failed: {failed[:item_rows].tolist() == per_item}")
+
+    jobs = [PageJob(page_index, text=f"page {page_index}") for page_index in range(page_count)]
+    print(f"Fake extraction, {page_count} pages, {misread_rate:.0%} of totals misread")
+    for label, recheck in (("no recheck", None), ("recheck", ArithmeticRecheck())):
+        backend = FakeGeminiBackend(rows_per_page=20, misread_rate=misread_rate)
+        start = time.perf_counter()
+        results = run_cascade(backend, jobs, "prompt", recheck=recheck)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<16}: {len(failing_pages(results))} failing pages, {backend.calls} requests, {elapsed:.2f}s")
+
+BENCHMARKS = {
+    "render": bench_render,
+    "llm-input": bench_llm_input,
+    "classifier": bench_classifier,
+    "concurrency": bench_concurrency,
+    "parse": bench_parse,
+    "derived": bench_derived,
+    "table": bench_table,
+    "validate": bench_validate,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name!r}, choose from: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
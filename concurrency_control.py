@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import deque
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MIN_CONCURRENCY = 1
+DEFAULT_MAX_CONCURRENCY = 32
+
+# The limit is cut by this factor on a 429 or a latency spike
+DECREASE_FACTOR = 0.5
+
+# A call slower than this multiple of the fast-call baseline counts as congestion
+LATENCY_TOLERANCE = 2.0
+
+# Recent calls kept for the latency baseline, p95 and throughput
+LATENCY_WINDOW = 100
+MIN_BASELINE_SAMPLES = 10
+THROUGHPUT_WINDOW_SECONDS = 30.0
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, 0.0 when there are none"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of Gemini requests in flight.
+    Each successful call adds 1/limit to the limit, so it grows by about one
+    per round of calls; a 429 or a call much slower than the recent baseline
+    halves it, at most once per typical call duration so one burst of
+    failures counts as one congestion signal.
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, min_limit=DEFAULT_MIN_CONCURRENCY,
+                 max_limit=DEFAULT_MAX_CONCURRENCY, decrease_factor=DECREASE_FACTOR,
+                 latency_tolerance=LATENCY_TOLERANCE, clock=time.monotonic):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.clock = clock
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._completions = deque()
+        self._last_decrease = float("-inf")
+        self.decreases = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        """Current number of requests allowed in flight"""
+        with self._lock:
+            return int(self._limit)
+
+    def record(self, latency, throttled=False):
+        """Feeds back one finished call: its latency in seconds and whether it was rate limited"""
+        with self._lock:
+            now = self.clock()
+            self._completions.append(now)
+            while self._completions and now - self._completions[0] > THROUGHPUT_WINDOW_SECONDS:
+                self._completions.popleft()
+
+            congested = throttled
+            if not throttled and len(self._latencies) >= MIN_BASELINE_SAMPLES:
+                baseline = percentile(self._latencies, 0.1)
+                congested = latency > baseline * self.latency_tolerance
+            self._latencies.append(latency)
+
+            if congested:
+                if now - self._last_decrease >= percentile(self._latencies, 0.5):
+                    self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+
+    def snapshot(self):
+        """Current limit, throughput in calls per second over the last 30 seconds, and p95 latency"""
+        with self._lock:
+            span = self._completions[-1] - self._completions[0] if len(self._completions) > 1 else 0.0
+            throughput = (len(self._completions) - 1) / span if span > 0 else 0.0
+            return {
+                "limit": int(self._limit),
+                "throughput": throughput,
+                "p95_latency": percentile(self._latencies, 0.95),
+                "decreases": self.decreases,
+            }
+
+def describe(snapshot):
+    """One line summary of a snapshot for logs and progress text"""
+    return (f"concurrency {snapshot['limit']}, {snapshot['throughput']:.1f} calls/s, "
+            f"p95 latency {snapshot['p95_latency']:.2f}s")
+
+# Share of a run's requests that may be duplicated to hedge slow pages
+DEFAULT_HEDGE_BUDGET = 0.1
+
+# A page is hedged once it has been running longer than this latency percentile
+HEDGE_PERCENTILE = 0.9
+MIN_HEDGE_SAMPLES = 20
+
+class HedgePolicy:
+    """
+    When to fire a duplicate request for a slow page: after the observed p90
+    latency of recent calls, and only while the duplicates stay within
+    budget as a share of the requests sent. Until MIN_HEDGE_SAMPLES calls
+    have been seen nothing is hedged.
+    """
+
+    def __init__(self, budget=DEFAULT_HEDGE_BUDGET, quantile=HEDGE_PERCENTILE, min_samples=MIN_HEDGE_SAMPLES):
+        self.budget = budget
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.hedges = 0
+        self.wins = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        """Feeds back how long a winning request took from leaving the rate limiter queue to answer"""
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def delay(self):
+        """Seconds after which a page is hedged, None while there is too little history"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return percentile(self._latencies, self.quantile)
+
+    def allow(self, requests_sent, hedges_sent):
+        """True when one more hedge keeps the hedges within budget of the requests sent"""
+        return hedges_sent + 1 <= self.budget * requests_sent
+
+    def count(self, won):
+        """Tallies a hedged page, and whether the duplicate answered first"""
+        with self._lock:
+            self.hedges += 1
+            self.wins += bool(won)
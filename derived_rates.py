@@ -0,0 +1,186 @@
+import math
+from operator import itemgetter
+import numpy as np
+from line_item_table import MISSING, LineItemTable
+from money import (AMOUNT_SCALE, PAISE_PER_RUPEE, format_paise, half_up_divide, half_up_int, parse_scaled_column,
+                   parse_scaled_encoded)
+
+# P Rate adds 6% to the invoice rate, B Rate another 11% on top of P Rate, as exact fractions
+P_RATE_FACTOR = (106, 100)
+B_RATE_FACTOR = (111, 100)
+
+# Calculated Rate backs the rate out of the MRP: MRP / (1.3 * 1.11 * 1.06 * (1 + GST rate / 100))
+MRP_DIVISOR = (13 * 111 * 106, 10 * 100 * 100)
+
+# Derived columns, each inserted right after the source column named here
+DERIVED_AFTER = {
+    "Rate": ("P Rate",),
+    "Total": ("B Rate",),
+    "MRP": ("Calculated Rate", "Difference"),
+}
+DERIVED_FIELDS = ("P Rate", "B Rate", "Calculated Rate", "Difference")
+DERIVED_SET = frozenset(DERIVED_FIELDS)
+
+# The columns the derived rates are computed from, in the order their parse errors are reported
+SOURCE_FIELDS = ("Rate", "MRP", "IGST Rate")
+
+# Calculated Rate as the fraction MRP * _MRP_MULTIPLIER / (_MRP_DIVISOR * (100 * AMOUNT_SCALE + GST rate))
+# of paise, reduced to keep int64 headroom
+_MRP_COMMON = math.gcd(PAISE_PER_RUPEE * MRP_DIVISOR[1] * 100, MRP_DIVISOR[0])
+_MRP_MULTIPLIER = PAISE_PER_RUPEE * MRP_DIVISOR[1] * 100 // _MRP_COMMON
+_MRP_DIVISOR = MRP_DIVISOR[0] // _MRP_COMMON
+
+# GST rates (in 1/AMOUNT_SCALE) past which that divisor no longer fits int64
+_MAX_INT64_GST_RATE = (2 ** 62) // _MRP_DIVISOR - 100 * AMOUNT_SCALE
+
+def derived_paise_row(rate, mrp, gst_rate):
+    """
+    derived_paise of one row, with Python ints of any size, as
+    (P Rate, B Rate, Calculated Rate, Difference)
+    """
+    rupee = AMOUNT_SCALE // PAISE_PER_RUPEE
+    p_rate = half_up_int(rate * P_RATE_FACTOR[0], P_RATE_FACTOR[1] * rupee)
+    b_rate = half_up_int(p_rate * B_RATE_FACTOR[0], B_RATE_FACTOR[1])
+    if mrp <= 0 or gst_rate < 0:
+        return p_rate, b_rate, 0, 0
+    calculated_rate = half_up_int(mrp * _MRP_MULTIPLIER, _MRP_DIVISOR * (100 * AMOUNT_SCALE + gst_rate))
+    return p_rate, b_rate, calculated_rate, half_up_int(rate - calculated_rate * rupee, rupee)
+
+def _parse_table_column(table, field):
+    codes, uniques = table.encoded(field)
+    if (codes == MISSING).any():
+        raise KeyError(field)
+    return parse_scaled_encoded(codes, uniques)
+
+def derived_paise(rate, mrp, gst_rate):
+    """
+    The derived prices in whole paise from amounts in 1/AMOUNT_SCALE rupee,
+    all as int64 arrays, each rounded half-up like GST invoices are:
+    P Rate from Rate, B Rate from the rounded P Rate, Calculated Rate from
+    MRP and the GST rate, and Difference between Rate and the rounded
+    Calculated Rate. Rows without a positive MRP and a non-negative GST
+    rate get 0 for the last two.
+    """
+    rupee = AMOUNT_SCALE // PAISE_PER_RUPEE
+    p_rate = half_up_divide(rate, P_RATE_FACTOR[0], P_RATE_FACTOR[1] * rupee)
+    b_rate = half_up_divide(p_rate, B_RATE_FACTOR[0], B_RATE_FACTOR[1])
+
+    has_mrp = (mrp > 0) & (gst_rate >= 0)
+    # Absurd GST rates would overflow the int64 divisor, those rows are done with Python ints below
+    huge_gst = has_mrp & (gst_rate > _MAX_INT64_GST_RATE)
+    in_range = has_mrp & ~huge_gst
+    gst_divisor = _MRP_DIVISOR * (100 * AMOUNT_SCALE + np.where(in_range, gst_rate, 0))
+    calculated_rate = half_up_divide(np.where(in_range, mrp, 0), _MRP_MULTIPLIER, gst_divisor)
+    difference = np.where(in_range, half_up_divide(rate - calculated_rate * rupee, 1, rupee), 0)
+    for row in np.flatnonzero(huge_gst).tolist():
+        _, _, calculated_rate[row], difference[row] = derived_paise_row(int(rate[row]), int(mrp[row]),
+                                                                        int(gst_rate[row]))
+    return {"P Rate": p_rate, "B Rate": b_rate, "Calculated Rate": calculated_rate, "Difference": difference}
+
+def _fast_layout(keys):
+    """
+    (output keys, (position, derived field index) of each derived value in
+    them) for items with these keys, or None when an item already carries
+    derived fields and has to be rebuilt the slow way to keep the old key
+    order exactly
+    """
+    if not DERIVED_SET.isdisjoint(keys):
+        return None
+    output_keys = []
+    inserts = []
+    for key in keys:
+        output_keys.append(key)
+        for field in DERIVED_AFTER.get(key, ()):
+            inserts.append((len(output_keys), DERIVED_FIELDS.index(field)))
+            output_keys.append(field)
+    return output_keys, inserts
+
+def _rebuild(item, derived_values):
+    """The per-item rebuild add_derived_rates replaced, for items _fast_layout cannot handle"""
+    new_item = {}
+    for key, value in item.items():
+        new_item[key] = value
+        for derived in DERIVED_AFTER.get(key, ()):
+            new_item[derived] = derived_values[DERIVED_FIELDS.index(derived)]
+    item.clear()
+    item.update(new_item)
+
+def add_derived_rates(line_items):
+    """
+    Adds P Rate after Rate, B Rate after Total, and Calculated Rate and
+    Difference after MRP to every line item, in place.
+
+    The source columns are parsed to exact fixed-point amounts and the
+    derived ones computed as whole integer arrays, see derived_paise.
+    Items whose Rate, MRP or IGST Rate is not a finite number keep their
+    fields and get "0.00" for every derived one, with the error printed.
+    Items must have all three source fields, see validate_line_items.
+
+    line_items may also be a LineItemTable, which gets the derived columns
+    at the same positions; its failed rows get "0.00" in them.
+
+    Returns:
+        line_items
+    """
+    if not len(line_items):
+        return line_items
+
+    if isinstance(line_items, LineItemTable):
+        columns = [_parse_table_column(line_items, field) for field in SOURCE_FIELDS]
+        rate, mrp, gst_rate = (amounts for amounts, _ in columns)
+        errors = [field_errors for _, field_errors in columns]
+    else:
+        # All three columns parsed in one pass, row by row, which is what keeps small lists cheap
+        getter = itemgetter(*SOURCE_FIELDS)
+        amounts, field_errors = parse_scaled_column([value for item in line_items for value in getter(item)])
+        rate, mrp, gst_rate = amounts.reshape(-1, len(SOURCE_FIELDS)).T
+        errors = list(field_errors.reshape(-1, len(SOURCE_FIELDS)).T)
+    failed = np.zeros(len(line_items), dtype=bool)
+    for field_errors in errors:
+        failed |= np.not_equal(field_errors, None)
+
+    # Formatted together, so a value shared between columns is formatted once
+    paise = derived_paise(rate, mrp, gst_rate)
+    formatted = format_paise(np.concatenate([paise[field] for field in DERIVED_FIELDS]))
+    derived = dict(zip(DERIVED_FIELDS, formatted.reshape(len(DERIVED_FIELDS), -1)))
+
+    for row in np.flatnonzero(failed).tolist():
+        message = next(field_errors[row] for field_errors in errors if field_errors[row] is not None)
+        print(f"Error processing item: {message}")
+        if not isinstance(line_items, LineItemTable):
+            for field in DERIVED_FIELDS:
+                line_items[row][field] = "0.00"
+
+    if isinstance(line_items, LineItemTable):
+        for source, fields in DERIVED_AFTER.items():
+            if source not in line_items:
+                continue
+            after = source
+            for field in fields:
+                line_items.set_column(field, np.where(failed, "0.00", derived[field]), after=after)
+                after = field
+        return line_items
+
+    # Every item is rebuilt in one pass with the derived values inserted at their output positions
+    derived_rows = zip(*(derived[field].tolist() for field in DERIVED_FIELDS))
+    layouts = {}
+    keys = layout = None
+    for item, row_failed, derived_values in zip(line_items, failed.tolist(), derived_rows):
+        if row_failed:
+            continue
+        item_keys = tuple(item)
+        if item_keys != keys:
+            keys = item_keys
+            if keys not in layouts:
+                layouts[keys] = _fast_layout(keys)
+            layout = layouts[keys]
+        if layout is None:
+            _rebuild(item, derived_values)
+            continue
+        output_keys, inserts = layout
+        values = list(item.values())
+        for position, index in inserts:
+            values.insert(position, derived_values[index])
+        item.clear()
+        item.update(zip(output_keys, values))
+    return line_items
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from typing import Protocol, runtime_checkable
+import google.generativeai as genai
+from gemini_model import CASCADE_MODEL_NAMES, create_model, load_system_prompt
+from line_item_schema import validate_response
+from model_cascade import ModelCascade
+from page_tiles import strip_bounds
+from rate_limiter import RateLimitedModel
+from retry_policy import RetryingModel
+
+BACKEND_GEMINI = "gemini"
+BACKEND_FAKE = "fake"
+
+# The strip label extraction_engine.STRIP_INSTRUCTION puts in a strip request
+STRIP_PATTERN = re.compile(r"strip (\d+) of (\d+)")
+
+@runtime_checkable
+class ExtractionBackend(Protocol):
+    """
+    What the extraction engine needs from a model: genai.GenerativeModel's
+    generate_content, plus the model name (for cache keys and metrics) and
+    the system prompt it already carries, if any. The engine also accepts a
+    ModelCascade of backends.
+    """
+    model_name: str
+    system_prompt: str
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        ...
+
+def create_gemini_backend(api_key, rate_limiter, model_names=CASCADE_MODEL_NAMES, system_prompt=None):
+    """
+    Configures the Gemini API and builds the production backend: a cascade
+    of models, each behind the retry policy and the shared rate limiter.
+    Answers that do not match the response schema are asked for again.
+    """
+    genai.configure(api_key=api_key)
+    if system_prompt is None:
+        system_prompt = load_system_prompt()
+    return ModelCascade([RetryingModel(RateLimitedModel(create_model(model_name, system_prompt), rate_limiter),
+                                       validate=validate_response)
+                         for model_name in model_names])
+
+class FakeAPIError(Exception):
+    """Error raised by FakeGeminiBackend, with the HTTP status as code like google.api_core errors"""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens, candidates_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = candidates_tokens
+        self.total_token_count = prompt_tokens + candidates_tokens
+        self.cached_content_token_count = 0
+
+class _FakeCandidate:
+    def __init__(self, finish_reason):
+        self.finish_reason = finish_reason
+
+class _FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class _FakeResponse:
+    """Stands in for GenerateContentResponse; iterating it streams the text in chunks"""
+
+    def __init__(self, text, usage, chunks=1, chunk_delay=0.0, finish_reason="STOP"):
+        self.text = text
+        self.usage_metadata = usage
+        self.candidates = [_FakeCandidate(finish_reason)]
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+
+    def __iter__(self):
+        size = max(1, -(-len(self.text) // self._chunks))
+        for start in range(0, len(self.text), size):
+            time.sleep(self._chunk_delay)
+            yield _FakeChunk(self.text[start:start + size])
+
+class FakeGeminiBackend:
+    """
+    Deterministic offline stand-in for Gemini, for load tests and benchmarks.
+
+    Answers are seeded by seed and the request contents, so the same page
+    always gets the same line items and the same injected failures whatever
+    the thread scheduling. Line items are canned when line_items is given,
+    otherwise generated with consistent arithmetic.
+
+    Args:
+        latency: Seconds each call takes, spread over the chunks when streamed
+        latency_jitter: Extra random latency, up to this many seconds
+        error_rate: Share of calls failing with a 500
+        rate_limit_rate: Share of calls failing with a 429
+        capacity: Calls in flight before each call slows down in proportion;
+            beyond twice this many calls get a 429. None for unlimited
+        rows_per_page: Generated line items per page
+        max_output_items: Line items that fit in one response; longer answers
+            are cut off mid-JSON with finish_reason MAX_TOKENS. None for unlimited
+        misread_rate: Share of generated line items answered with a wrong
+            Total, so they fail the arithmetic checks; a re-request draws afresh
+
+    A strip request answers the strip's share of the page's line items, the
+    rows near its edges in both neighbouring strips. Every page is then
+    treated as holding the same items, since a strip does not say which
+    page it was cut from.
+    """
+
+    def __init__(self, model_name="fake-gemini", seed=0, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 rate_limit_rate=0.0, capacity=None, line_items=None, rows_per_page=10, stream_chunks=8,
+                 system_prompt=None, max_output_items=None, misread_rate=0.0):
+        self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.seed = seed
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.capacity = capacity
+        self.line_items = line_items
+        self.rows_per_page = rows_per_page
+        self.stream_chunks = stream_chunks
+        self.max_output_items = max_output_items
+        self.misread_rate = misread_rate
+        self.calls = 0
+        self.rate_limited = 0
+        self.in_flight = 0
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def set_capacity(self, capacity):
+        with self._lock:
+            self.capacity = capacity
+
+    def _line_items(self, rng):
+        if self.line_items is not None:
+            return [dict(item) for item in self.line_items]
+        items = []
+        for row in range(self.rows_per_page):
+            qty = rng.randint(1, 50)
+            rate = round(rng.uniform(10, 500), 2)
+            igst_rate = rng.choice((5, 12, 18))
+            taxable = round(qty * rate, 2)
+            igst = round(taxable * igst_rate / 100, 2)
+            total = taxable + igst
+            if self.misread_rate and rng.random() < self.misread_rate:
+                total += rng.choice((100, 1000, -100))
+            items.append({
+                "Description of Goods": f"Item {row + 1}", "HSN/SAC": "30049011", "Batch No": f"B{rng.randint(100, 999)}",
+                "Mfg Date": "01/01/2025", "Expiry Date": "31/12/2027", "MRP": f"{rate * 1.6:.2f}", "QTY": str(qty),
+                "UOM": "PC", "Rate": f"{rate:.2f}", "Discount%": "0", "Discount Value": "0.00",
+                "Taxable Value": f"{taxable:.2f}", "IGST Rate": str(igst_rate), "IGST Amount": f"{igst:.2f}",
+                "Total": f"{total:.2f}",
+            })
+        return items
+
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        request = json.dumps(contents, sort_keys=True, default=lambda value: hashlib.sha1(value).hexdigest())
+        request_hash = hashlib.sha1(request.encode("utf-8")).hexdigest()
+        with self._lock:
+            self.calls += 1
+            # Retries of the same request draw fresh failures, but deterministically
+            attempt = self._attempts.get(request_hash, 0)
+            self._attempts[request_hash] = attempt + 1
+            if self.capacity is not None and self.in_flight >= 2 * self.capacity:
+                self.rate_limited += 1
+                raise FakeAPIError(429, "Resource has been exhausted (fake capacity)")
+            self.in_flight += 1
+            load = self.in_flight / self.capacity if self.capacity else 1.0
+        try:
+            rng = random.Random(f"{self.seed}:{request_hash}:{attempt}")
+            latency = (self.latency + rng.uniform(0, self.latency_jitter)) * max(1.0, load)
+            failure = rng.random()
+            if failure < self.rate_limit_rate:
+                with self._lock:
+                    self.rate_limited += 1
+                time.sleep(latency / 10)
+                raise FakeAPIError(429, "Resource has been exhausted (fake)")
+            if failure < self.rate_limit_rate + self.error_rate:
+                time.sleep(latency)
+                raise FakeAPIError(500, "Internal error encountered (fake)")
+
+            texts = [part.get("text", "") for turn in contents for part in turn["parts"]]
+            page_numbers = [int(text[5:-1]) for text in texts if text.startswith("Page ") and text.endswith(":")]
+            strips = [STRIP_PATTERN.search(text) for text in texts if STRIP_PATTERN.search(text)]
+            if page_numbers:
+                answer = {"Pages": [{"Page": page_number, "LineItems": self._line_items(rng)}
+                                    for page_number in page_numbers]}
+            elif strips:
+                number, count = int(strips[0].group(1)), int(strips[0].group(2))
+                line_items = self._line_items(random.Random(f"{self.seed}:strips"))
+                top, bottom = strip_bounds(count)[number - 1]
+                answer = {"LineItems": line_items[round(top * len(line_items)):round(bottom * len(line_items))]}
+            else:
+                answer = {"LineItems": self._line_items(rng)}
+            text = json.dumps(answer)
+            finish_reason = "STOP"
+            items = answer["Pages"] if page_numbers else [answer]
+            if self.max_output_items is not None and sum(len(entry["LineItems"]) for entry in items) > self.max_output_items:
+                text, finish_reason = text[:len(text) // 2], "MAX_TOKENS"
+            usage = _FakeUsage(len(request) // 4, len(text) // 4)
+            if stream:
+                return _FakeResponse(text, usage, self.stream_chunks, latency / self.stream_chunks, finish_reason)
+            time.sleep(latency)
+            return _FakeResponse(text, usage, finish_reason=finish_reason)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
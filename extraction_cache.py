@@ -0,0 +1,100 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "extraction_cache.sqlite3"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def make_cache_key(page_bytes, system_prompt, model_name, generation_config):
+    """
+    Content address for one page extraction.
+
+    Args:
+        page_bytes: Rendered page bytes exactly as sent to the model
+        system_prompt: Extraction instructions
+        model_name: Name of the Gemini model
+        generation_config: Dict of generation settings
+
+    Returns:
+        Hex SHA-256 digest of all inputs
+    """
+    digest = hashlib.sha256()
+    for part in (
+        page_bytes,
+        system_prompt.encode("utf-8"),
+        model_name.encode("utf-8"),
+        json.dumps(generation_config, sort_keys=True, default=str).encode("utf-8"),
+    ):
+        # Length prefix each part so different splits can never collide
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+class ExtractionCache:
+    """
+    Persistent SQLite cache of parsed page line items with size-based LRU eviction.
+    Safe to share between threads and, through SQLite locking, between processes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS page_cache ("
+            " key TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS page_cache_last_used ON page_cache (last_used)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Returns the cached line items for key, or None on a miss"""
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM page_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE page_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, line_items):
+        """Stores line items under key and evicts least recently used entries over max_bytes"""
+        payload = json.dumps(line_items)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_cache (key, payload, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, payload, len(payload), time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM page_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM page_cache ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM page_cache WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        """Returns hit/miss counters for this instance and the current cache size"""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM page_cache").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
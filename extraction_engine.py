@@ -0,0 +1,904 @@
+import queue
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field, replace
+import numpy as np
+import google.generativeai as genai
+from arithmetic_checks import DEFAULT_TOLERANCE, check_page_results, failing_pages
+from extraction_cache import make_cache_key
+from layout_templates import extract_template_line_items, learn_template
+from line_item_stream import LineItemStreamParser
+from line_item_schema import (BATCH_LINE_ITEMS_SCHEMA, LINE_ITEMS_SCHEMA, BatchLineItemsResponse, LineItemsResponse,
+                              to_line_item_dicts)
+from model_cascade import ModelCascade
+from page_classifier import classify_page
+from page_render import DEFAULT_RENDER_SETTINGS, IMAGE_MIME_TYPE, render_page
+from page_tiles import DEFAULT_STRIP_COUNT, merge_strip_line_items, render_page_strips, split_text_strips
+from rate_limiter import admission_listener
+from retry_policy import ERROR_RATE_LIMIT, FINISH_MAX_TOKENS, classify_error, finish_reason
+from supplier_fingerprint import text_fingerprint
+from supplier_index import STRATEGY_IMAGE
+from text_extractor import MIN_TEXT_WORDS, extract_text_line_items, page_layout_text
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+# How often the calling thread hands streamed line items to on_line_item
+STREAM_POLL_SECONDS = 0.1
+
+# How often the calling thread looks again at requests still queued in the rate limiter, to hedge them
+# on time once they are sent
+QUEUED_POLL_SECONDS = 0.25
+
+# Pages packed into one request when batching, bounded by a payload budget
+# well under Gemini's 20 MB inline request limit
+DEFAULT_BATCH_PAGES = 1
+DEFAULT_BATCH_BYTES = 4 * 1024 * 1024
+
+# How a page's line items were obtained
+PATH_TEXT = "text"
+PATH_TEMPLATE = "template"
+PATH_CACHE = "cache"
+PATH_GEMINI = "gemini"
+PATH_SKIPPED = "skipped"
+
+# What is sent to Gemini for a page: the rendered image, or the text layer
+# (falling back to the image for scanned pages without one)
+INPUT_IMAGE = "image"
+INPUT_TEXT = "text"
+PAGE_INSTRUCTION = "Extract all line items from this invoice page and format as specified."
+TEXT_PAGE_PREAMBLE = "The invoice page text below keeps the printed column layout:"
+STRIP_INSTRUCTION = (
+    "This is strip {number} of {count} of an invoice page, cut horizontally with some overlap. Extract the "
+    "line items whose row is fully visible in this strip and format as specified."
+)
+RECHECK_INSTRUCTION = (
+    "In an earlier answer for this page the amounts of line items {rows} did not add up. Read QTY, Rate, "
+    "the discount, Taxable Value, IGST and Total of every row again carefully."
+)
+BATCH_INSTRUCTION = (
+    "Extract all line items from each invoice page above. Return one entry per page with its "
+    "page number, including pages that have no line items."
+)
+
+# The response schemas fix the JSON structure, so the prompt no longer has to describe it
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": LINE_ITEMS_SCHEMA}
+BATCH_GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": BATCH_LINE_ITEMS_SCHEMA}
+
+class TruncatedResponseError(Exception):
+    """The model stopped at its output token limit, so the page's JSON is cut off"""
+
+@dataclass
+class PageJob:
+    """
+    A page waiting to be sent to Gemini, as either a rendered image or layout
+    text. strip is (index, count) when the job is one horizontal strip of a
+    page too dense to answer in one response. recheck_rows lists the 1-based
+    line items whose amounts did not add up when the page is re-requested.
+    """
+    page_index: int
+    image_bytes: bytes = None
+    text: str = None
+    strip: tuple = None
+    recheck_rows: tuple = None
+
+    @property
+    def input_mode(self):
+        return INPUT_TEXT if self.text is not None else INPUT_IMAGE
+
+    @property
+    def payload(self):
+        """The page content as bytes, used for cache keys and size accounting"""
+        return self.text.encode("utf-8") if self.text is not None else self.image_bytes
+
+@dataclass
+class PageResult:
+    """
+    Outcome of extracting one page. error is set when the page failed.
+    usage, latency, attempts and payload_bytes cover every request made for
+    the page, including answers that were thrown away; when those requests
+    went to more than one model, usage_by_tier splits usage by model name,
+    and escalations counts the lower tier answers that were thrown away.
+    """
+    page_index: int
+    line_items: list = field(default_factory=list)
+    error: str = None
+    response_text: str = None
+    path: str = PATH_GEMINI
+    input_mode: str = None
+    usage: dict = None
+    skip_reason: str = None
+    queue_wait: float = 0.0
+    attempts: int = 0
+    latency: float = 0.0
+    throttled: bool = False
+    tier: str = None
+    payload_bytes: int = 0
+    hedged: bool = False
+    hedge_won: bool = False
+    truncated: bool = False
+    strip: tuple = None
+    strips: int = 0
+    rechecks: int = 0
+    recheck_kept: bool = False
+    usage_by_tier: dict = None
+    escalations: int = 0
+
+def _page_part(job):
+    if job.input_mode == INPUT_TEXT:
+        return {"text": f"{TEXT_PAGE_PREAMBLE}\n{job.text}"}
+    return {"inline_data": {"mime_type": IMAGE_MIME_TYPE, "data": job.image_bytes}}
+
+def _inline_prompt(model, system_prompt):
+    """
+    The prompt to send as a user turn, or None when the model already
+    carries it as its system instruction (see gemini_model.create_model)
+    """
+    if getattr(model, "system_prompt", None) == system_prompt:
+        return None
+    return system_prompt
+
+def _with_prompt(system_prompt, parts):
+    contents = [{"role": "user", "parts": parts}]
+    if system_prompt:
+        contents.insert(0, {"role": "user", "parts": [{"text": system_prompt}]})
+    return contents
+
+def build_page_contents(system_prompt, job):
+    """Builds the generate_content request for a single page or strip, system_prompt may be None"""
+    if job.strip is not None:
+        instruction = STRIP_INSTRUCTION.format(number=job.strip[0] + 1, count=job.strip[1])
+    else:
+        instruction = PAGE_INSTRUCTION
+    if job.recheck_rows:
+        instruction += " " + RECHECK_INSTRUCTION.format(rows=", ".join(map(str, job.recheck_rows)))
+    return _with_prompt(system_prompt, [_page_part(job), {"text": instruction}])
+
+def build_batch_contents(system_prompt, jobs):
+    """Builds one generate_content request carrying several pages, each labelled with its page number"""
+    parts = []
+    for job in jobs:
+        parts.append({"text": f"Page {job.page_index + 1}:"})
+        parts.append(_page_part(job))
+    parts.append({"text": BATCH_INSTRUCTION})
+    return _with_prompt(system_prompt, parts)
+
+def pack_page_jobs(jobs, max_pages=DEFAULT_BATCH_PAGES, max_bytes=DEFAULT_BATCH_BYTES):
+    """
+    Greedily groups jobs, in page order, into batches of at most max_pages
+    pages and max_bytes of page payload. A page larger than max_bytes gets
+    a batch of its own.
+    """
+    batches = []
+    batch_bytes = 0
+    for job in jobs:
+        size = len(job.payload)
+        if not batches or len(batches[-1]) >= max_pages or batch_bytes + size > max_bytes:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(job)
+        batch_bytes += size
+    return batches
+
+def usage_from_response(response):
+    """Token counts from a response's usage_metadata, or None when it is missing"""
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return None
+    return {
+        "prompt_tokens": metadata.prompt_token_count,
+        "candidates_tokens": metadata.candidates_token_count,
+        "total_tokens": metadata.total_token_count,
+        "cached_tokens": getattr(metadata, "cached_content_token_count", 0) or 0,
+    }
+
+def parse_line_items(response_text):
+    """
+    Parses a Gemini JSON response into a list of line items with all
+    LINE_ITEM_FIELDS present, in one pydantic validation pass.
+    Responses without a "LineItems" key yield no items; responses that do
+    not match the schema raise pydantic.ValidationError.
+    """
+    return LineItemsResponse.model_validate_json(response_text).model_dump(by_alias=True)["LineItems"]
+
+def extract_page(model, job, system_prompt, line_item_queue=None):
+    """
+    Sends one page to Gemini and parses its line items.
+    Errors are captured on the returned PageResult instead of raised so one
+    bad page never takes the rest of the document down with it.
+
+    With a line_item_queue the response is streamed, and each line item is
+    put on the queue as (page_index, line_item) as soon as it is complete.
+
+    A response cut off at the output token limit fails the page with
+    PageResult.truncated set, see run_strips.
+    """
+    response = None
+    start = time.monotonic()
+    try:
+        response = model.generate_content(
+            contents=build_page_contents(_inline_prompt(model, system_prompt), job),
+            generation_config=genai.types.GenerationConfig(**GENERATION_CONFIG),
+            stream=line_item_queue is not None
+        )
+        if line_item_queue is not None:
+            parser = LineItemStreamParser()
+            for chunk in response:
+                for line_item in parser.feed(chunk.text):
+                    line_item_queue.put((job.page_index, line_item))
+            response_text = parser.full_text()
+        else:
+            response_text = response.text
+        if finish_reason(response) == FINISH_MAX_TOKENS:
+            raise TruncatedResponseError(f"Response cut off at the output token limit after {len(response_text)} characters")
+        return PageResult(job.page_index, parse_line_items(response_text),
+                          input_mode=job.input_mode, usage=usage_from_response(response),
+                          queue_wait=_queue_wait(response), attempts=getattr(response, "attempts", 1),
+                          payload_bytes=len(job.payload), strip=job.strip,
+                          latency=_latency(start, response), throttled=getattr(response, "throttled", False))
+    except Exception as e:
+        return PageResult(job.page_index, error=str(e), response_text=_response_text(response),
+                          input_mode=job.input_mode, usage=usage_from_response(response),
+                          queue_wait=_queue_wait(response), attempts=_attempts(response, e),
+                          payload_bytes=len(job.payload), strip=job.strip,
+                          latency=_latency(start, response), throttled=_throttled(response, e),
+                          truncated=isinstance(e, TruncatedResponseError))
+
+def _attempts(response, error=None):
+    """Requests made for a call, from the response or else from the error RetryingModel gave up with"""
+    if response is not None:
+        return getattr(response, "attempts", 1)
+    return getattr(error, "attempts", 1)
+
+def _throttled(response, error=None):
+    """Whether a call hit a 429, from the response or else from the error it failed with"""
+    if response is not None and getattr(response, "throttled", False):
+        return True
+    return getattr(error, "throttled", False) or classify_error(error) == ERROR_RATE_LIMIT
+
+def _queue_wait(response):
+    """Seconds the request spent in the rate limiter queue, see rate_limiter.RateLimitedModel"""
+    return getattr(response, "queue_wait", 0.0) if response is not None else 0.0
+
+def _latency(start, response):
+    """Seconds since start spent on the call itself, not waiting in the rate limiter queue"""
+    return max(0.0, time.monotonic() - start - _queue_wait(response))
+
+def _split_usage(usage, parts):
+    """Shares a batched request's token usage evenly between its pages"""
+    if not usage:
+        return None
+    return {key: (value or 0) // parts for key, value in usage.items()}
+
+def extract_batch(model, jobs, system_prompt):
+    """
+    Sends several pages to Gemini in one request and splits the answer back per page.
+
+    Returns:
+        (results, failed_jobs, spent): PageResults for pages the response
+        covered, the jobs that have to be retried on their own because the
+        response was malformed or left them out, and for each of those a
+        failed PageResult carrying its share of the request's cost
+    """
+    response = failure = None
+    start = time.monotonic()
+    try:
+        response = model.generate_content(
+            contents=build_batch_contents(_inline_prompt(model, system_prompt), jobs),
+            generation_config=genai.types.GenerationConfig(**BATCH_GENERATION_CONFIG)
+        )
+        pages = BatchLineItemsResponse.model_validate_json(response.text).Pages
+        line_items_by_page = {entry.Page: to_line_item_dicts(entry.LineItems) for entry in pages}
+        error = "Page missing from the batched response"
+    except Exception as e:
+        line_items_by_page = {}
+        error = str(e)
+        failure = e
+
+    usage = _split_usage(usage_from_response(response), len(jobs))
+    results = []
+    failed_jobs = []
+    spent = []
+    for job in jobs:
+        result = PageResult(job.page_index, line_items_by_page.get(job.page_index + 1, []),
+                            input_mode=job.input_mode, usage=usage,
+                            queue_wait=_queue_wait(response),
+                            attempts=_attempts(response, failure),
+                            payload_bytes=len(job.payload),
+                            latency=_latency(start, response),
+                            throttled=_throttled(response, failure))
+        if job.page_index + 1 in line_items_by_page:
+            results.append(result)
+        else:
+            result.error = error
+            failed_jobs.append(job)
+            spent.append(result)
+    return results, failed_jobs, spent
+
+def _response_text(response):
+    """Best effort access to response.text, which raises for blocked or empty responses"""
+    if response is None:
+        return None
+    try:
+        return response.text
+    except Exception:
+        return None
+
+def run_page_jobs(model, jobs, system_prompt, max_concurrency=DEFAULT_MAX_CONCURRENCY, on_progress=None,
+                  batch_pages=DEFAULT_BATCH_PAGES, batch_bytes=DEFAULT_BATCH_BYTES, concurrency=None,
+                  on_line_item=None, hedging=None):
+    """
+    Extracts line items from many pages concurrently.
+
+    Args:
+        model: genai.GenerativeModel used for every page
+        jobs: List of PageJob
+        system_prompt: Extraction instructions sent with every request
+        max_concurrency: Maximum number of in-flight Gemini requests
+        on_progress: Optional callback(completed_pages, total_pages), called
+            from the calling thread each time a page finishes
+        batch_pages: Pages packed into one request; pages of a batch whose
+            response is malformed are retried one request per page
+        batch_bytes: Page payload budget of one batched request
+        concurrency: Optional concurrency_control.AdaptiveConcurrency; when
+            given, its limit replaces max_concurrency and is fed the latency
+            and rate limiting of every request
+        on_line_item: Optional callback(page_index, line_item). Single page
+            requests are then streamed and the callback gets each line item
+            as soon as the model has written it, from the calling thread.
+            The returned results still come from the complete responses.
+        hedging: Optional concurrency_control.HedgePolicy. A single page
+            request still running after its hedge delay gets a duplicate;
+            the first good answer is kept and the other request abandoned.
+            Duplicates do not count against the concurrency limit. The delay
+            runs from when a request leaves the rate limiter queue, and
+            both requests' usage is charged to the page: a failed one's
+            right away, an abandoned one's if it answers before the rest
+            of the pages are done.
+
+    Returns:
+        List of PageResult in page order
+    """
+    if not jobs:
+        return []
+
+    if batch_pages > 1:
+        pending_batches = deque(pack_page_jobs(jobs, batch_pages, batch_bytes))
+    else:
+        pending_batches = deque([job] for job in jobs)
+    max_workers = concurrency.max_limit if concurrency is not None else max_concurrency
+    line_item_queue = queue.Queue() if on_line_item else None
+    finished_pages = set()
+    # Cost of batched requests whose answer for a page was unusable, added to the page's own result
+    spent_by_page = {}
+
+    def deliver_line_items():
+        while line_item_queue is not None and not line_item_queue.empty():
+            page_index, line_item = line_item_queue.get()
+            # A page answered by its hedge may still be streaming from the abandoned request
+            if page_index not in finished_pages:
+                on_line_item(page_index, line_item)
+
+    results = []
+    # Abandoned requests keep their thread until they return, so hedging needs spare workers
+    pool_size = max(1, min(max_workers, len(pending_batches))) * (2 if hedging is not None else 1)
+    executor = ThreadPoolExecutor(max_workers=pool_size)
+    # Every request in flight, primary or duplicate, with its batch, and a cell holding when it last
+    # left the rate limiter queue (None while it waits there), see _send
+    in_flight = {}
+    sent_at = {}
+    # Duplicates sent, and each hedged request's counterpart while both are running
+    duplicates = set()
+    twins = {}
+    # Losing requests that were already running, by the index in results of the page they lost on
+    abandoned = {}
+    # Batches with a duplicate, by identity: strips of one page share its page_index
+    hedged_batches = set()
+    requests_sent = 0
+    try:
+        while pending_batches or in_flight:
+            limit = concurrency.limit if concurrency is not None else max_concurrency
+            while pending_batches and len(in_flight) - len(duplicates & in_flight.keys()) < max(1, limit):
+                batch = pending_batches.popleft()
+                sent = [time.monotonic()]
+                if len(batch) > 1:
+                    future = executor.submit(_send, sent, extract_batch, model, batch, system_prompt)
+                else:
+                    future = executor.submit(_send, sent, extract_page, model, batch[0], system_prompt,
+                                             line_item_queue)
+                in_flight[future] = batch
+                sent_at[future] = sent
+                requests_sent += 1
+
+            timeout = STREAM_POLL_SECONDS if on_line_item else None
+            hedge_delay = hedging.delay() if hedging is not None else None
+            if hedge_delay is not None:
+                now = time.monotonic()
+                for future, batch in list(in_flight.items()):
+                    if len(batch) > 1 or future in twins or future in duplicates:
+                        continue
+                    if not hedging.allow(requests_sent, len(duplicates)):
+                        break
+                    sent = sent_at[future][0]
+                    if sent is None:
+                        # Still queued, a duplicate would only queue behind it
+                        timeout = QUEUED_POLL_SECONDS if timeout is None else min(timeout, QUEUED_POLL_SECONDS)
+                        continue
+                    remaining = sent + hedge_delay - now
+                    if remaining > 0:
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                        continue
+                    duplicate_sent = [now]
+                    duplicate = executor.submit(_send, duplicate_sent, extract_page, model, batch[0], system_prompt)
+                    in_flight[duplicate] = batch
+                    sent_at[duplicate] = duplicate_sent
+                    duplicates.add(duplicate)
+                    twins[future], twins[duplicate] = duplicate, future
+                    hedged_batches.add(id(batch))
+
+            done, _ = wait([*in_flight, *abandoned], timeout=timeout, return_when=FIRST_COMPLETED)
+            deliver_line_items()
+            for future in done:
+                if future in abandoned:
+                    # Lost the race to its twin but answered while other pages are still running
+                    index = abandoned.pop(future)
+                    loser = future.result()
+                    results[index] = _add_request_costs(results[index], [loser])
+                    if concurrency is not None:
+                        concurrency.record(loser.latency, loser.throttled)
+                    continue
+                if future not in in_flight:
+                    # Lost the race to its twin before it was started
+                    continue
+                batch = in_flight.pop(future)
+                sent_at.pop(future)
+                outcome = future.result()
+                twin = twins.pop(future, None)
+                loser = None
+                if twin is not None:
+                    del twins[twin]
+                    if outcome.error:
+                        # Wait for the other request rather than give up on the page, which still pays for this one
+                        spent_by_page.setdefault(outcome.page_index, []).append(outcome)
+                        if concurrency is not None:
+                            concurrency.record(outcome.latency, outcome.throttled)
+                        continue
+                    if not twin.cancel():
+                        loser = twin
+                    in_flight.pop(twin)
+                    sent_at.pop(twin)
+
+                if isinstance(outcome, PageResult):
+                    if outcome.page_index in spent_by_page:
+                        outcome = _add_request_costs(outcome, spent_by_page.pop(outcome.page_index))
+                    results.append(outcome)
+                    finished_pages.add(outcome.page_index)
+                    if loser is not None:
+                        abandoned[loser] = len(results) - 1
+                    requests = [outcome]
+                    if hedging is not None:
+                        hedging.record(outcome.latency)
+                        if id(batch) in hedged_batches:
+                            outcome.hedged = True
+                            outcome.hedge_won = future in duplicates
+                            hedging.count(outcome.hedge_won)
+                else:
+                    batch_results, failed_jobs, spent = outcome
+                    results.extend(batch_results)
+                    finished_pages.update(result.page_index for result in batch_results)
+                    for result in spent:
+                        spent_by_page.setdefault(result.page_index, []).append(result)
+                    # Pages of a batch share one request, feed it back once
+                    requests = (batch_results or spent)[:1]
+                    pending_batches.extend([job] for job in failed_jobs)
+                if concurrency is not None:
+                    for result in requests:
+                        concurrency.record(result.latency, result.throttled)
+                if on_progress:
+                    on_progress(len(results), len(jobs))
+    finally:
+        # Abandoned hedge losers cannot be interrupted mid-request; don't wait for them
+        executor.shutdown(wait=hedging is None, cancel_futures=True)
+
+    results.sort(key=lambda result: result.page_index)
+    return results
+
+def _send(sent, function, *args):
+    """function(*args) on a worker thread, with sent[0] kept at when its request last left the rate limiter queue"""
+    def listener(admitted):
+        sent[0] = admitted
+    with admission_listener(listener):
+        return function(*args)
+
+def _sum_usage(usages):
+    usages = [usage for usage in usages if usage]
+    return {key: sum(usage.get(key) or 0 for usage in usages) for key in usages[0]} if usages else None
+
+def _add_request_costs(result, discarded):
+    """
+    result with the tokens, latency, queue wait, attempts and payload of the
+    discarded requests made for the same page added, keeping usage per model
+    in usage_by_tier when they went to different tiers
+    """
+    requests = [result] + list(discarded)
+    usage_by_tier = {}
+    for request in requests:
+        for tier, usage in (request.usage_by_tier or {request.tier: request.usage}).items():
+            usage_by_tier[tier] = _sum_usage([usage_by_tier.get(tier), usage])
+    return replace(
+        result,
+        usage=_sum_usage(request.usage for request in requests),
+        usage_by_tier=usage_by_tier if len([usage for usage in usage_by_tier.values() if usage]) > 1 else None,
+        queue_wait=sum(request.queue_wait for request in requests),
+        attempts=sum(request.attempts for request in requests),
+        latency=sum(request.latency for request in requests),
+        throttled=any(request.throttled for request in requests),
+        payload_bytes=sum(request.payload_bytes for request in requests),
+    )
+
+def _merge_strip_results(job, truncated_result, strip_results):
+    """One PageResult for a page from its truncated answer and its strips' results, in strip order"""
+    requests = [truncated_result] + strip_results
+    failed = [result for result in strip_results if result.error]
+    return PageResult(
+        job.page_index,
+        [] if failed else merge_strip_line_items([result.line_items for result in strip_results]),
+        error="; ".join(f"Strip {result.strip[0] + 1}: {result.error}" for result in failed) or None,
+        response_text=failed[0].response_text if failed else None,
+        input_mode=job.input_mode,
+        usage=_sum_usage(result.usage for result in requests),
+        queue_wait=truncated_result.queue_wait + max(result.queue_wait for result in strip_results),
+        attempts=sum(result.attempts for result in requests),
+        latency=truncated_result.latency + max(result.latency for result in strip_results),
+        throttled=any(result.throttled for result in requests),
+        payload_bytes=sum(result.payload_bytes for result in requests),
+        hedged=any(result.hedged for result in requests),
+        hedge_won=any(result.hedge_won for result in requests),
+        truncated=any(result.truncated for result in strip_results),
+        strips=len(strip_results),
+    )
+
+def run_strips(model, truncated, split_job, system_prompt, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+               concurrency=None, hedging=None):
+    """
+    Re-extracts pages whose answer was cut off at the output token limit as
+    overlapping horizontal strips, every strip of every page in one round of
+    concurrent requests, and merges each page's strips back into one
+    PageResult, dropping the rows read twice in the overlaps.
+
+    Args:
+        truncated: (PageJob, PageResult) pairs of the truncated pages
+        split_job: Callable(job) returning the page's strip PageJobs, top to
+            bottom, called on the calling thread
+
+    Returns:
+        List of PageResult in page order, one per truncated page, with
+        strips set to the number of strips it was split into
+    """
+    strip_jobs = [strip_job for job, _ in truncated for strip_job in split_job(job)]
+    strip_results = {}
+    for result in run_page_jobs(model, strip_jobs, system_prompt, max_concurrency, batch_pages=1,
+                                concurrency=concurrency, hedging=hedging):
+        strip_results.setdefault(result.page_index, []).append(result)
+    results = [_merge_strip_results(job, result, sorted(strip_results[job.page_index], key=lambda strip: strip.strip))
+               for job, result in truncated]
+    results.sort(key=lambda result: result.page_index)
+    return results
+
+def _recheck_result(original, retried, keep_retried):
+    """The PageResult of a re-requested page, with the better answer and both requests' costs"""
+    chosen = retried if keep_retried else original
+    return replace(
+        _add_request_costs(original, [retried]),
+        line_items=chosen.line_items,
+        response_text=chosen.response_text,
+        rechecks=original.rechecks + 1,
+        recheck_kept=original.recheck_kept or keep_retried,
+    )
+
+def run_rechecks(models, results, jobs_by_page, recheck, system_prompt, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 concurrency=None, hedging=None):
+    """
+    Re-requests the pages whose line items fail the arithmetic checks, all
+    in one round of concurrent requests per attempt, each from the model
+    that answered it and told which rows did not add up. The other pages
+    are not sent again. A page keeps the new answer only when a smaller
+    share of its rows fails; either way it is marked with the re-request.
+
+    Args:
+        models: Models by model_name, as PageResult.tier names them
+        results: PageResults of the Gemini pages
+        jobs_by_page: The PageJob of each page index
+        recheck: ArithmeticRecheck with the tolerance, allowed failing share
+            and number of attempts
+
+    Returns:
+        List of PageResult in page order
+    """
+    results_by_page = {result.page_index: result for result in results}
+    for _ in range(recheck.attempts):
+        pages = sorted(page for page in failing_pages(results_by_page.values(), recheck.tolerance,
+                                                      recheck.max_failing_fraction)
+                       if results_by_page[page].tier in models)
+        if not pages:
+            break
+        # One bulk check of the failing pages gives each page's failing rows and failing share
+        check = check_page_results([results_by_page[page] for page in pages], recheck.tolerance)
+        _, failing, rows = check.page_failures(pages)
+        starts = np.searchsorted(check.page_indices, pages)
+        failed_rows = np.flatnonzero(check.failed)
+        row_pages = np.searchsorted(pages, check.page_indices[failed_rows])
+        jobs_by_tier = {}
+        for position, page in enumerate(pages):
+            numbers = failed_rows[row_pages == position] - starts[position] + 1
+            job = replace(jobs_by_page[page], recheck_rows=tuple(numbers.tolist()))
+            jobs_by_tier.setdefault(results_by_page[page].tier, []).append(job)
+
+        retried = []
+        for tier, jobs in jobs_by_tier.items():
+            retried.extend(run_page_jobs(models[tier], jobs, system_prompt, max_concurrency, batch_pages=1,
+                                         concurrency=concurrency, hedging=hedging))
+        usable = [result for result in retried if not result.error and result.line_items]
+        retried_check = check_page_results(usable, recheck.tolerance)
+        usable_pages = sorted(result.page_index for result in usable)
+        _, retried_failing, retried_rows = retried_check.page_failures(usable_pages)
+        retried_share = dict(zip(usable_pages, (retried_failing / np.maximum(retried_rows, 1)).tolist()))
+        share = dict(zip(pages, (failing / np.maximum(rows, 1)).tolist()))
+        for result in retried:
+            page = result.page_index
+            keep = page in retried_share and retried_share[page] < share[page]
+            result.tier = results_by_page[page].tier
+            results_by_page[page] = _recheck_result(results_by_page[page], result, keep)
+    return sorted(results_by_page.values(), key=lambda result: result.page_index)
+
+def run_cascade(model, jobs, system_prompt, max_concurrency=DEFAULT_MAX_CONCURRENCY, on_progress=None,
+                batch_pages=DEFAULT_BATCH_PAGES, batch_bytes=DEFAULT_BATCH_BYTES, concurrency=None,
+                on_line_item=None, hedging=None, split_job=None, recheck=None):
+    """
+    Runs run_page_jobs through each tier of a ModelCascade, re-sending only
+    the pages whose answer needs escalation to the next tier. A plain model
+    is a cascade of one. Each result records the model that resolved it in
+    PageResult.tier.
+
+    Streamed line items (on_line_item) come from the first tier only; an
+    escalated page's final items are in the returned results.
+
+    With split_job, pages a tier's answer was truncated on are re-sent to
+    the same tier as strips (see run_strips) before deciding on escalation.
+
+    With recheck, an ArithmeticRecheck, pages whose final answer still
+    fails the arithmetic checks are re-requested from the tier that
+    resolved them, see run_rechecks.
+
+    Returns:
+        List of PageResult in page order
+    """
+    tiers = model.tiers if isinstance(model, ModelCascade) else [model]
+    jobs_by_page = {job.page_index: job for job in jobs}
+    resolved = []
+    # Lower tier answers of escalated pages, whose cost still counts towards the page
+    escalated_results = {}
+    reported = [0]
+
+    for tier_index, tier_model in enumerate(tiers):
+        if not jobs:
+            break
+        last_tier = tier_index == len(tiers) - 1
+
+        def report_progress(completed, total):
+            # Escalated pages are counted once, so progress never moves backwards
+            reported[0] = max(reported[0], len(resolved) + completed)
+            if on_progress:
+                on_progress(reported[0], len(jobs_by_page))
+
+        tier_results = run_page_jobs(tier_model, jobs, system_prompt, max_concurrency, report_progress,
+                                     batch_pages, batch_bytes, concurrency,
+                                     on_line_item if tier_index == 0 else None, hedging)
+        truncated = [(jobs_by_page[result.page_index], result) for result in tier_results if result.truncated]
+        if truncated and split_job is not None:
+            stripped = {result.page_index: result for result in run_strips(tier_model, truncated, split_job,
+                                                                           system_prompt, max_concurrency,
+                                                                           concurrency, hedging)}
+            tier_results = [stripped.get(result.page_index, result) for result in tier_results]
+
+        escalate = set() if last_tier else model.escalations(tier_results)
+        escalated = []
+        for result in tier_results:
+            result.tier = getattr(tier_model, "model_name", None)
+            if result.page_index in escalate:
+                escalated.append(jobs_by_page[result.page_index])
+                escalated_results.setdefault(result.page_index, []).append(result)
+            elif result.page_index in escalated_results:
+                discarded = escalated_results.pop(result.page_index)
+                resolved.append(replace(_add_request_costs(result, discarded), escalations=len(discarded)))
+            else:
+                resolved.append(result)
+        jobs = escalated
+
+    if recheck is not None and recheck.attempts > 0:
+        models = {getattr(tier_model, "model_name", None): tier_model for tier_model in tiers}
+        return run_rechecks(models, resolved, jobs_by_page, recheck, system_prompt, max_concurrency,
+                            concurrency, hedging)
+    resolved.sort(key=lambda result: result.page_index)
+    return resolved
+
+def extract_document(model, pdf_document, system_prompt, page_count,
+                     render_settings=DEFAULT_RENDER_SETTINGS,
+                     max_concurrency=DEFAULT_MAX_CONCURRENCY, on_progress=None,
+                     cache=None, use_text_layer=True, llm_input=INPUT_TEXT, templates=None,
+                     supplier=None, skip_pages=True, batch_pages=DEFAULT_BATCH_PAGES,
+                     batch_bytes=DEFAULT_BATCH_BYTES, concurrency=None, on_line_item=None, hedging=None,
+                     strip_count=DEFAULT_STRIP_COUNT, recheck=None, tolerance=None):
+    """
+    Extracts line items from the first page_count pages of an open PDF.
+
+    Each page is first tried on its text layer, with the supplier's learned
+    layout template when there is one and otherwise with table detection.
+    Pages without a text layer, or whose local extraction fails the
+    arithmetic checks, are prepared for Gemini and looked up in the cache,
+    and only the remaining pages are sent concurrently.
+    All PyMuPDF work happens up front on the calling thread because
+    documents must not be shared between threads.
+
+    Args:
+        cache: Optional ExtractionCache consulted before calling the model;
+            successful extractions are written back to it
+        use_text_layer: Try the deterministic text-layer extractor first
+        llm_input: INPUT_TEXT sends the layout text of pages that have a text
+            layer instead of their image; INPUT_IMAGE always sends images
+        templates: Optional TemplateIndex of per-supplier layout templates.
+            When the supplier has none, or it failed on this document, a new
+            one is learned from the model's output
+        supplier: Optional SupplierMatch from SupplierIndex.identify. Its id keys
+            the layout template, and suppliers that send scanned invoices go
+            straight to Gemini as images without any text layer work
+        skip_pages: Classify pages locally first and skip those that cannot
+            hold line items (terms and conditions, e-way bills, blank pages)
+        batch_pages, batch_bytes: Pack up to batch_pages pages, within
+            batch_bytes of payload, into each Gemini request
+        concurrency: Optional AdaptiveConcurrency that tunes the number of
+            requests in flight instead of max_concurrency
+        on_line_item: Optional callback(page_index, line_item) for line items
+            streamed from Gemini while pages are still being generated
+        hedging: Optional HedgePolicy to duplicate requests for pages that
+            take longer than the observed p90 latency, see run_page_jobs
+        strip_count: Pages whose answer is cut off at the output token
+            limit are re-sent as this many overlapping horizontal strips;
+            below 2 they fail instead
+        recheck: Optional ArithmeticRecheck to re-request the Gemini pages
+            whose line items do not add up, see run_rechecks
+        tolerance: ArithmeticTolerance of the checks that text layer and
+            template extractions, and learned templates, must pass; by
+            default recheck's, or DEFAULT_TOLERANCE without one
+
+    model may be a ModelCascade; pages then go to its cheapest tier first,
+    see run_cascade.
+
+    Returns:
+        List of PageResult in page order
+    """
+    results = []
+    pending = []
+    cache_keys = {}
+    if tolerance is None:
+        tolerance = recheck.tolerance if recheck is not None else DEFAULT_TOLERANCE
+    if supplier is not None and supplier.strategy == STRATEGY_IMAGE:
+        use_text_layer, llm_input = False, INPUT_IMAGE
+    fingerprint = template = None
+    if use_text_layer and templates is not None and page_count:
+        fingerprint = supplier.supplier_id if supplier else text_fingerprint(pdf_document.load_page(0))
+        template = templates.get(fingerprint) if fingerprint else None
+    template_failed = False
+    # Words of text pages sent to Gemini, kept to learn a template from the answer
+    page_words = {}
+
+    for page_index in range(page_count):
+        page = pdf_document.load_page(page_index)
+        words = page.get_text("words") if use_text_layer or llm_input == INPUT_TEXT or skip_pages else []
+        has_text = len(words) >= MIN_TEXT_WORDS
+        if skip_pages:
+            keep, reason = classify_page(page, words)
+            if not keep:
+                results.append(PageResult(page_index, path=PATH_SKIPPED, skip_reason=reason))
+                continue
+        if use_text_layer and has_text:
+            if template is not None:
+                line_items = extract_template_line_items(template, words, page.rect.width, tolerance)
+                if line_items is not None:
+                    results.append(PageResult(page_index, line_items, path=PATH_TEMPLATE))
+                    continue
+                template_failed = True
+            line_items = extract_text_line_items(page, tolerance)
+            if line_items is not None:
+                results.append(PageResult(page_index, line_items, path=PATH_TEXT))
+                continue
+            page_words[page_index] = (words, page.rect.width)
+
+        if llm_input == INPUT_TEXT and has_text:
+            job = PageJob(page_index, text=page_layout_text(page))
+        else:
+            job = PageJob(page_index, image_bytes=render_page(page, render_settings))
+        if cache is not None:
+            key = make_cache_key(job.payload, system_prompt, model.model_name, GENERATION_CONFIG)
+            line_items = cache.get(key)
+            if line_items is not None:
+                results.append(PageResult(page_index, line_items, path=PATH_CACHE))
+                # Cached answers are model output too, so they can still teach a template
+                continue
+            cache_keys[page_index] = key
+        pending.append(job)
+
+    resolved_locally = len(results)
+    if on_progress and resolved_locally:
+        on_progress(resolved_locally, page_count)
+
+    def report_progress(completed, total):
+        if on_progress:
+            on_progress(resolved_locally + completed, page_count)
+
+    def split_page_job(job):
+        # Called back from run_cascade on this thread, so the document stays on it
+        if job.input_mode == INPUT_TEXT:
+            strip_jobs = [PageJob(job.page_index, text=text) for text in split_text_strips(job.text, strip_count)]
+        else:
+            page = pdf_document.load_page(job.page_index)
+            strip_jobs = [PageJob(job.page_index, image_bytes=image_bytes)
+                          for image_bytes in render_page_strips(page, render_settings, strip_count)]
+        for strip_index, strip_job in enumerate(strip_jobs):
+            strip_job.strip = (strip_index, len(strip_jobs))
+        return strip_jobs
+
+    for result in run_cascade(model, pending, system_prompt, max_concurrency, report_progress,
+                              batch_pages, batch_bytes, concurrency, on_line_item, hedging,
+                              split_page_job if strip_count >= 2 else None, recheck):
+        if cache is not None and not result.error:
+            cache.put(cache_keys[result.page_index], result.line_items)
+        results.append(result)
+
+    results.sort(key=lambda result: result.page_index)
+    if fingerprint and (template is None or template_failed):
+        _learn_supplier_template(templates, fingerprint, results, page_words, tolerance)
+    return results
+
+def _learn_supplier_template(templates, fingerprint, results, page_words, tolerance):
+    """Stores a template learned from the first model-extracted page that yields a reliable one"""
+    for result in results:
+        if result.path not in (PATH_GEMINI, PATH_CACHE) or result.error or result.page_index not in page_words:
+            continue
+        words, page_width = page_words[result.page_index]
+        template = learn_template(words, result.line_items, page_width, tolerance)
+        if template is not None:
+            templates.put(fingerprint, template)
+            return
+
+def count_page_paths(results):
+    """Returns how many pages took each extraction path, e.g. {"text": 3, "gemini": 1}"""
+    counts = {}
+    for result in results:
+        counts[result.path] = counts.get(result.path, 0) + 1
+    return counts
+
+def summarize_token_usage(results):
+    """
+    Totals token usage of the pages sent to Gemini, per input mode.
+
+    Returns:
+        Dict of input mode -> {"pages", "prompt_tokens", "candidates_tokens", "total_tokens", "cached_tokens"}
+    """
+    token_keys = ("prompt_tokens", "candidates_tokens", "total_tokens", "cached_tokens")
+    summary = {}
+    for result in results:
+        if not result.usage:
+            continue
+        totals = summary.setdefault(result.input_mode, dict.fromkeys(("pages",) + token_keys, 0))
+        totals["pages"] += 1
+        for key in token_keys:
+            totals[key] += result.usage.get(key) or 0
+    return summary
+
+def combine_page_results(results):
+    """Merges per-page results into the {"LineItems": [...]} structure, in page order"""
+    all_line_items = []
+    for result in results:
+        all_line_items.extend(result.line_items)
+    return {"LineItems": all_line_items}
@@ -1,105 +1,218 @@
 from dotenv import load_dotenv
-import google.generativeai as genai
+import functools
 import os
 import json
 import fitz  # PyMuPDF
-from PIL import Image
-import io
-import tempfile
 import time
-import atexit
+from page_render import DEFAULT_RENDER_SETTINGS
+from arithmetic_checks import ArithmeticRecheck
+from concurrency_control import AdaptiveConcurrency, HedgePolicy, describe
+from extraction_cache import ExtractionCache
+from extraction_engine import (DEFAULT_BATCH_PAGES, DEFAULT_MAX_CONCURRENCY, INPUT_TEXT, combine_page_results, count_page_paths,
+                               extract_document, summarize_token_usage)
+from extraction_backend import BACKEND_FAKE, BACKEND_GEMINI, FakeGeminiBackend, create_gemini_backend
+from gemini_model import load_system_prompt
+from layout_templates import TemplateIndex
+from line_items import validate_line_items
+from model_cascade import count_resolving_tiers
+from rate_limiter import limiter_from_env
+from run_metrics import DEFAULT_METRICS_LOG_PATH, SessionMetrics, append_metrics_log, document_metrics
+from supplier_index import SupplierIndex
 
 load_dotenv()
-genai.configure(api_key=os.environ['GEMINI_API_KEY'])
-model = genai.GenerativeModel(model_name='gemini-2.5-flash')
 
-# Keep track of temporary files to clean up at exit
-temp_files = []
+_backend = None
 
-def cleanup_temp_files():
-    """Clean up any remaining temporary files when the program exits"""
-    for file_path in temp_files:
-        try:
-            if os.path.exists(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f"Warning: Could not delete temporary file {file_path}: {e}")
+# Default of process_pdf_to_json's cache, templates and suppliers: the process-wide one from the getters below
+_SHARED = object()
 
-# Register the cleanup function to run at exit
-atexit.register(cleanup_temp_files)
+@functools.lru_cache(maxsize=None)
+def get_rate_limiter():
+    """
+    The limiter every Gemini request of this process waits in for RPM, TPM
+    and in-flight quota; set GEMINI_LIMITER_DB to share the quota with
+    other processes
+    """
+    return limiter_from_env()
+
+@functools.lru_cache(maxsize=None)
+def get_extraction_cache():
+    """Parsed pages cached on disk, so re-running the same invoice costs no API calls"""
+    return ExtractionCache()
+
+@functools.lru_cache(maxsize=None)
+def get_template_index():
+    """Column layouts learned per supplier, replayed on later invoices without Gemini"""
+    return TemplateIndex()
 
-def process_pdf_to_json(pdf_path, system_prompt,pages):
+@functools.lru_cache(maxsize=None)
+def get_supplier_index():
+    """Letterhead fingerprints used to route each invoice to the right extractor"""
+    return SupplierIndex()
+
+def initialize_backend(name=None):
+    """
+    Creates the extraction backend named by EXTRACTION_BACKEND: "gemini"
+    (the default) or "fake" for offline runs with FakeGeminiBackend.
+
+    The Gemini backend carries the extraction prompt as its system
+    instruction (served from a context cache where possible). Transient
+    errors are retried with backoff outside the rate limiter, so every
+    attempt waits for quota again. Pages go to the light model first and
+    only those failing the schema or arithmetic checks are sent to the stronger one.
     """
-    Processes a PDF file page by page and extracts invoice line items to JSON.
+    name = name or os.environ.get("EXTRACTION_BACKEND", BACKEND_GEMINI)
+    if name == BACKEND_FAKE:
+        return FakeGeminiBackend(latency=0.5, latency_jitter=0.5)
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY is not set; add it to .env or set EXTRACTION_BACKEND=fake")
+    return create_gemini_backend(api_key, get_rate_limiter())
+
+def get_backend():
+    """The process-wide backend, created on first use so importing this module needs no API key"""
+    global _backend
+    if _backend is None:
+        _backend = initialize_backend()
+    return _backend
+
+# Requests in flight, tuned from observed latency and 429s
+concurrency_controller = AdaptiveConcurrency()
+
+# Duplicates requests for pages slower than the observed p90, within a budget
+hedge_policy = HedgePolicy()
+
+# Gemini pages whose amounts do not add up are re-requested once
+arithmetic_recheck = ArithmeticRecheck()
+
+# Token, latency and cost totals over every document this process handles
+session_metrics = SessionMetrics()
+
+def process_pdf_to_json(pdf_path, system_prompt,pages, render_settings=DEFAULT_RENDER_SETTINGS,
+                        max_concurrency=DEFAULT_MAX_CONCURRENCY, cache=_SHARED,
+                        use_text_layer=True, llm_input=INPUT_TEXT, templates=_SHARED,
+                        suppliers=_SHARED, skip_pages=True, batch_pages=DEFAULT_BATCH_PAGES,
+                        concurrency=concurrency_controller, metrics_log=DEFAULT_METRICS_LOG_PATH, backend=None,
+                        hedging=hedge_policy, recheck=arithmetic_recheck):
+    """
+    Processes a PDF file and extracts invoice line items to JSON.
+    Pages are sent to Gemini concurrently and reassembled in page order.
     
     Args:
         pdf_path: Path to the PDF file
         system_prompt: Detailed system prompt for Gemini with extraction instructions
+        pages: Number of pages to process
+        render_settings: RenderSettings used to rasterize each page
+        max_concurrency: Maximum number of pages in flight at once
+        cache: ExtractionCache consulted before calling Gemini, or None to
+            disable; defaults to get_extraction_cache()
+        use_text_layer: Parse digitally generated pages from their text layer without Gemini
+        llm_input: "text" sends Gemini the layout text of pages that have a text layer,
+            "image" always sends the rendered page
+        templates: TemplateIndex of supplier layout templates, or None to
+            disable; defaults to get_template_index()
+        suppliers: SupplierIndex used to identify the supplier first, or None
+            to disable; defaults to get_supplier_index()
+        skip_pages: Skip pages the local classifier finds cannot hold line items
+        batch_pages: Number of pages packed into each Gemini request
+        concurrency: AdaptiveConcurrency that tunes the requests in flight,
+            or None for the fixed max_concurrency
+        metrics_log: JSONL file the document's metrics are appended to, or None
+        backend: ExtractionBackend (or ModelCascade of them) to extract with,
+            defaults to get_backend()
+        hedging: HedgePolicy that duplicates requests for slow pages, or None to disable
+        recheck: ArithmeticRecheck that re-requests pages whose amounts do not add up,
+            with its tolerances, or None to disable
         
     Returns:
-        Combined JSON with all invoice line items
+        Combined JSON with all invoice line items, and under "Metrics" the
+        per-page and per-document token, latency and cost figures
     """
-    all_line_items = []
+    start_time = time.perf_counter()
+    if backend is None:
+        backend = get_backend()
+    if cache is _SHARED:
+        cache = get_extraction_cache()
+    if templates is _SHARED:
+        templates = get_template_index()
+    if suppliers is _SHARED:
+        suppliers = get_supplier_index()
     
     # Open PDF file
     try:
         pdf_document = fitz.open(pdf_path)
         
-        # Process each page
-        for page_num in range(pages):
-            # Render page to image
-            page = pdf_document.load_page(page_num)
-            pix = page.get_pixmap(alpha=False)
-            
-            # Create a temporary file
-            temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-            temp_path = temp_file.name
-            temp_files.append(temp_path)  # Add to tracking list
-            temp_file.close()  # Close the file handle immediately
-            
-            # Save the pixmap to the temp file
-            pix.save(temp_path)
-            
-            try:
-                # Open, process and explicitly close the image
-                with Image.open(temp_path) as img:
-                    # Convert image to bytes
-                    img_bytes = io.BytesIO()
-                    img.save(img_bytes, format="JPEG")
-                    img_bytes = img_bytes.getvalue()
-                
-                # Process with Gemini
-                content = [
-                    {"role": "user", "parts": [{"text": system_prompt}]},
-                    {"role": "user", "parts": [
-                        {"inline_data": {"mime_type": "image/jpeg", "data": img_bytes}},
-                        {"text": "Extract all line items from this invoice page and format as specified."}
-                    ]}
-                ]
-                
-                response = model.generate_content(
-                    contents=content,
-                    generation_config=genai.types.GenerationConfig(
-                        response_mime_type="application/json"
-                    )
-                )
-                
-                # Parse the JSON response
-                page_data = json.loads(response.text)
-                
-                # Add line items to combined data
-                if "LineItems" in page_data and isinstance(page_data["LineItems"], list):
-                    all_line_items.extend(page_data["LineItems"])
-                
-            except Exception as e:
-                print(f"Error processing page {page_num + 1}: {e}")
-                print(f"Response text: {response.text if 'response' in locals() else 'No response'}")
-            
-            # Don't try to delete the file here, it will be cleaned up at exit
-                
+        # Identify the supplier before any other work to pick the extraction strategy
+        supplier = suppliers.identify(pdf_document.load_page(0)) if suppliers is not None and pages else None
+        if supplier:
+            print(f"Supplier: {supplier.name or supplier.supplier_id[:12]} ({'new, ' if supplier.is_new else ''}"
+                  f"strategy {supplier.strategy})")
+        
+        def report_progress(completed, total):
+            if concurrency is not None:
+                print(f"Processed {completed} of {total} pages ({describe(concurrency.snapshot())})")
+            else:
+                print(f"Processed {completed} of {total} pages")
+        
+        results = extract_document(backend, pdf_document, system_prompt, pages,
+                                   render_settings, max_concurrency, report_progress, cache,
+                                   use_text_layer, llm_input, templates, supplier, skip_pages,
+                                   batch_pages, concurrency=concurrency, hedging=hedging, recheck=recheck)
+        
+        for result in results:
+            if result.usage:
+                print(f"Page {result.page_index + 1}: {result.usage['prompt_tokens']} prompt tokens "
+                      f"({result.usage['cached_tokens']} cached), {result.usage['candidates_tokens']} output tokens")
+            if result.escalations:
+                # attempts then also counts the weaker models' requests, so it is not a retry count
+                print(f"Page {result.page_index + 1}: escalated to {result.tier} after {result.escalations} "
+                      f"weaker model answer{'s' if result.escalations > 1 else ''} failed the checks")
+            elif result.attempts > 1:
+                print(f"Page {result.page_index + 1}: succeeded after {result.attempts} attempts")
+            if result.strips:
+                print(f"Page {result.page_index + 1}: answer cut off at the output limit, re-extracted "
+                      f"as {result.strips} strips")
+            if result.rechecks:
+                print(f"Page {result.page_index + 1}: amounts did not add up, re-requested "
+                      f"({'new answer kept' if result.recheck_kept else 'no better, first answer kept'})")
+            if result.skip_reason:
+                print(f"Skipped page {result.page_index + 1}: {result.skip_reason}")
+            if result.error:
+                print(f"Error processing page {result.page_index + 1}: {result.error}")
+                print(f"Response text: {result.response_text or 'No response'}")
+        
+        paths = count_page_paths(results)
+        print("Pages by extraction path: " + ", ".join(f"{path}={count}" for path, count in sorted(paths.items())))
+        tiers = count_resolving_tiers(results)
+        if tiers:
+            print("Gemini pages by resolving model: " + ", ".join(f"{tier}={count}" for tier, count in tiers.items()))
+        for mode, usage in summarize_token_usage(results).items():
+            print(f"Gemini {mode} input: {usage['pages']} pages, {usage['prompt_tokens']} prompt tokens "
+                  f"({usage['cached_tokens']} cached), {usage['candidates_tokens']} output tokens")
+        
+        if cache is not None:
+            stats = cache.stats()
+            print(f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+        
+        stats = get_rate_limiter().stats()
+        print(f"Rate limiter: {stats['requests']} requests, {stats['mean_wait']:.2f}s mean "
+              f"and {stats['max_wait']:.2f}s max queue wait")
+        
+        metrics = document_metrics(os.path.basename(pdf_path), results, time.perf_counter() - start_time)
+        session_metrics.add(metrics)
+        if metrics_log:
+            append_metrics_log(metrics, metrics_log)
+        session = session_metrics.summary()
+        print(f"Document: {metrics['total_tokens']} tokens, ${metrics['cost_usd']:.4f}, {metrics['wall_time_s']:.1f}s "
+              f"({metrics['gemini_latency_s']:.1f}s in Gemini calls, {metrics['payload_bytes'] / 1024:.0f} KiB sent)")
+        if metrics["hedges"]:
+            print(f"Hedged {metrics['hedges']} slow pages, the duplicate answered first on {metrics['hedge_wins']}")
+        print(f"Session: {session['documents']} documents, {session['total_tokens']} tokens, ${session['cost_usd']:.4f}")
+        
         # Create final combined structure
-        combined_data = {"LineItems": all_line_items}
-        return combined_data
+        combined = combine_page_results(results)
+        combined["Metrics"] = metrics
+        return combined
     
     except Exception as e:
         print(f"Error opening PDF: {e}")
@@ -109,90 +222,18 @@ def process_pdf_to_json(pdf_path, system_prompt,pages):
         if 'pdf_document' in locals():
             pdf_document.close()
 
-def validate_line_items(line_items):
-    """
-    Validates and ensures all required fields are present in line items.
-    If fields are missing, adds them with empty string values.
-    """
-    required_fields = [
-        "Description of Goods", "HSN/SAC", "Batch No", "Mfg Date", "Expiry Date", 
-        "MRP", "QTY", "UOM", "Rate", "Discount%", "Discount Value", 
-        "Taxable Value", "IGST Rate", "IGST Amount", "Total"
-    ]
-    
-    for item in line_items:
-        for field in required_fields:
-            if field not in item:
-                item[field] = ""
-    
-    return line_items
-
 if __name__ == "__main__":
     pdf_file = "2925365390.pdf"
     
-    system_prompt = """
-    You are a precise and detail-oriented invoice data extraction assistant. Your task is to analyze the provided invoice and extract all line items into a structured JSON array. Each line item should be represented as an individual JSON object, and all specified fields should be included for every line item. If a field is missing or not identifiable for a specific line item, use an empty string ("") as its value.
-
-IMPORTANT DATE FORMAT RULE:
-All date fields (Mfg Date and Expiry Date) must be converted to the format **DD/MM/YYYY**, regardless of how they appear in the invoice.  
-Examples:
-- "2024-01-05" → "05/01/2024"
-- "05-01-24" → "05/01/2024"
-- "Jan 5 2024" → "05/01/2024"
-- "05.01.2024" → "05/01/2024"
-If a date cannot be determined or parsed with certainty, return an empty string ("").
-
-Fields to Extract for Each Line Item:
-- Description of Goods: Description of the items or services listed in the invoice.
-- HSN/SAC: Harmonized System of Nomenclature or Service Accounting Code.
-- Batch No: Batch number associated with the goods.
-- Mfg Date: Manufacturing date of the goods (convert to DD/MM/YYYY).
-- Expiry Date: Expiry date of the goods (convert to DD/MM/YYYY).
-- MRP: Maximum Retail Price of the item.
-- QTY: Quantity of the goods.
-- UOM: Unit of Measure for the quantity (e.g., pcs, kg, ltr).
-- Rate: Price per unit of the goods.
-- Discount%: Discount percentage applied.
-- Discount Value: Total discount value in currency.
-- Taxable Value: Total amount before taxes after applying discounts.
-- IGST Rate: Integrated GST rate applied.
-- IGST Amount: Total Integrated GST amount applied.
-- Total: Grand total amount for the line item, including all taxes.
-
-Output Format:
-The output should be a JSON object containing a key "LineItems", whose value is a list of JSON objects, one for each line item. Example:
-{
-    "LineItems": [
-        {
-            "Description of Goods": "Item 1 Description",
-            "HSN/SAC": "1234",
-            "Batch No": "B001",
-            "Mfg Date": "01/01/2024",
-            "Expiry Date": "01/01/2025",
-            "MRP": "500.00",
-            "QTY": "2",
-            "UOM": "pcs",
-            "Rate": "450.00",
-            "Discount%": "10",
-            "Discount Value": "90.00",
-            "Taxable Value": "810.00",
-            "IGST Rate": "18",
-            "IGST Amount": "145.80",
-            "Total": "955.80"
-        }
-    ]
-}
-
-Instructions:
-- Extract every line item in the invoice and structure it as described above.
-- Include all fields for each line item. If a field is not present, return an empty string ("").
-- Convert all date fields to **DD/MM/YYYY only**.
-- Ensure numerical fields retain precision.
-- Always return full structured JSON output.
-
-    """
+    system_prompt = load_system_prompt()
     
-    result = process_pdf_to_json(pdf_file, system_prompt,2)
+    backend = get_backend()
+    if isinstance(backend, FakeGeminiBackend):
+        # Fake answers must never reach the extraction cache, the supplier templates or the supplier index
+        result = process_pdf_to_json(pdf_file, system_prompt, 2, cache=None, templates=None, suppliers=None,
+                                     backend=backend)
+    else:
+        result = process_pdf_to_json(pdf_file, system_prompt,2, backend=backend)
     
     if result and "LineItems" in result:
         # Validate and ensure all fields are present
@@ -202,6 +243,3 @@ Instructions:
         with open("invoice_line_items.json", "w") as f:
             json.dump(result,f, indent=2)
         print(f"Successfully extracted {len(result['LineItems'])} line items to invoice_line_items.json")
-    
-    # Final cleanup attempt for any remaining temp files
-    cleanup_temp_files()
@@ -0,0 +1,155 @@
+import datetime
+import functools
+import hashlib
+import os
+import re
+import threading
+import google.generativeai as genai
+from google.generativeai import caching
+
+MODEL_NAME = "gemini-2.5-flash"
+
+# Cheaper, faster model tried first; pages it gets wrong are escalated to MODEL_NAME
+LIGHT_MODEL_NAME = "gemini-2.5-flash-lite"
+CASCADE_MODEL_NAMES = (LIGHT_MODEL_NAME, MODEL_NAME)
+
+# Bump when the prompt changes; each version lives in prompts/line_items_<version>.txt
+PROMPT_VERSION = "v2"
+PROMPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# How long a context cache lives. get_context_cache sets it when the cache is created or found, and
+# ContextCachedModel extends it once less than CONTEXT_CACHE_REFRESH is left
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=6)
+CONTEXT_CACHE_REFRESH = datetime.timedelta(hours=1)
+
+# What the API says when a request names a cache it no longer has, usually as a 403 or 404
+_CACHE_NOT_FOUND = re.compile(r"cached\s*content", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=None)
+def load_system_prompt(version=PROMPT_VERSION):
+    """Reads the extraction prompt for a prompt version, once per process"""
+    with open(os.path.join(PROMPT_DIR, f"line_items_{version}.txt"), "r", encoding="utf-8") as f:
+        return f.read()
+
+def _cache_display_name(model_name, system_prompt):
+    # The prompt hash in the name means an edited prompt never reuses a stale cache
+    digest = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()[:12]
+    return f"invoice-line-items-{model_name}-{digest}"
+
+def get_context_cache(model_name, system_prompt, ttl=CONTEXT_CACHE_TTL):
+    """
+    Returns a Gemini context cache holding the system prompt, reusing one
+    created by an earlier session or process when it still exists.
+
+    Returns:
+        caching.CachedContent, or None when the model or prompt cannot be
+        cached (caching needs a minimum prompt size and a supported model).
+        prompts/line_items_v2.txt is about 450 tokens, below the minimum the
+        API accepts for explicit caching (1,024 tokens or more depending on
+        the model), so for now create fails and models run on
+        system_instruction alone.
+    """
+    display_name = _cache_display_name(model_name, system_prompt)
+    try:
+        for cached_content in caching.CachedContent.list():
+            if cached_content.display_name == display_name and cached_content.model == f"models/{model_name}":
+                cached_content.update(ttl=ttl)
+                return cached_content
+        return caching.CachedContent.create(
+            model=f"models/{model_name}",
+            display_name=display_name,
+            system_instruction=system_prompt,
+            ttl=ttl,
+        )
+    except Exception as e:
+        print(f"Context caching unavailable, using system_instruction only: {e}")
+        return None
+
+def _is_cache_not_found(error):
+    return getattr(error, "code", None) in (403, 404) and bool(_CACHE_NOT_FOUND.search(str(error)))
+
+class ContextCachedModel:
+    """
+    A genai.GenerativeModel served from a context cache, kept usable for
+    the life of the process: the cache's TTL is extended once less than
+    refresh is left, and when the API no longer has the cache (expired or
+    deleted elsewhere) the cache and model are rebuilt and the request is
+    sent once more. A cache that cannot be rebuilt falls back to the plain
+    system_instruction model. Everything else is the current model's.
+    """
+
+    def __init__(self, model_name, system_prompt, cached_content, ttl=CONTEXT_CACHE_TTL,
+                 refresh=CONTEXT_CACHE_REFRESH, now=lambda: datetime.datetime.now(datetime.timezone.utc)):
+        self.system_prompt = system_prompt
+        self._model_name = model_name
+        self.ttl = ttl
+        self.refresh = refresh
+        self.now = now
+        self._lock = threading.Lock()
+        self._use(cached_content)
+
+    def _use(self, cached_content):
+        self.cached_content = cached_content
+        if cached_content is not None:
+            self.model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        else:
+            self.model = genai.GenerativeModel(model_name=self._model_name, system_instruction=self.system_prompt)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _refresh(self):
+        with self._lock:
+            cached_content = self.cached_content
+            if cached_content is None or cached_content.expire_time - self.now() > self.refresh:
+                return
+            try:
+                cached_content.update(ttl=self.ttl)
+            except Exception as e:
+                if not _is_cache_not_found(e):
+                    raise
+                self._use(get_context_cache(self._model_name, self.system_prompt, self.ttl))
+
+    def _rebuild(self, failed_model):
+        with self._lock:
+            # Another thread may have rebuilt it already
+            if self.model is failed_model:
+                self._use(get_context_cache(self._model_name, self.system_prompt, self.ttl))
+
+    def generate_content(self, contents, **kwargs):
+        self._refresh()
+        model = self.model
+        try:
+            return model.generate_content(contents=contents, **kwargs)
+        except Exception as e:
+            if not _is_cache_not_found(e):
+                raise
+            print(f"Context cache of {self._model_name} is gone, rebuilding it: {e}")
+            self._rebuild(model)
+            return self.model.generate_content(contents=contents, **kwargs)
+
+def create_model(model_name=MODEL_NAME, system_prompt=None, use_context_cache=True):
+    """
+    Creates the Gemini model with the extraction prompt as its system instruction,
+    served from a context cache where the API supports it.
+
+    The prompt is recorded on the model as model.system_prompt; the
+    extraction engine leaves it out of per-page requests for such models.
+
+    Args:
+        model_name: Gemini model name
+        system_prompt: Extraction prompt, defaults to the current prompt version
+        use_context_cache: Try to register the prompt as cached content
+
+    Returns:
+        ContextCachedModel when the prompt is cached, otherwise
+        genai.GenerativeModel
+    """
+    if system_prompt is None:
+        system_prompt = load_system_prompt()
+    cached_content = get_context_cache(model_name, system_prompt) if use_context_cache else None
+    if cached_content is not None:
+        return ContextCachedModel(model_name, system_prompt, cached_content)
+    model = genai.GenerativeModel(model_name=model_name, system_instruction=system_prompt)
+    model.system_prompt = system_prompt
+    return model
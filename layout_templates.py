@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+import time
+from arithmetic_checks import DEFAULT_TOLERANCE, any_arithmetic_errors
+from line_items import LINE_ITEM_FIELDS, normalize_date, parse_amount
+from page_classifier import MIN_NUMBERS_PER_ROW, NUMBER_PATTERN
+from text_extractor import DATE_FIELDS, group_words_into_lines
+
+DEFAULT_TEMPLATE_PATH = "layout_templates.json"
+
+NUMERIC_FIELDS = {
+    "MRP", "QTY", "Rate", "Discount%", "Discount Value",
+    "Taxable Value", "IGST Rate", "IGST Amount", "Total"
+}
+
+# Fields are located most distinctive first, so values that repeat across
+# columns (0.00 discounts, tax rates) only compete for the columns left over
+MATCH_ORDER = [
+    "Batch No", "HSN/SAC", "Total", "Taxable Value", "IGST Amount", "Rate", "MRP", "QTY",
+    "Description of Goods", "Expiry Date", "Mfg Date", "UOM", "IGST Rate", "Discount Value", "Discount%"
+]
+
+# Columns a template must have to be able to recognise line item rows
+ANCHOR_FIELDS = ("Description of Goods", "QTY", "Total")
+
+# Word edges within this many points are treated as the same column alignment
+COLUMN_SNAP = 4.0
+
+# Share of line items a column has to be found in before it is trusted
+MIN_COLUMN_SUPPORT = 0.6
+
+def _word_matches(field, word_text, value):
+    """True when a page word is (the start of) a line item value"""
+    if field in NUMERIC_FIELDS:
+        word_amount = parse_amount(word_text)
+        return word_amount is not None and word_amount == parse_amount(value)
+    if field in DATE_FIELDS:
+        return word_text == value or normalize_date(word_text) == value
+    return word_text == value.split()[0]
+
+def _find_column(field, line_items, words, claimed):
+    """
+    Locates the words holding one field's values and returns their x-span,
+    or None when no alignment is shared by enough of the line items.
+    Values may be left or right aligned, so both edges are tried.
+    """
+    with_value = [index for index, item in enumerate(line_items) if (item.get(field) or "").strip()]
+    if not with_value:
+        return None
+
+    alignments = {}
+    for index in with_value:
+        value = line_items[index][field].strip()
+        for word in words:
+            if _word_matches(field, word[4], value):
+                for key in (("left", round(word[0] / COLUMN_SNAP)), ("right", round(word[2] / COLUMN_SNAP))):
+                    alignments.setdefault(key, {})[index] = word
+
+    ranked = sorted(alignments.values(), key=len, reverse=True)
+    for matched in ranked:
+        if len(matched) < MIN_COLUMN_SUPPORT * len(with_value):
+            break
+        x0 = min(word[0] for word in matched.values())
+        x1 = max(word[2] for word in matched.values())
+        if not any(x0 < other_x1 and other_x0 < x1 for other_x0, other_x1 in claimed):
+            return x0, x1
+    return None
+
+def derive_template(words, line_items, page_width):
+    """
+    Learns column boundaries from a page's words and the line items the model extracted from it.
+
+    Args:
+        words: page.get_text("words") of the page
+        line_items: Line items extracted from that page
+        page_width: Width of the page in points
+
+    Returns:
+        Template dict, or None when the columns could not be located reliably
+    """
+    if not line_items:
+        return None
+
+    spans = {}
+    for field in MATCH_ORDER:
+        span = _find_column(field, line_items, words, list(spans.values()))
+        if span:
+            spans[field] = span
+        elif sum(1 for item in line_items if (item.get(field) or "").strip()) >= MIN_COLUMN_SUPPORT * len(line_items):
+            # The model found this field on most rows, so a template without it would lose data
+            return None
+    if not all(field in spans for field in ANCHOR_FIELDS):
+        return None
+
+    # Fields with the same value on every row (typically all-zero discounts)
+    # cannot be told apart by matching, so keep them in the usual printed order
+    for position, first in enumerate(LINE_ITEM_FIELDS):
+        for second in LINE_ITEM_FIELDS[position + 1:]:
+            if (first in spans and second in spans and spans[first][0] > spans[second][0]
+                    and all(item.get(first) == item.get(second) for item in line_items)):
+                spans[first], spans[second] = spans[second], spans[first]
+
+    ordered = sorted(spans.items(), key=lambda entry: entry[1][0])
+    columns = []
+    for position, (field, (x0, x1)) in enumerate(ordered):
+        left = (ordered[position - 1][1][1] + x0) / 2 if position > 0 else 0
+        right = (x1 + ordered[position + 1][1][0]) / 2 if position + 1 < len(ordered) else page_width
+        columns.append({"field": field, "x0": round(left, 2), "x1": round(right, 2)})
+    return {"columns": columns, "page_width": page_width, "rows": len(line_items), "updated": time.time()}
+
+def _numbers_on_line(line_words):
+    return sum(1 for word in line_words if NUMBER_PATTERN.match(word[4]))
+
+def apply_template(template, words, page_width):
+    """
+    Parses line items from a page's words using a learned template.
+    A line is a row when it has a description, a numeric QTY and a numeric Total;
+    lines just below a row with text only in the description column continue it.
+
+    Returns:
+        List of line items, or None when no row was found
+    """
+    line_items, _ = _template_rows(template, words, page_width)
+    return line_items or None
+
+def _template_rows(template, words, page_width):
+    """
+    (line items, (unmatched, row_numbers)): the line items of
+    apply_template, how many numbers each line that was neither a row nor
+    a continuation holds, and how many each row's own line holds
+    """
+    scale = page_width / template["page_width"]
+    columns = [(column["field"], column["x0"] * scale, column["x1"] * scale) for column in template["columns"]]
+    lines = group_words_into_lines(words)
+    if not lines:
+        return [], ([], [])
+    heights = sorted(word[3] - word[1] for word in words)
+    max_continuation_gap = heights[len(heights) // 2] * 2.5
+
+    line_items = []
+    unmatched = []
+    last_row_y = None
+    for y_center, line_words in lines:
+        cells = {}
+        for word in line_words:
+            x_center = (word[0] + word[2]) / 2
+            for field, x0, x1 in columns:
+                if x0 <= x_center < x1:
+                    cells.setdefault(field, []).append(word[4])
+                    break
+        values = {field: " ".join(texts) for field, texts in cells.items()}
+
+        if (values.get("Description of Goods") and parse_amount(values.get("QTY")) is not None
+                and parse_amount(values.get("Total")) is not None):
+            item = {field: values.get(field, "") for field in LINE_ITEM_FIELDS}
+            for field in DATE_FIELDS:
+                item[field] = normalize_date(item[field])
+            item["_numbers"] = _numbers_on_line(line_words)
+            line_items.append(item)
+            last_row_y = y_center
+        elif (line_items and set(values) == {"Description of Goods"}
+                and y_center - last_row_y <= max_continuation_gap):
+            line_items[-1]["Description of Goods"] += "\n" + values["Description of Goods"]
+            last_row_y = y_center
+        else:
+            unmatched.append(_numbers_on_line(line_words))
+
+    row_numbers = [item.pop("_numbers") for item in line_items]
+    return line_items, (unmatched, row_numbers)
+
+def learn_template(words, line_items, page_width, tolerance=DEFAULT_TOLERANCE):
+    """
+    Derives a template and keeps it only if replaying it on the same page
+    reproduces every row and the rows pass the arithmetic checks within
+    tolerance, an ArithmeticTolerance. The template remembers how many
+    numbers its sparsest row had, see extract_template_line_items.
+    """
+    if any_arithmetic_errors(line_items, tolerance):
+        return None
+    template = derive_template(words, line_items, page_width)
+    if template is None:
+        return None
+    replayed, (_, row_numbers) = _template_rows(template, words, page_width)
+    if not replayed or len(replayed) != len(line_items):
+        return None
+    if any_arithmetic_errors(replayed, tolerance):
+        return None
+    template["min_row_numbers"] = min(row_numbers)
+    return template
+
+def extract_template_line_items(template, words, page_width, tolerance=DEFAULT_TOLERANCE):
+    """
+    Replays a template and returns its line items only if they all pass the
+    arithmetic checks within tolerance and none look missing: a line the template did not
+    read as a row but with as many numbers as a line item row (as many as
+    the sparsest row seen, and at least the page classifier's
+    MIN_NUMBERS_PER_ROW) is a row whose QTY or Total fell outside the
+    learned columns, so the page goes to the model instead.
+    """
+    line_items, (unmatched, row_numbers) = _template_rows(template, words, page_width)
+    if not line_items or any_arithmetic_errors(line_items, tolerance):
+        return None
+    min_row_numbers = max(MIN_NUMBERS_PER_ROW, min(row_numbers + [template.get("min_row_numbers", min(row_numbers))]))
+    if any(numbers >= min_row_numbers for numbers in unmatched):
+        return None
+    return line_items
+
+class TemplateIndex:
+    """
+    Per-supplier layout templates keyed by supplier fingerprint, stored as a JSON file.
+    """
+
+    def __init__(self, path=DEFAULT_TEMPLATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._templates = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._templates = json.load(f)
+
+    def get(self, fingerprint):
+        with self._lock:
+            return self._templates.get(fingerprint)
+
+    def put(self, fingerprint, template):
+        with self._lock:
+            self._templates[fingerprint] = template
+            self._save()
+
+    def remove(self, fingerprint):
+        with self._lock:
+            if self._templates.pop(fingerprint, None) is not None:
+                self._save()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._templates)
+
+    def _save(self):
+        # Write to a temp file first so a crash never leaves a half written index
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self._templates, f, indent=2)
+        os.replace(temp_path, self.path)
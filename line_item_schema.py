@@ -0,0 +1,87 @@
+import json
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+class LineItem(BaseModel):
+    """
+    One invoice line item; every field is a string exactly as extracted, "" when absent.
+    The aliases are line_items.LINE_ITEM_FIELDS, in the same order.
+    """
+    # Models sometimes answer numbers as JSON numbers or null, read them as strings
+    model_config = ConfigDict(populate_by_name=True, coerce_numbers_to_str=True, extra="ignore")
+
+    description_of_goods: str = Field("", alias="Description of Goods")
+    hsn_sac: str = Field("", alias="HSN/SAC")
+    batch_no: str = Field("", alias="Batch No")
+    mfg_date: str = Field("", alias="Mfg Date")
+    expiry_date: str = Field("", alias="Expiry Date")
+    mrp: str = Field("", alias="MRP")
+    qty: str = Field("", alias="QTY")
+    uom: str = Field("", alias="UOM")
+    rate: str = Field("", alias="Rate")
+    discount_percent: str = Field("", alias="Discount%")
+    discount_value: str = Field("", alias="Discount Value")
+    taxable_value: str = Field("", alias="Taxable Value")
+    igst_rate: str = Field("", alias="IGST Rate")
+    igst_amount: str = Field("", alias="IGST Amount")
+    total: str = Field("", alias="Total")
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def _none_to_empty(cls, value):
+        return "" if value is None else value
+
+class LineItemsResponse(BaseModel):
+    """Answer to a single page request"""
+    LineItems: list[LineItem] = []
+
+class PageLineItems(BaseModel):
+    """One page of the answer to a batched request"""
+    Page: int
+    LineItems: list[LineItem] = []
+
+class BatchLineItemsResponse(BaseModel):
+    """Answer to a request carrying several pages"""
+    Pages: list[PageLineItems] = []
+
+def _gemini_schema(json_schema, definitions):
+    """Converts a pydantic JSON schema into the OpenAPI subset Gemini accepts as response_schema"""
+    if "$ref" in json_schema:
+        json_schema = definitions[json_schema["$ref"].rsplit("/", 1)[-1]]
+    schema_type = json_schema["type"]
+    schema = {"type": schema_type.upper()}
+    if schema_type == "object":
+        schema["properties"] = {name: _gemini_schema(value, definitions)
+                                for name, value in json_schema["properties"].items()}
+        # Every property is required from the model even where parsing has a default
+        schema["required"] = list(json_schema["properties"])
+    elif schema_type == "array":
+        schema["items"] = _gemini_schema(json_schema["items"], definitions)
+    return schema
+
+def response_schema(model_class):
+    """Gemini response_schema dict for a pydantic model, JSON serializable for the Batch API"""
+    json_schema = model_class.model_json_schema(by_alias=True)
+    return _gemini_schema(json_schema, json_schema.get("$defs", {}))
+
+LINE_ITEMS_SCHEMA = response_schema(LineItemsResponse)
+BATCH_LINE_ITEMS_SCHEMA = response_schema(BatchLineItemsResponse)
+
+# The pydantic model each response schema was built from
+_RESPONSE_MODELS = ((LINE_ITEMS_SCHEMA, LineItemsResponse), (BATCH_LINE_ITEMS_SCHEMA, BatchLineItemsResponse))
+
+def validate_response(schema, text):
+    """
+    Checks a JSON answer against the pydantic model its response_schema was
+    built from, or only that it parses for other schemas; a RetryingModel validate.
+
+    Raises:
+        pydantic.ValidationError or json.JSONDecodeError
+    """
+    for known_schema, model_class in _RESPONSE_MODELS:
+        if schema == known_schema:
+            model_class.model_validate_json(text)
+            return
+    json.loads(text)
+
+def to_line_item_dicts(line_items):
+    return [line_item.model_dump(by_alias=True) for line_item in line_items]
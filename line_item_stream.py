@@ -0,0 +1,54 @@
+from pydantic import ValidationError
+from line_item_schema import LineItem
+
+# Nesting level of a line item object in {"LineItems": [{...}, ...]}, counting braces and brackets
+LINE_ITEM_DEPTH = 3
+
+class LineItemStreamParser:
+    """
+    Incremental parser for a streamed {"LineItems": [...]} response.
+    feed() takes text chunks as they arrive and returns the line items whose
+    closing brace has arrived, validated like parse_line_items. Items that
+    fail validation are left out; the full response parsed at the end stays
+    the authoritative result.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._item = None
+        self.text = []
+
+    def feed(self, chunk):
+        self.text.append(chunk)
+        line_items = []
+        for char in chunk:
+            if self._item is not None:
+                self._item.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if char == "{" and self._depth == LINE_ITEM_DEPTH:
+                    self._item = [char]
+            elif char in "}]":
+                if char == "}" and self._depth == LINE_ITEM_DEPTH and self._item is not None:
+                    try:
+                        line_items.append(LineItem.model_validate_json("".join(self._item)).model_dump(by_alias=True))
+                    except ValidationError:
+                        pass
+                    self._item = None
+                self._depth -= 1
+        return line_items
+
+    def full_text(self):
+        """Everything fed so far"""
+        return "".join(self.text)
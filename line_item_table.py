@@ -0,0 +1,124 @@
+from itertools import chain
+import numpy as np
+import pandas as pd
+
+# Marks a cell whose item did not have the field at all
+MISSING = -1
+
+class LineItemTable:
+    """
+    Line items stored column by column instead of as a list of dicts.
+
+    Every column is dictionary encoded: an int32 code per row indexing the
+    column's distinct values, so a repeated UOM, HSN/SAC, rate or date is
+    stored once however many rows carry it. Values are kept exactly as
+    extracted, and numbers() parses a column to a float64 array once per
+    distinct value. Code MISSING marks a row whose item lacked the field.
+    """
+
+    def __init__(self, fields=(), codes=None, categories=None, length=0):
+        self.fields = list(fields)
+        self._codes = dict(codes or {})
+        self._categories = dict(categories or {})
+        self._length = length
+        self._numbers = {}
+
+    @classmethod
+    def from_line_items(cls, line_items):
+        """Builds a table from a list of line item dicts; fields are ordered by first appearance"""
+        layouts = dict.fromkeys(map(tuple, line_items))
+        fields = list(dict.fromkeys(chain.from_iterable(layouts)))
+        table = cls(length=len(line_items))
+        complete = len(layouts) == 1
+        for field in fields:
+            if complete:
+                values = [item[field] for item in line_items]
+            else:
+                values = [item.get(field, _ABSENT) for item in line_items]
+            table._set_encoded(field, *_encode(values))
+        return table
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, field):
+        return field in self._codes
+
+    def _set_encoded(self, field, codes, categories):
+        if field not in self._codes:
+            self.fields.append(field)
+        self._codes[field] = codes
+        self._categories[field] = categories
+        self._numbers.pop(field, None)
+
+    def encoded(self, field):
+        """(codes, distinct values) of a column; codes are MISSING where the field is absent"""
+        return self._codes[field], self._categories[field]
+
+    def numbers(self, field, parse):
+        """
+        float64 array of the column parsed by parse(value) -> float or None,
+        NaN for None and absent cells. parse runs once per distinct value and
+        the result is kept until the column changes.
+        """
+        parsed_columns = self._numbers.setdefault(field, {})
+        if parse not in parsed_columns:
+            codes, categories = self.encoded(field)
+            parsed = [parse(value) for value in categories.tolist()] + [None]
+            parsed_columns[parse] = np.array([np.nan if value is None else value for value in parsed],
+                                             dtype=np.float64)[codes]
+        return parsed_columns[parse]
+
+    def set_column(self, field, values, after=None):
+        """
+        Sets a column from a sequence of values, one per row. A new column is
+        placed right after the field after, or at the end; an existing one
+        keeps its place.
+        """
+        is_new = field not in self._codes
+        self._set_encoded(field, *_encode(values))
+        if is_new and after in self._codes:
+            self.fields.remove(field)
+            self.fields.insert(self.fields.index(after) + 1, field)
+
+    def fill_missing(self, field, value):
+        """Gives every row without the field the given value, adding the column if needed"""
+        if field not in self._codes:
+            self._set_encoded(field, np.zeros(self._length, dtype=np.int32), np.array([value], dtype=object))
+            return
+        codes, categories = self.encoded(field)
+        if (codes == MISSING).any():
+            self._set_encoded(field, np.where(codes == MISSING, len(categories), codes).astype(np.int32),
+                              np.append(categories, np.array([value], dtype=object)))
+
+    def to_frame(self):
+        """The table as a DataFrame of categorical columns, NaN where a field is absent"""
+        return pd.DataFrame({field: _frame_column(*self.encoded(field)) for field in self.fields},
+                            index=pd.RangeIndex(self._length))
+
+def _frame_column(codes, categories):
+    if pd.isna(categories).any():
+        # Categories cannot hold null values, fall back to a plain column
+        return pd.Series(np.append(categories, None)[codes], dtype=object)
+    return pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+
+# Placeholder for an absent field while encoding, never stored in a table
+_ABSENT = object()
+
+def _encode(values):
+    """(int32 codes, object array of distinct values) of a sequence, _ABSENT encoded as MISSING"""
+    codes, categories = pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False)
+    categories = np.asarray(categories, dtype=object)
+    absent = [index for index, value in enumerate(categories) if value is _ABSENT]
+    codes = codes.astype(np.int32)
+    if absent:
+        codes[codes == absent[0]] = MISSING
+        codes[codes > absent[0]] -= 1
+        categories = np.delete(categories, absent[0])
+    return codes, categories
+
+def as_line_item_table(line_items):
+    """line_items as a LineItemTable, converting a list of dicts"""
+    if isinstance(line_items, LineItemTable):
+        return line_items
+    return LineItemTable.from_line_items(line_items)
@@ -0,0 +1,65 @@
+import re
+from datetime import datetime
+from line_item_table import LineItemTable
+
+# The 15 fields every extracted line item carries, in output order
+LINE_ITEM_FIELDS = [
+    "Description of Goods", "HSN/SAC", "Batch No", "Mfg Date", "Expiry Date",
+    "MRP", "QTY", "UOM", "Rate", "Discount%", "Discount Value",
+    "Taxable Value", "IGST Rate", "IGST Amount", "Total"
+]
+
+DATE_FORMATS = [
+    "%d/%m/%Y", "%d.%m.%Y", "%d-%m-%Y", "%Y-%m-%d", "%d/%m/%y", "%d.%m.%y", "%d-%m-%y",
+    "%b %d %Y", "%d %b %Y", "%d-%b-%Y", "%d-%b-%y", "%b-%Y", "%b-%y", "%m/%Y", "%m/%y",
+]
+
+def validate_line_items(line_items):
+    """
+    Validates and ensures all required fields are present in line items.
+    If fields are missing, adds them with empty string values.
+    line_items may be a list of dicts or a LineItemTable.
+    """
+    if isinstance(line_items, LineItemTable):
+        for field in LINE_ITEM_FIELDS:
+            line_items.fill_missing(field, "")
+        return line_items
+
+    for item in line_items:
+        for field in LINE_ITEM_FIELDS:
+            if field not in item:
+                item[field] = ""
+
+    return line_items
+
+def parse_amount(value):
+    """
+    Parses an invoice number such as "11,820.57", "12%" or "Rs. 90" to float.
+    Returns None for empty or unparseable values.
+    """
+    if value is None:
+        return None
+    cleaned = re.sub(r"[^0-9.\-]", "", str(value))
+    if cleaned in ("", "-", ".", "-."):
+        return None
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+def normalize_date(value):
+    """
+    Converts an invoice date to DD/MM/YYYY, the format the extraction prompt asks for.
+    Month-only dates such as "Dec-2027" become the first of the month.
+    Returns "" when the date cannot be parsed with certainty.
+    """
+    value = re.sub(r"\s+", " ", (value or "").replace(",", " ")).strip()
+    if not value:
+        return ""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime("%d/%m/%Y")
+        except ValueError:
+            continue
+    return ""
+
@@ -0,0 +1,45 @@
+from dataclasses import dataclass
+from arithmetic_checks import DEFAULT_TOLERANCE, ArithmeticTolerance, failing_pages
+
+@dataclass
+class ModelCascade:
+    """
+    Models tried in order, cheapest first. A page is re-sent to the next
+    tier when the answer failed, or did not pass the checks below; the last
+    tier's answer is always kept.
+
+    Attributes:
+        tiers: Models, each with model_name and system_prompt like create_model's
+        max_failing_fraction: Share of a page's line items allowed to fail the
+            arithmetic checks before the page is escalated
+        escalate_empty: Escalate pages the model found no line items on;
+            only pages the classifier kept get this far, so empty is suspicious
+        tolerance: ArithmeticTolerance of the arithmetic checks
+    """
+    tiers: list
+    max_failing_fraction: float = 0.0
+    escalate_empty: bool = True
+    tolerance: ArithmeticTolerance = DEFAULT_TOLERANCE
+
+    @property
+    def model_name(self):
+        """Names every tier, so cached answers are only reused by the same cascade"""
+        return ">".join(tier.model_name for tier in self.tiers)
+
+    @property
+    def system_prompt(self):
+        return getattr(self.tiers[0], "system_prompt", None)
+
+    def escalations(self, results):
+        """Page indices of the PageResults from a lower tier that should be retried on the next one"""
+        escalated = {result.page_index for result in results
+                     if result.error or (not result.line_items and self.escalate_empty)}
+        return escalated | failing_pages(results, self.tolerance, self.max_failing_fraction)
+
+def count_resolving_tiers(results):
+    """Returns how many Gemini pages each model tier resolved, e.g. {"gemini-2.5-flash-lite": 7}"""
+    counts = {}
+    for result in results:
+        if result.tier:
+            counts[result.tier] = counts.get(result.tier, 0) + 1
+    return counts
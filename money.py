@@ -0,0 +1,96 @@
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+import numpy as np
+import pandas as pd
+
+# Amounts are held as int64 counts of 1/10000 rupee, so a rate printed with
+# up to four decimals is exact; derived prices come out as whole paise
+AMOUNT_SCALE = 10_000
+PAISE_PER_RUPEE = 100
+
+# Magnitudes past which intermediate products are computed with Python ints instead of int64
+_INT64_HEADROOM = 2 ** 62
+
+# Below this many units floats are exact enough: a product that comes out whole is within a quarter
+# unit of the exact one, so it is the half-up rounding too, and units / 100 still prints back exactly
+_EXACT_FLOAT_UNITS = 2 ** 50
+
+def parse_scaled(value):
+    """
+    Parses an invoice amount such as "1,234.50" to an int count of
+    1/AMOUNT_SCALE rupee, rounding further decimals half-up; an empty
+    value is 0. Accepts what float() accepts once commas are removed.
+
+    Raises:
+        ValueError when the value is not a finite number
+    """
+    if not value:
+        return 0
+    cleaned = value.replace(",", "")
+    # float() decides what parses, so errors read as they always have
+    approximate = float(cleaned) * AMOUNT_SCALE
+    # Amounts with at most four decimals almost always land on a whole number here, skipping Decimal
+    if approximate.is_integer() and abs(approximate) < _EXACT_FLOAT_UNITS:
+        return int(approximate)
+    try:
+        scaled = (Decimal(cleaned) * AMOUNT_SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        scaled = None
+    if scaled is None or not scaled.is_finite() or abs(scaled) >= _INT64_HEADROOM:
+        raise ValueError(f"could not convert string to an exact amount: {value!r}")
+    return int(scaled)
+
+def parse_scaled_encoded(codes, uniques):
+    """
+    Parses a dictionary encoded column with parse_scaled, once per distinct value.
+
+    Returns:
+        (amounts, errors): int64 array, 0 where parsing failed, and the error
+        message of each failed value (None elsewhere) as an object array
+    """
+    parsed = []
+    errors = np.full(len(uniques), None, dtype=object)
+    for index, value in enumerate(uniques):
+        try:
+            parsed.append(parse_scaled(value))
+        except (ValueError, TypeError) as e:
+            parsed.append(0)
+            errors[index] = str(e)
+    return np.array(parsed, dtype=np.int64)[codes], errors[codes]
+
+def parse_scaled_column(values):
+    """parse_scaled_encoded of a sequence of values"""
+    return parse_scaled_encoded(*pd.factorize(np.asarray(values, dtype=object), use_na_sentinel=False))
+
+def half_up_divide(numerator, multiplier, divisor):
+    """
+    numerator * multiplier / divisor rounded half-up (away from zero) to an
+    integer, exactly, for int64 arrays. divisor must be positive. Rows
+    whose product could overflow int64 are computed with Python ints.
+    """
+    numerator = np.asarray(numerator, dtype=np.int64)
+    divisor = np.broadcast_to(np.asarray(divisor, dtype=np.int64), numerator.shape)
+    safe = np.abs(numerator) <= (_INT64_HEADROOM - divisor) // (2 * multiplier)
+    product = np.where(safe, numerator, 0) * multiplier
+    magnitude = (2 * np.abs(product) + divisor) // (2 * divisor)
+    result = np.where(product < 0, -magnitude, magnitude)
+    for index in np.flatnonzero(~safe):
+        result[index] = half_up_int(int(numerator[index]) * multiplier, int(divisor[index]))
+    return result
+
+def half_up_int(numerator, divisor):
+    """numerator / divisor rounded half-up (away from zero), for Python ints; divisor must be positive"""
+    rounded = (2 * abs(numerator) + divisor) // (2 * divisor)
+    return -rounded if numerator < 0 else rounded
+
+def format_paise_int(paise):
+    """format_paise of a single int"""
+    return "%d.%02d" % divmod(paise, PAISE_PER_RUPEE) if paise >= 0 else "-%d.%02d" % divmod(-paise, PAISE_PER_RUPEE)
+
+def format_paise(paise):
+    """Formats whole paise as rupees with two decimals ("-12.05"), once per distinct value, as an object array"""
+    codes, uniques = pd.factorize(np.asarray(paise, dtype=np.int64))
+    # Rupees as a float round back to the same two decimals while the paise are well within float precision
+    formatted = np.array(["%.2f" % value for value in (uniques / PAISE_PER_RUPEE).tolist()], dtype=object)
+    for index in np.flatnonzero(np.abs(uniques) >= _EXACT_FLOAT_UNITS).tolist():
+        formatted[index] = format_paise_int(int(uniques[index]))
+    return formatted[codes]
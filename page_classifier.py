@@ -0,0 +1,78 @@
+import re
+import fitz  # PyMuPDF
+from text_extractor import MIN_TEXT_WORDS, group_words_into_lines, normalize_header
+
+# Column headings that only appear on pages with a line item table
+TABLE_KEYWORDS = {
+    "qty", "quantity", "rate", "hsn", "sac", "batch", "mrp", "taxable", "uom",
+    "igst", "cgst", "sgst", "disc", "discount", "particulars", "description",
+}
+
+# Titles of pages that carry an item table but are not the invoice itself
+NON_INVOICE_TITLES = ("e way bill", "eway bill", "delivery challan", "packing list")
+TITLE_LINES = 3
+
+# Minimum distinct table keywords for a header row to count
+MIN_TABLE_KEYWORDS = 3
+
+# Lines with this many numbers look like line item rows, for continuation
+# pages that do not repeat the table header
+MIN_NUMBERS_PER_ROW = 4
+MIN_NUMERIC_ROWS = 2
+
+# Scanned pages with less dark ink than this are blank
+MIN_INK_FRACTION = 0.005
+INK_DPI = 36
+INK_THRESHOLD = 200
+
+NUMBER_PATTERN = re.compile(r"^-?[\d,]+(\.\d+)?%?$")
+
+def ink_fraction(page):
+    """Fraction of dark pixels in a low resolution grayscale render of the page"""
+    pix = page.get_pixmap(dpi=INK_DPI, colorspace=fitz.csGRAY, alpha=False)
+    samples = pix.samples
+    if not samples:
+        return 0.0
+    return sum(1 for value in samples if value < INK_THRESHOLD) / len(samples)
+
+def classify_page(page, words=None):
+    """
+    Decides cheaply, without calling the model, whether a page can hold line items.
+    Pages with a text layer are judged on table headings and rows of numbers;
+    scanned pages are only skipped when they are blank.
+
+    Args:
+        page: fitz.Page to classify
+        words: page.get_text("words") if already computed
+
+    Returns:
+        (True, reason) to extract the page, (False, reason) to skip it
+    """
+    if words is None:
+        words = page.get_text("words")
+
+    if len(words) < MIN_TEXT_WORDS:
+        ink = ink_fraction(page)
+        if ink < MIN_INK_FRACTION:
+            return False, f"blank page ({ink:.2%} ink)"
+        return True, "scanned page"
+
+    lines = group_words_into_lines(words)
+    title = normalize_header(" ".join(word[4] for _, line_words in lines[:TITLE_LINES] for word in line_words))
+    for non_invoice_title in NON_INVOICE_TITLES:
+        if non_invoice_title in title and "invoice" not in title:
+            return False, f"{non_invoice_title} page"
+
+    tokens = {token for word in words for token in normalize_header(word[4]).split()}
+    keywords = tokens & TABLE_KEYWORDS
+    if len(keywords) >= MIN_TABLE_KEYWORDS:
+        return True, "line item headings: " + ", ".join(sorted(keywords))
+
+    numeric_rows = 0
+    for _, line_words in lines:
+        if sum(1 for word in line_words if NUMBER_PATTERN.match(word[4])) >= MIN_NUMBERS_PER_ROW:
+            numeric_rows += 1
+            if numeric_rows >= MIN_NUMERIC_ROWS:
+                return True, "rows of amounts"
+
+    return False, "no line item table in text layer"
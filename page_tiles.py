@@ -0,0 +1,71 @@
+from collections import Counter
+import fitz  # PyMuPDF
+from page_render import COLORSPACES, DEFAULT_RENDER_SETTINGS, encode_jpeg
+
+# A page whose answer hit the output token limit is re-sent as this many
+# horizontal strips, each overlapping its neighbours by this share of the
+# page height so every row is whole in at least one strip
+DEFAULT_STRIP_COUNT = 3
+STRIP_OVERLAP = 0.1
+
+# Fields that identify a row when the same row is read from two strips
+ROW_KEY_FIELDS = ("Description of Goods", "Batch No", "QTY", "Total")
+
+def strip_bounds(count=DEFAULT_STRIP_COUNT, overlap=STRIP_OVERLAP):
+    """Top and bottom of each strip as fractions of the page height"""
+    height = 1.0 / count
+    return [(max(0.0, index * height - overlap / 2), min(1.0, (index + 1) * height + overlap / 2))
+            for index in range(count)]
+
+def render_page_strips(page, settings=DEFAULT_RENDER_SETTINGS, count=DEFAULT_STRIP_COUNT, overlap=STRIP_OVERLAP):
+    """
+    Renders a PDF page as overlapping horizontal strips, top to bottom.
+    Must run on the thread that owns the document, like render_page.
+
+    Returns:
+        List of JPEG encoded strip images as bytes
+    """
+    rect = page.rect
+    strips = []
+    for top, bottom in strip_bounds(count, overlap):
+        clip = fitz.Rect(rect.x0, rect.y0 + top * rect.height, rect.x1, rect.y0 + bottom * rect.height)
+        pix = page.get_pixmap(dpi=settings.dpi, colorspace=COLORSPACES[settings.colorspace], alpha=False, clip=clip)
+        strips.append(encode_jpeg(pix, settings.jpeg_quality))
+    return strips
+
+def split_text_strips(text, count=DEFAULT_STRIP_COUNT, overlap=STRIP_OVERLAP):
+    """Splits layout text into overlapping runs of whole lines, the text counterpart of render_page_strips"""
+    lines = text.split("\n")
+    strips = []
+    for top, bottom in strip_bounds(count, overlap):
+        start = int(top * len(lines))
+        end = max(start + 1, round(bottom * len(lines)))
+        strips.append("\n".join(lines[start:end]))
+    return strips
+
+def _row_key(line_item):
+    return tuple(" ".join(str(line_item.get(key, "")).split()).lower() for key in ROW_KEY_FIELDS)
+
+def merge_strip_line_items(strips):
+    """
+    Concatenates the line items of a page's strips, top to bottom, dropping
+    the rows at the start of each strip that were already read from the
+    bottom of the strip above it. Identical rows elsewhere on the page are
+    kept, invoices do list the same item twice.
+
+    Args:
+        strips: One list of line items per strip, in strip order
+
+    Returns:
+        List of line items for the whole page
+    """
+    merged = []
+    previous = Counter()
+    for line_items in strips:
+        start = 0
+        while start < len(line_items) and previous[_row_key(line_items[start])] > 0:
+            previous[_row_key(line_items[start])] -= 1
+            start += 1
+        merged.extend(line_items[start:])
+        previous = Counter(_row_key(line_item) for line_item in line_items)
+    return merged
@@ -0,0 +1,300 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Defaults, overridable with GEMINI_RPM, GEMINI_TPM and GEMINI_MAX_IN_FLIGHT;
+# set them to the quota of your API tier
+DEFAULT_REQUESTS_PER_MINUTE = 300
+DEFAULT_TOKENS_PER_MINUTE = 1_000_000
+DEFAULT_MAX_IN_FLIGHT = 16
+
+# Rough input token cost of one inline page image, corrected from usage_metadata after the call
+IMAGE_TOKEN_ESTIMATE = 1100
+CHARS_PER_TOKEN = 4
+
+# In-flight slots held by a crashed process are given back after this long
+LEASE_SECONDS = 300
+
+# Longest single sleep while waiting, so a freed slot is noticed quickly
+MAX_POLL_SECONDS = 0.25
+
+# Per thread, the callback of admission_listener
+_admission = threading.local()
+
+@contextmanager
+def admission_listener(listener):
+    """
+    While active, every RateLimiter.acquire on this thread calls
+    listener(None) as its request starts waiting and
+    listener(time.monotonic()) once it is admitted, so callers can time a
+    request from when it was actually sent.
+    """
+    previous = getattr(_admission, "listener", None)
+    _admission.listener = listener
+    try:
+        yield
+    finally:
+        _admission.listener = previous
+
+def estimate_tokens(contents, system_prompt=None):
+    """Cheap pre-call estimate of the input tokens of a generate_content request"""
+    tokens = len(system_prompt) // CHARS_PER_TOKEN if system_prompt else 0
+    for turn in contents:
+        for part in turn.get("parts", []):
+            if "text" in part:
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif "inline_data" in part:
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def _refill(level, updated, capacity, now):
+    """Tops a bucket up at capacity per minute since it was last updated"""
+    return min(capacity, level + (now - updated) * capacity / 60.0)
+
+class _MemoryState:
+    """Bucket levels and in-flight count shared by the threads of one process"""
+
+    def __init__(self, capacities):
+        now = time.monotonic()
+        self.capacities = capacities
+        self.buckets = {name: (capacity, now) for name, capacity in capacities.items()}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, costs, max_in_flight):
+        with self.lock:
+            now = time.monotonic()
+            levels = {
+                name: _refill(level, updated, self.capacities[name], now)
+                for name, (level, updated) in self.buckets.items()
+            }
+            wait = _wait_for(levels, costs, self.capacities)
+            if wait == 0 and self.in_flight >= max_in_flight:
+                wait = MAX_POLL_SECONDS
+            if wait == 0:
+                self.in_flight += 1
+                for name in levels:
+                    levels[name] -= costs.get(name, 0)
+            self.buckets = {name: (level, now) for name, level in levels.items()}
+            return wait, None
+
+    def release(self, lease):
+        with self.lock:
+            self.in_flight -= 1
+
+    def adjust(self, name, delta):
+        with self.lock:
+            level, updated = self.buckets[name]
+            self.buckets[name] = (level - delta, updated)
+
+class _SqliteState:
+    """
+    Bucket levels and in-flight leases in a SQLite file, so several
+    processes (CLI runs, Streamlit servers) share one quota.
+    """
+
+    def __init__(self, path, capacities):
+        self.capacities = capacities
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL, updated REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS leases (id INTEGER PRIMARY KEY AUTOINCREMENT, expires REAL)")
+            for name, capacity in capacities.items():
+                self.conn.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)", (name, capacity, time.time()))
+
+    def try_acquire(self, costs, max_in_flight):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = {}
+                for name, level, updated in self.conn.execute("SELECT name, level, updated FROM buckets"):
+                    if name in self.capacities:
+                        levels[name] = _refill(level, updated, self.capacities[name], now)
+                wait = _wait_for(levels, costs, self.capacities)
+                self.conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+                if wait == 0:
+                    in_flight = self.conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+                    if in_flight >= max_in_flight:
+                        wait = MAX_POLL_SECONDS
+                lease = None
+                if wait == 0:
+                    for name in levels:
+                        levels[name] -= costs.get(name, 0)
+                    lease = self.conn.execute("INSERT INTO leases (expires) VALUES (?)", (now + LEASE_SECONDS,)).lastrowid
+                for name, level in levels.items():
+                    self.conn.execute("UPDATE buckets SET level = ?, updated = ? WHERE name = ?", (level, now, name))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            return wait, lease
+
+    def release(self, lease):
+        with self.lock:
+            self.conn.execute("DELETE FROM leases WHERE id = ?", (lease,))
+
+    def adjust(self, name, delta):
+        with self.lock:
+            self.conn.execute("UPDATE buckets SET level = level - ? WHERE name = ?", (delta, name))
+
+def _wait_for(levels, costs, capacities):
+    """Seconds until every bucket holds its cost, 0 when they already do"""
+    wait = 0.0
+    for name, level in levels.items():
+        # A request bigger than a whole bucket only has to wait for a full one
+        cost = min(costs.get(name, 0), capacities[name])
+        if level < cost:
+            wait = max(wait, (cost - level) * 60.0 / capacities[name])
+    return wait
+
+class RateLimiter:
+    """
+    Token-bucket limiter for Gemini requests per minute, tokens per minute and
+    requests in flight. Memory-backed it covers every thread of a process;
+    given a state_path it keeps its buckets in SQLite so separate processes
+    share the quota.
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, state_path=None):
+        self.max_in_flight = max_in_flight
+        capacities = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self._state = _SqliteState(state_path, capacities) if state_path else _MemoryState(capacities)
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, estimated_tokens):
+        """
+        Blocks until the request fits the quota.
+
+        Returns:
+            (lease, seconds waited); pass the lease to release()
+        """
+        listener = getattr(_admission, "listener", None)
+        if listener is not None:
+            listener(None)
+        start = time.monotonic()
+        costs = {"requests": 1, "tokens": estimated_tokens}
+        while True:
+            wait, lease = self._state.try_acquire(costs, self.max_in_flight)
+            if wait == 0:
+                break
+            time.sleep(min(wait, MAX_POLL_SECONDS))
+        admitted = time.monotonic()
+        waited = admitted - start
+        if listener is not None:
+            listener(admitted)
+        with self._stats_lock:
+            self.requests += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return lease, waited
+
+    def release(self, lease, estimated_tokens=0, actual_tokens=None):
+        """Frees the in-flight slot and corrects the token bucket with the real usage"""
+        self._state.release(lease)
+        if actual_tokens is not None and actual_tokens != estimated_tokens:
+            self._state.adjust("tokens", actual_tokens - estimated_tokens)
+
+    def stats(self):
+        """Queue wait metrics: requests admitted, total, mean and max seconds spent waiting"""
+        with self._stats_lock:
+            mean = self.total_wait / self.requests if self.requests else 0.0
+            return {"requests": self.requests, "total_wait": self.total_wait,
+                    "mean_wait": mean, "max_wait": self.max_wait}
+
+class RateLimitedModel:
+    """
+    Wraps a GenerativeModel so every generate_content call goes through a
+    RateLimiter. Other attributes are passed through to the wrapped model.
+    The time spent queueing is set on the response as response.queue_wait.
+    A streamed response holds its in-flight slot until it has been read to
+    the end or closed, see LeasedStream.
+    """
+
+    def __init__(self, model, limiter):
+        self.model = model
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def generate_content(self, contents, **kwargs):
+        estimated_tokens = estimate_tokens(contents, getattr(self.model, "system_prompt", None))
+        lease, waited = self.limiter.acquire(estimated_tokens)
+        streamed = False
+        actual_tokens = None
+        try:
+            response = self.model.generate_content(contents=contents, **kwargs)
+            if kwargs.get("stream"):
+                response = LeasedStream(response, self.limiter, lease, estimated_tokens)
+                streamed = True
+            else:
+                actual_tokens = _total_tokens(response)
+            response.queue_wait = waited
+            return response
+        finally:
+            if not streamed:
+                self.limiter.release(lease, estimated_tokens, actual_tokens)
+
+def _total_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return usage.total_token_count if usage is not None else None
+
+class LeasedStream:
+    """
+    A streamed response that gives its rate limiter lease back once the
+    stream has been read to the end, closed, or dropped, correcting the
+    token bucket with the real usage when the stream was read in full.
+    Other attributes are passed through to the response.
+    """
+
+    def __init__(self, response, limiter, lease, estimated_tokens):
+        self.response = response
+        self.limiter = limiter
+        self.lease = lease
+        self.estimated_tokens = estimated_tokens
+        self._released = False
+        self._release_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __iter__(self):
+        complete = False
+        try:
+            yield from self.response
+            complete = True
+        finally:
+            self._release(_total_tokens(self.response) if complete else None)
+
+    def close(self):
+        """Gives the lease back without reading the rest of the stream"""
+        self._release(None)
+
+    def __del__(self):
+        if "_released" in self.__dict__:
+            self._release(None)
+
+    def _release(self, actual_tokens):
+        with self._release_lock:
+            if self._released:
+                return
+            self._released = True
+        self.limiter.release(self.lease, self.estimated_tokens, actual_tokens)
+
+def limiter_from_env():
+    """Builds the process-wide limiter from GEMINI_RPM, GEMINI_TPM, GEMINI_MAX_IN_FLIGHT and GEMINI_LIMITER_DB"""
+    return RateLimiter(
+        requests_per_minute=int(os.environ.get("GEMINI_RPM", DEFAULT_REQUESTS_PER_MINUTE)),
+        tokens_per_minute=int(os.environ.get("GEMINI_TPM", DEFAULT_TOKENS_PER_MINUTE)),
+        max_in_flight=int(os.environ.get("GEMINI_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT)),
+        state_path=os.environ.get("GEMINI_LIMITER_DB") or None,
+    )
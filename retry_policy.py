@@ -0,0 +1,245 @@
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from pydantic import ValidationError
+
+# Error classes a failed Gemini call is sorted into
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_SERVER = "server"
+ERROR_TIMEOUT = "timeout"
+ERROR_INVALID_JSON = "invalid_json"
+
+# Error classes that count against the circuit breaker
+TRANSIENT_ERRORS = (ERROR_RATE_LIMIT, ERROR_SERVER, ERROR_TIMEOUT)
+
+# Circuit breaker states
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+JSON_MIME_TYPE = "application/json"
+
+# finish_reason of a response the model stopped writing at its output token limit
+FINISH_MAX_TOKENS = "MAX_TOKENS"
+
+class CircuitOpenError(Exception):
+    """Raised without calling the API while the circuit breaker is open"""
+
+@dataclass(frozen=True)
+class RetryRule:
+    """How often and how patiently one error class is retried"""
+    max_attempts: int
+    base_delay: float
+    max_delay: float = 30.0
+
+def _default_rules():
+    return {
+        ERROR_RATE_LIMIT: RetryRule(max_attempts=6, base_delay=2.0, max_delay=60.0),
+        ERROR_SERVER: RetryRule(max_attempts=4, base_delay=1.0),
+        ERROR_TIMEOUT: RetryRule(max_attempts=3, base_delay=1.0),
+        # A malformed answer is asked again straight away, the API itself is fine
+        ERROR_INVALID_JSON: RetryRule(max_attempts=2, base_delay=0.0),
+    }
+
+def classify_error(error):
+    """
+    Sorts an exception from generate_content into an error class.
+
+    Returns:
+        One of the ERROR_* constants, or None when retrying cannot help
+        (bad request, permission denied, blocked prompt, open circuit)
+    """
+    # An answer that does not match the response schema is as useless as malformed JSON
+    if isinstance(error, (json.JSONDecodeError, ValidationError)):
+        return ERROR_INVALID_JSON
+    # google.api_core exceptions carry the HTTP status as code
+    status = getattr(error, "code", None)
+    if isinstance(status, int):
+        if status == 429:
+            return ERROR_RATE_LIMIT
+        if status in (408, 504):
+            return ERROR_TIMEOUT
+        if 500 <= status < 600:
+            return ERROR_SERVER
+        return None
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return ERROR_TIMEOUT
+    return None
+
+def finish_reason(response):
+    """Name of the first candidate's finish_reason, e.g. "STOP" or "MAX_TOKENS", None when absent"""
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return None
+    return getattr(reason, "name", reason)
+
+@dataclass
+class RetryPolicy:
+    """
+    Per error class retry rules with capped exponential backoff and full
+    jitter: attempt n waits a random time between 0 and
+    min(max_delay, base_delay * 2 ** (n - 1)) seconds.
+    """
+    rules: dict = field(default_factory=_default_rules)
+    sleep: object = time.sleep
+    random: object = random.random
+
+    def delay(self, rule, attempt):
+        return self.random() * min(rule.max_delay, rule.base_delay * 2 ** (attempt - 1))
+
+class CircuitBreaker:
+    """
+    Fails fast once the API has failed failure_threshold calls in a row with
+    rate limit, server or timeout errors. After reset_timeout seconds one
+    probe call is let through, and no other until it is settled: any answer
+    from the API closes the circuit again, a transient error reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError when the call must not reach the API.
+
+        Returns:
+            True when the call is the half-open probe; the caller must then
+            call release_probe once the call is over, whatever its outcome
+        """
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return False
+            if (self.state == CIRCUIT_OPEN and not self._probing
+                    and self.clock() - self._opened_at >= self.reset_timeout):
+                self.state = CIRCUIT_HALF_OPEN
+                self._probing = True
+                return True
+            raise CircuitOpenError(f"Gemini circuit breaker is {self.state}, not calling the API")
+
+    def record_success(self):
+        """The API answered, even if it refused the request"""
+        with self._lock:
+            self.state = CIRCUIT_CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        """The call failed with a rate limit, server or timeout error"""
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == CIRCUIT_HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = CIRCUIT_OPEN
+                self._opened_at = self.clock()
+
+    def release_probe(self):
+        """Reopens the circuit when the probe ended without an outcome being recorded"""
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self.state = CIRCUIT_OPEN
+                self._opened_at = self.clock()
+
+def _config_value(generation_config, name):
+    """A generation_config field, from a GenerationConfig or a plain dict"""
+    value = getattr(generation_config, name, None)
+    if value is None and isinstance(generation_config, dict):
+        value = generation_config.get(name)
+    return value
+
+def _expects_json(generation_config):
+    return _config_value(generation_config, "response_mime_type") == JSON_MIME_TYPE
+
+def validate_json(response_schema, text):
+    """Default RetryingModel check of a JSON answer: only that it parses"""
+    json.loads(text)
+
+class RetryingModel:
+    """
+    Wraps a model so generate_content is retried according to a RetryPolicy
+    behind a CircuitBreaker. Responses requested as JSON are checked once
+    here with validate(response_schema, text), json.loads of the text by
+    default, so a malformed answer is asked again instead of losing the
+    page; an answer cut off at the output token limit is returned as it is,
+    asking again would only cut it off again.
+    The number of attempts is set on the response as response.attempts, and
+    response.throttled tells whether any of them hit a 429; an error raised
+    once retrying gives up carries the same two attributes.
+    Other attributes are passed through to the wrapped model.
+    """
+
+    def __init__(self, model, policy=None, breaker=None, validate=None):
+        self.model = model
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.validate = validate or validate_json
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        attempts = {}
+        total_attempts = 0
+        try:
+            while True:
+                probe = self.breaker.before_call()
+                total_attempts += 1
+                try:
+                    response = self.model.generate_content(contents=contents, generation_config=generation_config,
+                                                           **kwargs)
+                except Exception as e:
+                    error_class = classify_error(e)
+                    if error_class in TRANSIENT_ERRORS:
+                        self.breaker.record_failure()
+                    else:
+                        # A 4xx, a blocked prompt or a malformed answer still means the API is up
+                        self.breaker.record_success()
+                    if not self._should_retry(error_class, attempts):
+                        raise
+                    continue
+                else:
+                    self.breaker.record_success()
+                finally:
+                    # Even an interrupted probe must not leave the breaker half-open
+                    if probe:
+                        self.breaker.release_probe()
+                # Streamed responses are only complete once the caller has consumed them
+                if (_expects_json(generation_config) and not kwargs.get("stream")
+                        and finish_reason(response) != FINISH_MAX_TOKENS):
+                    try:
+                        self.validate(_config_value(generation_config, "response_schema"), response.text)
+                    except Exception as e:
+                        # Blocked or empty responses have no text; the caller reports them
+                        if classify_error(e) == ERROR_INVALID_JSON:
+                            if not self._should_retry(ERROR_INVALID_JSON, attempts):
+                                raise
+                            continue
+                response.attempts = total_attempts
+                response.throttled = ERROR_RATE_LIMIT in attempts
+                return response
+        except Exception as e:
+            # The caller reports the failed page with what it cost
+            e.attempts = total_attempts
+            e.throttled = ERROR_RATE_LIMIT in attempts
+            raise
+
+    def _should_retry(self, error_class, attempts):
+        """Counts the failed attempt and sleeps before the next one; False once the rule is exhausted"""
+        rule = self.policy.rules.get(error_class)
+        if rule is None:
+            return False
+        attempts[error_class] = attempts.get(error_class, 0) + 1
+        if attempts[error_class] >= rule.max_attempts:
+            return False
+        self.policy.sleep(self.policy.delay(rule, attempts[error_class]))
+        return True
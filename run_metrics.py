@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+DEFAULT_METRICS_LOG_PATH = "extraction_metrics.jsonl"
+
+# USD per million tokens: (input, cached input, output including thinking).
+# Update when Google changes its prices; unknown models are costed at 0.
+MODEL_PRICES = {
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.025, 0.40),
+    "gemini-2.5-pro": (1.25, 0.31, 10.00),
+}
+
+TOKEN_KEYS = ("prompt_tokens", "cached_tokens", "candidates_tokens", "total_tokens")
+
+def _model_key(model_name):
+    return (model_name or "").split("/")[-1]
+
+def page_cost(usage, model_name):
+    """
+    Cost in USD of one page's Gemini usage. Output is billed as total minus
+    prompt tokens, which includes thinking tokens that candidates_tokens omits.
+    """
+    if not usage or _model_key(model_name) not in MODEL_PRICES:
+        return 0.0
+    input_price, cached_price, output_price = MODEL_PRICES[_model_key(model_name)]
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    cached_tokens = usage.get("cached_tokens") or 0
+    output_tokens = max((usage.get("total_tokens") or 0) - prompt_tokens, usage.get("candidates_tokens") or 0)
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + output_tokens * output_price) / 1_000_000
+
+def page_metrics(result):
+    """Flat metrics record for one PageResult"""
+    usage = result.usage or {}
+    record = {
+        "page": result.page_index + 1,
+        "path": result.path,
+        "model": result.tier,
+        "input_mode": result.input_mode,
+        "payload_bytes": result.payload_bytes,
+        "latency_s": round(result.latency, 3),
+        "queue_wait_s": round(result.queue_wait, 3),
+        "attempts": result.attempts,
+        "hedged": result.hedged,
+        "hedge_won": result.hedge_won,
+        "strips": result.strips,
+        "rechecks": result.rechecks,
+        "recheck_kept": result.recheck_kept,
+        "line_items": len(result.line_items),
+        "error": result.error,
+    }
+    for key in TOKEN_KEYS:
+        record[key] = usage.get(key) or 0
+    if result.usage_by_tier:
+        # Escalated pages were also paid for at the lower tiers' prices
+        record["cost_usd"] = sum(page_cost(tier_usage, tier) for tier, tier_usage in result.usage_by_tier.items())
+    else:
+        record["cost_usd"] = page_cost(usage, result.tier)
+    return record
+
+def document_metrics(document, results, wall_time):
+    """
+    Aggregates the page metrics of one document.
+
+    Args:
+        document: Name of the document, e.g. the PDF file name
+        results: PageResults of the document
+        wall_time: Seconds the whole document took, end to end
+
+    Returns:
+        Dict of document totals with the per-page records under "pages"
+    """
+    pages = [page_metrics(result) for result in results]
+    gemini_pages = [page for page in pages if page["model"]]
+    metrics = {
+        "document": document,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "page_count": len(pages),
+        "gemini_pages": len(gemini_pages),
+        "wall_time_s": round(wall_time, 3),
+        "gemini_latency_s": round(sum(page["latency_s"] for page in gemini_pages), 3),
+        "queue_wait_s": round(sum(page["queue_wait_s"] for page in gemini_pages), 3),
+        "payload_bytes": sum(page["payload_bytes"] for page in gemini_pages),
+        "line_items": sum(page["line_items"] for page in pages),
+        "failed_pages": sum(1 for page in pages if page["error"]),
+        "hedges": sum(1 for page in pages if page["hedged"]),
+        "hedge_wins": sum(1 for page in pages if page["hedge_won"]),
+        "split_pages": sum(1 for page in pages if page["strips"]),
+        "rechecked_pages": sum(1 for page in pages if page["rechecks"]),
+        "recheck_fixes": sum(1 for page in pages if page["recheck_kept"]),
+    }
+    for key in TOKEN_KEYS:
+        metrics[key] = sum(page[key] for page in pages)
+    metrics["cost_usd"] = sum(page["cost_usd"] for page in pages)
+    metrics["pages"] = pages
+    return metrics
+
+class SessionMetrics:
+    """Running totals over every document processed in a session"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = []
+
+    def add(self, metrics):
+        with self._lock:
+            self.documents.append({key: value for key, value in metrics.items() if key != "pages"})
+
+    def summary(self):
+        """Session totals of the document metrics that add up"""
+        with self._lock:
+            totals = {"documents": len(self.documents)}
+            for key in ("page_count", "gemini_pages", "wall_time_s", "gemini_latency_s", "queue_wait_s",
+                        "payload_bytes", "line_items", "failed_pages", "hedges", "hedge_wins", "split_pages",
+                        "rechecked_pages", "recheck_fixes") + TOKEN_KEYS + ("cost_usd",):
+                totals[key] = sum(document[key] for document in self.documents)
+            return totals
+
+def append_metrics_log(metrics, path=DEFAULT_METRICS_LOG_PATH):
+    """Appends one document's metrics as a JSON line for offline analysis"""
+    with open(path, "a") as f:
+        f.write(json.dumps(metrics) + "\n")
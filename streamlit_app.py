@@ -3,6 +3,9 @@ import json
 import pandas as pd
 from io import StringIO
 import base64
+import numpy as np
+from derived_rates import derived_paise
+from money import format_paise, parse_scaled_column
 
 def process_json_data(input_json):
     # Parse the JSON if it's a string, otherwise use as is
@@ -11,21 +14,29 @@ def process_json_data(input_json):
     else:
         data = input_json
     
-    # Process each line item
+    # Convert Rate to exact paise, removing any commas if present; an empty Rate is an error here, as it
+    # always was, where parse_scaled reads it as 0
     for item in data["LineItems"]:
-        # Convert Rate to float, removing any commas if present
-        rate = float(item["Rate"].replace(",", ""))
-        # Calculate P Rate (1.06 times Rate) and format to 2 decimal places
-        p_rate = round(rate * 1.06, 2)
-        b_rate=round(p_rate*1.11,2)
+        if not item["Rate"]:
+            float(item["Rate"])
+    rates, errors = parse_scaled_column([item["Rate"] for item in data["LineItems"]])
+    for error in errors:
+        if error is not None:
+            raise ValueError(error)
+    # Calculate P Rate (1.06 times Rate) and B Rate, rounded half-up to the paisa
+    derived = derived_paise(rates, np.zeros_like(rates), np.zeros_like(rates))
+    p_rates, b_rates = format_paise(derived["P Rate"]), format_paise(derived["B Rate"])
+    
+    # Process each line item
+    for item, p_rate, b_rate in zip(data["LineItems"], p_rates, b_rates):
         # Create a new dictionary with all original items plus P Rate
         new_item = {}
         for key, value in item.items():
             new_item[key] = value
             if key == "Rate":
-                new_item["P Rate"] = f"{p_rate:.2f}"
+                new_item["P Rate"] = p_rate
             if key == "Total":
-                new_item["B Rate"] = f"{b_rate:.2f}" 
+                new_item["B Rate"] = b_rate
         # Replace the original item with the new one
         item.clear()
         item.update(new_item)
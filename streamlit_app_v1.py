@@ -4,14 +4,25 @@ import pandas as pd
 from io import StringIO
 import base64
 import os
-import io
-import tempfile
 import time
-import atexit
 import fitz  # PyMuPDF
-from PIL import Image
 from dotenv import load_dotenv
-import google.generativeai as genai
+from page_render import DEFAULT_RENDER_SETTINGS
+from arithmetic_checks import ArithmeticRecheck, ArithmeticTolerance
+from concurrency_control import AdaptiveConcurrency, HedgePolicy, describe
+from derived_rates import add_derived_rates
+from extraction_cache import ExtractionCache
+from extraction_engine import (DEFAULT_BATCH_PAGES, DEFAULT_MAX_CONCURRENCY, INPUT_IMAGE, INPUT_TEXT, combine_page_results,
+                               count_page_paths, extract_document, summarize_token_usage)
+from extraction_backend import BACKEND_FAKE, FakeGeminiBackend, create_gemini_backend
+from gemini_model import load_system_prompt
+from layout_templates import TemplateIndex
+from line_item_table import LineItemTable
+from line_items import validate_line_items
+from model_cascade import count_resolving_tiers
+from rate_limiter import limiter_from_env
+from run_metrics import DEFAULT_METRICS_LOG_PATH, SessionMetrics, append_metrics_log, document_metrics
+from supplier_index import SupplierIndex
 
 # Set page config
 st.set_page_config(page_title="Invoice PDF Processor", layout="wide")
@@ -19,9 +30,18 @@ st.set_page_config(page_title="Invoice PDF Processor", layout="wide")
 # Load environment variables and configure Gemini
 load_dotenv()
 
-# Initialize Gemini API
+# One rate limiter for every session of the app, so concurrent users share
+# the API quota instead of each running into 429s
 @st.cache_resource
-def initialize_gemini():
+def get_rate_limiter():
+    return limiter_from_env()
+
+# Initialize the extraction backend: Gemini, or with EXTRACTION_BACKEND=fake an offline stand-in
+@st.cache_resource
+def initialize_backend():
+    if os.environ.get("EXTRACTION_BACKEND") == BACKEND_FAKE:
+        return FakeGeminiBackend(latency=0.5, latency_jitter=0.5)
+    
     api_key = os.environ.get('GEMINI_API_KEY')
     if not api_key:
         api_key = st.secrets.get("GEMINI_API_KEY", None)
@@ -30,50 +50,98 @@ def initialize_gemini():
         st.error("Gemini API key not found. Please set GEMINI_API_KEY in .env file or Streamlit secrets.")
         return None
     
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel(model_name='gemini-2.5-flash')
+    # Created once per server: the extraction prompt is the system instruction,
+    # served from a Gemini context cache shared across sessions where possible.
+    # The retry policy and its circuit breaker wrap the shared rate limiter.
+    # Pages go to the light model first and are escalated only when its answer fails the checks
+    return create_gemini_backend(api_key, get_rate_limiter())
 
-model = initialize_gemini()
+backend = initialize_backend()
 
-# Keep track of temporary files to clean up at exit
-temp_files = []
+# One on-disk extraction cache shared by every session of the app
+@st.cache_resource
+def get_extraction_cache():
+    return ExtractionCache()
 
-def cleanup_temp_files():
-    """Clean up any remaining temporary files when the program exits"""
-    for file_path in temp_files:
-        try:
-            if os.path.exists(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            print(f"Warning: Could not delete temporary file {file_path}: {e}")
+# Supplier layout templates, shared by every session of the app
+@st.cache_resource
+def get_template_index():
+    return TemplateIndex()
 
-# Register the cleanup function to run at exit
-atexit.register(cleanup_temp_files)
+# Concurrency limit learned from latency and 429s, shared by every session of the app
+@st.cache_resource
+def get_concurrency_controller():
+    return AdaptiveConcurrency()
 
-def process_pdf_to_json(pdf_file, system_prompt, page_limit=None):
+# Hedge delay learned from observed latency, shared by every session of the app
+@st.cache_resource
+def get_hedge_policy():
+    return HedgePolicy()
+
+# Supplier fingerprint index, shared by every session of the app
+@st.cache_resource
+def get_supplier_index():
+    return SupplierIndex()
+
+def process_pdf_to_json(pdf_file, system_prompt, page_limit=None, render_settings=DEFAULT_RENDER_SETTINGS,
+                        max_concurrency=DEFAULT_MAX_CONCURRENCY, cache=None, use_text_layer=True,
+                        llm_input=INPUT_TEXT, templates=None, suppliers=None, skip_pages=True,
+                        batch_pages=DEFAULT_BATCH_PAGES, concurrency=None, stream_preview=False,
+                        metrics_log=DEFAULT_METRICS_LOG_PATH, hedging=None, recheck=None):
     """
     Processes a PDF file and extracts invoice line items to JSON.
+    Pages are sent to Gemini concurrently and reassembled in page order.
     
     Args:
         pdf_file: PDF file object
         system_prompt: Detailed system prompt for Gemini with extraction instructions
         page_limit: Maximum number of pages to process
+        render_settings: RenderSettings used to rasterize each page
+        max_concurrency: Maximum number of pages in flight at once
+        cache: ExtractionCache consulted before calling Gemini, defaults to the shared app cache
+        use_text_layer: Parse digitally generated pages from their text layer without Gemini
+        llm_input: "text" sends Gemini the layout text of pages that have a text layer,
+            "image" always sends the rendered page
+        templates: TemplateIndex of supplier layout templates, defaults to the shared app index
+        suppliers: SupplierIndex used to identify the supplier first, defaults to the shared app index
+        skip_pages: Skip pages the local classifier finds cannot hold line items
+        batch_pages: Number of pages packed into each Gemini request
+        concurrency: AdaptiveConcurrency that tunes the requests in flight
+            instead of max_concurrency, or None for a fixed limit
+        stream_preview: Stream Gemini responses and show each line item,
+            validated and enriched, while the model is still generating
+        metrics_log: JSONL file the document's metrics are appended to, or None
+        hedging: HedgePolicy that duplicates requests for slow pages, or None to disable
+        recheck: ArithmeticRecheck that re-requests pages whose amounts do not add up, or None to disable
         
     Returns:
-        Combined JSON with all invoice line items
+        Combined JSON with all invoice line items, and under "Metrics" the
+        per-page and per-document token, latency and cost figures
     """
-    all_line_items = []
+    if not backend:
+        st.error("Gemini API not properly initialized")
+        return {"LineItems": []}
+    
+    # Fake answers must never reach the shared extraction cache or supplier templates
+    offline = isinstance(backend, FakeGeminiBackend)
+    if cache is None and not offline:
+        cache = get_extraction_cache()
+    if templates is None and not offline:
+        templates = get_template_index()
+    if suppliers is None:
+        suppliers = get_supplier_index()
+    
+    if "session_metrics" not in st.session_state:
+        st.session_state["session_metrics"] = SessionMetrics()
+    session_metrics = st.session_state["session_metrics"]
+    
     progress_text = st.empty()
     progress_bar = st.progress(0)
-    
-    # Save uploaded file to a temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_pdf:
-        temp_pdf.write(pdf_file.getvalue())
-        temp_pdf_path = temp_pdf.name
+    start_time = time.perf_counter()
     
     try:
-        # Open PDF file
-        pdf_document = fitz.open(temp_pdf_path)
+        # Open the uploaded PDF straight from memory
+        pdf_document = fitz.open(stream=pdf_file.getvalue(), filetype="pdf")
         total_pages = len(pdf_document)
         
         # Apply page limit if specified
@@ -82,160 +150,115 @@ def process_pdf_to_json(pdf_file, system_prompt, page_limit=None):
         else:
             pages_to_process = total_pages
         
-        # Process each page
-        for page_idx in range(pages_to_process):
-            progress_text.text(f"Processing page {page_idx + 1} of {pages_to_process}...")
-            progress_bar.progress((page_idx + 1) / pages_to_process)
-            
-            # Render page to image
-            page = pdf_document.load_page(page_idx)
-            pix = page.get_pixmap(alpha=False)
-            
-            # Create a temporary file
-            temp_file = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-            temp_path = temp_file.name
-            temp_files.append(temp_path)  # Add to tracking list
-            temp_file.close()  # Close the file handle immediately
-            
-            # Save the pixmap to the temp file
-            pix.save(temp_path)
-            
-            try:
-                # Open, process and explicitly close the image
-                with Image.open(temp_path) as img:
-                    # Convert image to bytes
-                    img_bytes = io.BytesIO()
-                    img.save(img_bytes, format="JPEG")
-                    img_bytes = img_bytes.getvalue()
-                
-                # Process with Gemini
-                if model:
-                    content = [
-                        {"role": "user", "parts": [{"text": system_prompt}]},
-                        {"role": "user", "parts": [
-                            {"inline_data": {"mime_type": "image/jpeg", "data": img_bytes}},
-                            {"text": "Extract all line items from this invoice page and format as specified."}
-                        ]}
-                    ]
-                    
-                    response = model.generate_content(
-                        contents=content,
-                        generation_config=genai.types.GenerationConfig(
-                            response_mime_type="application/json"
-                        )
-                    )
-                    
-                    # Parse the JSON response
-                    page_data = json.loads(response.text)
-                    
-                    # Add line items to combined data
-                    if "LineItems" in page_data and isinstance(page_data["LineItems"], list):
-                        all_line_items.extend(page_data["LineItems"])
-                else:
-                    progress_text.text("Gemini API not properly initialized")
-                    break
-                
-            except Exception as e:
-                st.error(f"Error processing page {page_idx + 1}: {str(e)}")
-                if 'response' in locals():
-                    st.error(f"Response text: {response.text}")
+        # Identify the supplier before any other work to pick the extraction strategy
+        supplier = suppliers.identify(pdf_document.load_page(0)) if pages_to_process else None
+        if supplier:
+            st.caption(f"Supplier: {supplier.name or supplier.supplier_id[:12]} "
+                       f"({'new, ' if supplier.is_new else ''}strategy {supplier.strategy})")
+        
+        progress_text.text(f"Processing {pages_to_process} pages...")
+        
+        def report_progress(completed, total):
+            status = f"Processed {completed} of {total} pages..."
+            if concurrency is not None:
+                status += f" ({describe(concurrency.snapshot())})"
+            progress_text.text(status)
+            progress_bar.progress(completed / total)
+        
+        live_preview = st.empty()
+        streamed_rows = []
+        last_preview = [0.0]
+        
+        def show_line_item(page_index, line_item):
+            # Called on this thread, so the same validation and enrichment run while Gemini is still writing
+            enriched = process_json_data({"LineItems": validate_line_items([line_item])})["LineItems"]
+            streamed_rows.extend({"Page": page_index + 1, **item} for item in enriched)
+            if time.monotonic() - last_preview[0] >= 0.5:
+                live_preview.dataframe(pd.DataFrame(streamed_rows).tail(10))
+                last_preview[0] = time.monotonic()
+        
+        results = extract_document(backend, pdf_document, system_prompt, pages_to_process,
+                                   render_settings, max_concurrency, report_progress, cache,
+                                   use_text_layer, llm_input, templates, supplier, skip_pages,
+                                   batch_pages, concurrency=concurrency,
+                                   on_line_item=show_line_item if stream_preview else None, hedging=hedging,
+                                   recheck=recheck)
+        live_preview.empty()
+        
+        for result in results:
+            if result.strips:
+                st.caption(f"Page {result.page_index + 1} was too dense for one answer, "
+                           f"re-extracted as {result.strips} strips")
+            if result.rechecks:
+                st.caption(f"Page {result.page_index + 1}: amounts did not add up, re-requested "
+                           f"({'new answer kept' if result.recheck_kept else 'no better, first answer kept'})")
+            if result.skip_reason:
+                st.caption(f"Skipped page {result.page_index + 1}: {result.skip_reason}")
+            if result.error:
+                st.error(f"Error processing page {result.page_index + 1}: {result.error}")
+                if result.response_text:
+                    st.error(f"Response text: {result.response_text}")
         
         # Clear progress indicators
         progress_text.empty()
         progress_bar.empty()
         
+        paths = count_page_paths(results)
+        st.info("Pages by extraction path: " + ", ".join(f"{path}: {count}" for path, count in sorted(paths.items())))
+        tiers = count_resolving_tiers(results)
+        if tiers:
+            st.caption("Gemini pages by resolving model: " + ", ".join(f"{tier}: {count}" for tier, count in tiers.items()))
+        for mode, usage in summarize_token_usage(results).items():
+            st.caption(f"Gemini {mode} input: {usage['pages']} pages, {usage['prompt_tokens']} prompt tokens "
+                       f"({usage['cached_tokens']} cached), {usage['candidates_tokens']} output tokens")
+        queue_wait = max((result.queue_wait for result in results), default=0.0)
+        stats = get_rate_limiter().stats()
+        if concurrency is not None:
+            st.caption(f"Adaptive {describe(concurrency.snapshot())}")
+        hedged = sum(1 for result in results if result.hedged)
+        if hedged:
+            st.caption(f"Hedged {hedged} slow pages, the duplicate answered first on "
+                       f"{sum(1 for result in results if result.hedge_won)}")
+        st.caption(f"Rate limiter queue wait: {queue_wait:.2f}s max for this document, "
+                   f"{stats['mean_wait']:.2f}s mean over {stats['requests']} requests on this server")
+        
+        metrics = document_metrics(pdf_file.name, results, time.perf_counter() - start_time)
+        session_metrics.add(metrics)
+        if metrics_log:
+            append_metrics_log(metrics, metrics_log)
+        st.subheader("Cost and Timing")
+        summary_rows = [{"scope": "this document", **{key: value for key, value in metrics.items()
+                                                      if key not in ("document", "timestamp", "pages")}},
+                        {"scope": "this session", **session_metrics.summary()}]
+        st.dataframe(pd.DataFrame(summary_rows))
+        with st.expander("Per page"):
+            st.dataframe(pd.DataFrame(metrics["pages"]))
+        
         # Create final combined structure
-        combined_data = {"LineItems": all_line_items}
-        return combined_data
+        combined = combine_page_results(results)
+        combined["Metrics"] = metrics
+        return combined
     
     except Exception as e:
         st.error(f"Error processing PDF: {str(e)}")
         return None
     finally:
-        # Make sure to close the PDF document and remove temp file
+        # Make sure to close the PDF document
         if 'pdf_document' in locals():
             pdf_document.close()
-        if os.path.exists(temp_pdf_path):
-            os.unlink(temp_pdf_path)
 
-def validate_line_items(line_items):
+def process_json_data(input_json):
     """
-    Validates and ensures all required fields are present in line items.
-    If fields are missing, adds them with empty string values.
+    Add calculated fields to the JSON data, see derived_rates.add_derived_rates.
+    "LineItems" may be a list of dicts or a LineItemTable.
     """
-    required_fields = [
-        "Description of Goods", "HSN/SAC", "Batch No", "Mfg Date", "Expiry Date", 
-        "MRP", "QTY", "UOM", "Rate", "Discount%", "Discount Value", 
-        "Taxable Value", "IGST Rate", "IGST Amount", "Total"
-    ]
-    
-    for item in line_items:
-        for field in required_fields:
-            if field not in item:
-                item[field] = ""
-    
-    return line_items
-
-def process_json_data(input_json):
-    """Add calculated fields to the JSON data"""
-    # Process each line item
-    for item in input_json["LineItems"]:
-        # Convert numeric fields to float, removing any commas if present
-        try:
-            rate = float(item["Rate"].replace(",", "")) if item["Rate"] else 0
-            mrp_rate = float(item["MRP"].replace(",", "")) if item["MRP"] else 0
-            gst_rate = float(item["IGST Rate"].replace(",", "")) if item["IGST Rate"] else 0
-            
-            # Calculate P Rate (1.06 times Rate) and format to 2 decimal places
-            p_rate = round(rate * 1.06, 2)
-            b_rate = round(p_rate * 1.11, 2)
-            
-            # Calculate the theoretical rate based on MRP
-            # Formula: MRP / (1.3 * 1.11 * 1.06 * (1 + GST_rate/100))
-            if mrp_rate > 0 and gst_rate >= 0:
-                calculated_rate = round(mrp_rate / (1.3 * 1.11 * 1.06 * (1 + gst_rate/100)), 2)
-                difference = round(rate - calculated_rate, 2)
-            else:
-                calculated_rate = 0
-                difference = 0
-            
-            # Create a new ordered dictionary to maintain field order
-            new_item = {}
-            
-            # Copy all original fields and add calculated fields in appropriate positions
-            for key, value in item.items():
-                new_item[key] = value
-                
-                # Add P Rate after Rate
-                if key == "Rate":
-                    new_item["P Rate"] = f"{p_rate:.2f}"
-                
-                # Add B Rate after Total (assuming Total is the last financial field)
-                elif key == "Total":
-                    new_item["B Rate"] = f"{b_rate:.2f}"
-                
-                # Add Calculated Rate and Difference after MRP
-                elif key == "MRP":
-                    new_item["Calculated Rate"] = f"{calculated_rate:.2f}"
-                    new_item["Difference"] = f"{difference:.2f}"
-            
-            # Replace the original item with the new one
-            item.clear()
-            item.update(new_item)
-            
-        except (ValueError, TypeError, ZeroDivisionError) as e:
-            # Handle case where conversion fails or division by zero
-            print(f"Error processing item: {e}")
-            # Add empty calculated fields
-            item["P Rate"] = "0.00"
-            item["B Rate"] = "0.00" 
-            item["Calculated Rate"] = "0.00"
-            item["Difference"] = "0.00"
-    
+    add_derived_rates(input_json["LineItems"])
     return input_json
 
 def json_to_csv(json_data):
     """Convert JSON data to a DataFrame"""
+    if isinstance(json_data["LineItems"], LineItemTable):
+        return json_data["LineItems"].to_frame()
     df = pd.DataFrame(json_data["LineItems"])
     return df
 
@@ -256,6 +279,38 @@ def main():
     # Page limit input
     page_limit = st.number_input("Page limit (leave at 0 for all pages)", min_value=0, value=0)
     
+    # Digitally generated PDFs can be parsed from their text layer without Gemini
+    use_text_layer = st.checkbox("Read text-based PDFs directly (skip Gemini when possible)", value=True)
+    
+    # Terms and conditions, e-way bill and blank pages never have line items
+    skip_pages = st.checkbox("Skip pages without a line item table", value=True)
+    
+    # Send Gemini the page text when the PDF has one, it costs far fewer tokens than an image
+    llm_input = st.selectbox("Send pages to Gemini as", [INPUT_TEXT, INPUT_IMAGE],
+                             format_func=lambda mode: "Text layer (fallback to image)" if mode == INPUT_TEXT else "Image")
+    
+    # Number of pages sent to Gemini at the same time, or tuned from latency and 429s
+    adaptive_concurrency = st.checkbox("Tune parallel requests automatically", value=True)
+    max_concurrency = st.number_input("Pages processed in parallel", min_value=1, max_value=16, value=DEFAULT_MAX_CONCURRENCY,
+                                      disabled=adaptive_concurrency)
+    
+    # Re-send pages that take longer than most, and keep whichever answer comes first
+    hedge_requests = st.checkbox("Hedge slow pages with a duplicate request", value=True)
+    
+    # Ask Gemini again for pages whose QTY x Rate, IGST and Total do not agree
+    recheck_pages = st.checkbox("Re-request pages whose amounts do not add up", value=True)
+    tolerance_rupees = st.number_input("Allowed gap in amounts, rupees", min_value=0.0,
+                                       value=ArithmeticTolerance().absolute, step=0.5, disabled=not recheck_pages)
+    tolerance_percent = st.number_input("Allowed gap in amounts, % of the stated amount", min_value=0.0,
+                                        value=ArithmeticTolerance().relative * 100, step=0.1,
+                                        disabled=not recheck_pages)
+    
+    # Show line items as Gemini writes them instead of after each page completes
+    stream_preview = st.checkbox("Preview line items while Gemini is still generating", value=True)
+    
+    # Several pages per request share one copy of the extraction prompt
+    batch_pages = st.number_input("Pages per Gemini request", min_value=1, max_value=10, value=DEFAULT_BATCH_PAGES)
+    
     # Only show processing button when a file is uploaded
     if uploaded_file is not None:
         filename = os.path.splitext(uploaded_file.name)[0]  # Get filename without extension
@@ -265,75 +320,28 @@ def main():
         
         if process_button:
             with st.spinner("Processing PDF..."):
-                # System prompt for Gemini
-                system_prompt = """
-                You are a precise and detail-oriented invoice data extraction assistant. Your task is to analyze the provided invoice and extract all line items into a structured JSON array. Each line item should be represented as an individual JSON object, and all specified fields should be included for every line item. If a field is missing or not identifiable for a specific line item, use an empty string ("") as its value.
-
-IMPORTANT DATE FORMAT RULE:
-All date fields (Mfg Date and Expiry Date) must be converted to the format **DD/MM/YYYY**, regardless of how they appear in the invoice.  
-Examples:
-- "2024-01-05" → "05/01/2024"
-- "05-01-24" → "05/01/2024"
-- "Jan 5 2024" → "05/01/2024"
-- "05.01.2024" → "05/01/2024"
-If a date cannot be determined or parsed with certainty, return an empty string ("").
-
-Fields to Extract for Each Line Item:
-- Description of Goods: Description of the items or services listed in the invoice.
-- HSN/SAC: Harmonized System of Nomenclature or Service Accounting Code.
-- Batch No: Batch number associated with the goods.
-- Mfg Date: Manufacturing date of the goods (convert to DD/MM/YYYY).
-- Expiry Date: Expiry date of the goods (convert to DD/MM/YYYY).
-- MRP: Maximum Retail Price of the item.
-- QTY: Quantity of the goods.
-- UOM: Unit of Measure for the quantity (e.g., pcs, kg, ltr).
-- Rate: Price per unit of the goods.
-- Discount%: Discount percentage applied.
-- Discount Value: Total discount value in currency.
-- Taxable Value: Total amount before taxes after applying discounts.
-- IGST Rate: Integrated GST rate applied.
-- IGST Amount: Total Integrated GST amount applied.
-- Total: Grand total amount for the line item, including all taxes.
-
-Output Format:
-The output should be a JSON object containing a key "LineItems", whose value is a list of JSON objects, one for each line item. Example:
-{
-    "LineItems": [
-        {
-            "Description of Goods": "Item 1 Description",
-            "HSN/SAC": "1234",
-            "Batch No": "B001",
-            "Mfg Date": "01/01/2024",
-            "Expiry Date": "01/01/2025",
-            "MRP": "500.00",
-            "QTY": "2",
-            "UOM": "pcs",
-            "Rate": "450.00",
-            "Discount%": "10",
-            "Discount Value": "90.00",
-            "Taxable Value": "810.00",
-            "IGST Rate": "18",
-            "IGST Amount": "145.80",
-            "Total": "955.80"
-        }
-    ]
-}
-
-Instructions:
-- Extract every line item in the invoice and structure it as described above.
-- Include all fields for each line item. If a field is not present, return an empty string ("").
-- Convert all date fields to **DD/MM/YYYY only**.
-- Ensure numerical fields retain precision.
-- Always return full structured JSON output.
-                """
+                # System prompt for Gemini, versioned in prompts/
+                system_prompt = load_system_prompt()
                 
                 # Process the PDF
                 page_limit_to_use = page_limit if page_limit > 0 else None
-                extracted_data = process_pdf_to_json(uploaded_file, system_prompt, page_limit_to_use)
+                extracted_data = process_pdf_to_json(uploaded_file, system_prompt, page_limit_to_use,
+                                                     max_concurrency=max_concurrency,
+                                                     use_text_layer=use_text_layer,
+                                                     llm_input=llm_input,
+                                                     skip_pages=skip_pages,
+                                                     batch_pages=batch_pages,
+                                                     concurrency=get_concurrency_controller() if adaptive_concurrency else None,
+                                                     stream_preview=stream_preview,
+                                                     hedging=get_hedge_policy() if hedge_requests else None,
+                                                     recheck=ArithmeticRecheck(ArithmeticTolerance(
+                                                         tolerance_rupees, tolerance_percent / 100))
+                                                     if recheck_pages else None)
                 
                 if extracted_data and "LineItems" in extracted_data and extracted_data["LineItems"]:
-                    # Validate and process the data
-                    extracted_data["LineItems"] = validate_line_items(extracted_data["LineItems"])
+                    # Validate and process the data, column by column from here on
+                    extracted_data["LineItems"] = validate_line_items(
+                        LineItemTable.from_line_items(extracted_data["LineItems"]))
                     processed_data = process_json_data(extracted_data)
                     
                     # Convert to DataFrame
@@ -384,5 +392,3 @@ Instructions:
 
 if __name__ == "__main__":
     main()
-    # Final cleanup attempt for any remaining temp files
-    cleanup_temp_files()
@@ -0,0 +1,78 @@
+import hashlib
+import re
+import fitz  # PyMuPDF
+from PIL import Image
+
+# Fraction of the first page treated as the letterhead
+HEADER_FRACTION = 0.25
+
+# Resolution the letterhead is rendered at for the perceptual hash
+HEADER_HASH_DPI = 36
+
+GSTIN_PATTERN = re.compile(r"\b\d{2}[A-Z]{5}\d{4}[A-Z][A-Z\d]Z[A-Z\d]\b")
+
+def header_rect(page, fraction=HEADER_FRACTION):
+    rect = page.rect
+    return fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height * fraction)
+
+def header_text(page, fraction=HEADER_FRACTION):
+    """Text of the top part of a page, where suppliers print their name and GSTIN"""
+    return page.get_text("text", clip=header_rect(page, fraction))
+
+def find_gstin(text):
+    """Returns the first GSTIN in text, which in a letterhead is the supplier's, or None"""
+    match = GSTIN_PATTERN.search(text.upper())
+    return match.group(0) if match else None
+
+def normalize_name(line):
+    """Upper-cases and drops digits and punctuation so invoice numbers and dates don't leak in"""
+    return re.sub(r"\s+", " ", re.sub(r"[^A-Z ]+", " ", line.upper())).strip()
+
+def header_fields(page):
+    """
+    Reads the supplier GSTIN and name from the letterhead.
+
+    Returns:
+        (gstin or None, name or "")
+    """
+    text = header_text(page)
+    # Names often share a line with the GSTIN label, keep only what comes before it
+    names = [normalize_name(re.split(r"\bGST", line.upper())[0]) for line in text.splitlines()]
+    names = [name for name in names if len(name) >= 4]
+    return find_gstin(text), (names[0] if names else "")
+
+def text_fingerprint(page):
+    """
+    Identifies the supplier from the letterhead of an invoice's first page.
+    The GSTIN is used when present, otherwise the first line that looks like a name.
+
+    Returns:
+        Hex digest identifying the supplier, or None when the header has no text
+    """
+    gstin, name = header_fields(page)
+    key = gstin or name
+    if not key:
+        return None
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def header_image_hash(page):
+    """
+    Perceptual difference hash (dHash) of the letterhead image, for scanned
+    invoices that have no text layer. Similar letterheads give hashes a few
+    bits apart, see hamming_distance.
+
+    Returns:
+        64-bit hash as a 16 character hex string
+    """
+    pix = page.get_pixmap(clip=header_rect(page), dpi=HEADER_HASH_DPI, colorspace=fitz.csGRAY, alpha=False)
+    image = Image.frombytes("L", (pix.width, pix.height), pix.samples).resize((9, 8), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{value:016x}"
+
+def hamming_distance(first_hash, second_hash):
+    """Number of differing bits between two hex image hashes"""
+    return bin(int(first_hash, 16) ^ int(second_hash, 16)).count("1")
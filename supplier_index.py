@@ -0,0 +1,167 @@
+import json
+import os
+import sys
+import threading
+from dataclasses import dataclass
+import fitz  # PyMuPDF
+from supplier_fingerprint import hamming_distance, header_fields, header_image_hash, text_fingerprint
+from text_extractor import has_text_layer
+
+DEFAULT_SUPPLIER_INDEX_PATH = "supplier_index.json"
+
+# How a supplier's invoices are extracted: "text" tries the text layer
+# (template, table detection, then Gemini on layout text) and "image"
+# sends scanned pages straight to Gemini as images
+STRATEGY_TEXT = "text"
+STRATEGY_IMAGE = "image"
+
+# Letterhead image hashes at most this many bits apart belong to the same supplier
+MAX_IMAGE_DISTANCE = 10
+
+# The 64-bit image hash is split into bands; a near match shares at least one band exactly
+IMAGE_HASH_BANDS = 4
+
+# Image hashes kept per supplier, letterhead scans vary a little
+MAX_IMAGE_HASHES = 8
+
+@dataclass
+class SupplierMatch:
+    """Result of identifying the supplier of an invoice"""
+    supplier_id: str
+    strategy: str
+    name: str = ""
+    is_new: bool = False
+
+def _bands(image_hash):
+    width = len(image_hash) // IMAGE_HASH_BANDS
+    return [(band, image_hash[band * width:(band + 1) * width]) for band in range(IMAGE_HASH_BANDS)]
+
+class SupplierIndex:
+    """
+    Maps invoice letterheads to suppliers, stored as a JSON file.
+    Lookups are dictionary hits on the letterhead text hash, or on one band
+    of the letterhead image hash for scanned invoices.
+    """
+
+    def __init__(self, path=DEFAULT_SUPPLIER_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._suppliers = {}
+        self._by_text = {}
+        self._by_band = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for supplier_id, record in json.load(f).get("suppliers", {}).items():
+                    self._add(supplier_id, record)
+
+    def _add(self, supplier_id, record):
+        self._suppliers[supplier_id] = record
+        if record.get("text_hash"):
+            self._by_text[record["text_hash"]] = supplier_id
+        for image_hash in record.get("image_hashes", []):
+            for band in _bands(image_hash):
+                self._by_band.setdefault(band, set()).add(supplier_id)
+
+    def _match_image(self, image_hash):
+        candidates = set()
+        for band in _bands(image_hash):
+            candidates |= self._by_band.get(band, set())
+        best_id, best_distance = None, MAX_IMAGE_DISTANCE + 1
+        for supplier_id in candidates:
+            for known_hash in self._suppliers[supplier_id]["image_hashes"]:
+                distance = hamming_distance(image_hash, known_hash)
+                if distance < best_distance:
+                    best_id, best_distance = supplier_id, distance
+        return best_id
+
+    def identify(self, page, register=True):
+        """
+        Identifies the supplier of an invoice from its first page.
+        Unknown suppliers are added to the index when register is True.
+
+        Args:
+            page: First fitz.Page of the invoice
+
+        Returns:
+            SupplierMatch, or None for an unknown supplier when register is False
+        """
+        text_hash = text_fingerprint(page)
+        image_hash = header_image_hash(page)
+        with self._lock:
+            supplier_id = self._by_text.get(text_hash) if text_hash else None
+            if supplier_id is None:
+                supplier_id = self._match_image(image_hash)
+            strategy = STRATEGY_TEXT if has_text_layer(page) else STRATEGY_IMAGE
+            if supplier_id is not None:
+                record = self._suppliers[supplier_id]
+                changed = False
+                # Remember new letterhead variants so they match directly next time
+                if image_hash not in record["image_hashes"] and len(record["image_hashes"]) < MAX_IMAGE_HASHES:
+                    record["image_hashes"].append(image_hash)
+                    self._add(supplier_id, record)
+                    changed = True
+                # Suppliers do switch between scanned and generated PDFs
+                if record["strategy"] != strategy:
+                    record["strategy"] = strategy
+                    changed = True
+                if changed:
+                    self._save()
+                return SupplierMatch(supplier_id, strategy, record.get("name", ""))
+            if not register:
+                return None
+
+            gstin, name = header_fields(page)
+            supplier_id = text_hash or f"img-{image_hash}"
+            record = {
+                "name": name,
+                "gstin": gstin,
+                "text_hash": text_hash,
+                "image_hashes": [image_hash],
+                "strategy": strategy,
+            }
+            self._add(supplier_id, record)
+            self._save()
+            return SupplierMatch(supplier_id, record["strategy"], name, is_new=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._suppliers)
+
+    def _save(self):
+        # Write to a temp file first so a crash never leaves a half written index
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"suppliers": self._suppliers}, f, indent=2)
+        os.replace(temp_path, self.path)
+
+def rebuild_index(pdf_dir, index_path=DEFAULT_SUPPLIER_INDEX_PATH):
+    """
+    Rebuilds the supplier index from a directory of already processed PDFs.
+
+    Returns:
+        The new SupplierIndex
+    """
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    index = SupplierIndex(index_path)
+    for root, _, files in os.walk(pdf_dir):
+        for file_name in sorted(files):
+            if not file_name.lower().endswith(".pdf"):
+                continue
+            pdf_path = os.path.join(root, file_name)
+            try:
+                with fitz.open(pdf_path) as pdf_document:
+                    if len(pdf_document) == 0:
+                        continue
+                    match = index.identify(pdf_document.load_page(0))
+                print(f"{pdf_path}: {match.supplier_id[:12]} {match.strategy} {match.name}")
+            except Exception as e:
+                print(f"Error indexing {pdf_path}: {e}")
+    return index
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python supplier_index.py <pdf_directory> [index_path]")
+        sys.exit(1)
+    index = rebuild_index(sys.argv[1], *sys.argv[2:3])
+    print(f"Indexed {len(index)} suppliers into {index.path}")
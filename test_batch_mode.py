@@ -0,0 +1,53 @@
+import json
+import fitz  # PyMuPDF
+from batch_mode import LocalBatchBackend, ingest_results, prepare_batch
+from extraction_backend import FakeGeminiBackend
+
+ROWS_PER_PAGE = 3
+
+def write_pdf(path, title, page_count):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pdf_document = fitz.open()
+    for page_num in range(page_count):
+        page = pdf_document.new_page()
+        page.insert_text((72, 72), f"{title} page {page_num + 1}")
+    pdf_document.save(str(path))
+    pdf_document.close()
+
+def read_requests(requests_path):
+    with open(requests_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def test_batch_round_trip_keys_outputs_by_relative_path(tmp_path):
+    pdf_dir, work_dir, output_dir = tmp_path / "pdfs", tmp_path / "work", tmp_path / "out"
+    # Same file name in two folders, and a byte-identical copy of one of them
+    write_pdf(pdf_dir / "a" / "inv.pdf", "Supplier A", page_count=2)
+    write_pdf(pdf_dir / "b" / "inv.pdf", "Supplier B", page_count=1)
+    (pdf_dir / "copy.pdf").write_bytes((pdf_dir / "a" / "inv.pdf").read_bytes())
+
+    requests_path, manifest_path = prepare_batch(str(pdf_dir), str(work_dir), "prompt",
+                                                 use_text_layer=False, skip_pages=False)
+
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    assert sorted(manifest) == ["a/inv.pdf", "b/inv.pdf", "copy.pdf"]
+    assert manifest["copy.pdf"]["hash"] == manifest["a/inv.pdf"]["hash"] != manifest["b/inv.pdf"]["hash"]
+    assert manifest["copy.pdf"]["path"] == str(pdf_dir / "copy.pdf")
+    assert [manifest[name]["pages"] for name in sorted(manifest)] == [2, 1, 2]
+    assert all(document["local_results"] == {} for document in manifest.values())
+    # The copy shares the first one's requests
+    assert len(read_requests(requests_path)) == 3
+
+    backend = LocalBatchBackend(str(work_dir / "jobs"), FakeGeminiBackend(rows_per_page=ROWS_PER_PAGE))
+    job_id = backend.submit(requests_path)
+    backend.poll(job_id)
+    results_path = backend.fetch_results(job_id, str(work_dir / "batch_results.jsonl"))
+    failures = ingest_results(results_path, manifest_path, str(output_dir))
+
+    assert failures == {}
+    outputs = {path.relative_to(output_dir).as_posix(): json.loads(path.read_text())
+               for path in output_dir.rglob("*.json")}
+    assert sorted(outputs) == ["a/inv.json", "b/inv.json", "copy.json"]
+    assert len(outputs["a/inv.json"]["LineItems"]) == 2 * ROWS_PER_PAGE
+    assert len(outputs["b/inv.json"]["LineItems"]) == ROWS_PER_PAGE
+    assert outputs["copy.json"] == outputs["a/inv.json"]
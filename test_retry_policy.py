@@ -0,0 +1,196 @@
+import json
+import pytest
+from line_item_schema import LINE_ITEMS_SCHEMA, validate_response
+from retry_policy import (CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, JSON_MIME_TYPE, CircuitBreaker,
+                          CircuitOpenError, RetryingModel, RetryPolicy)
+
+JSON_CONFIG = {"response_mime_type": JSON_MIME_TYPE}
+
+class APIError(Exception):
+    """Stands in for a google.api_core exception, which carries the HTTP status as code"""
+
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+class Response:
+    def __init__(self, text='{"LineItems": []}'):
+        self.text = text
+
+class StubModel:
+    """Answers generate_content from a script: an exception is raised, anything else returned"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def sleeps():
+    return []
+
+def make_model(stub, clock, sleeps, failure_threshold=5, reset_timeout=30.0):
+    policy = RetryPolicy(sleep=sleeps.append, random=lambda: 1.0)
+    return RetryingModel(stub, policy, CircuitBreaker(failure_threshold, reset_timeout, clock))
+
+def test_rate_limit_then_server_error_then_success(clock, sleeps):
+    stub = StubModel(APIError(429), APIError(503), Response())
+    model = make_model(stub, clock, sleeps)
+
+    response = model.generate_content("page", generation_config=JSON_CONFIG)
+
+    assert stub.calls == 3
+    assert response.attempts == 3
+    assert response.throttled
+    # First backoff of each error class: base_delay of the rate limit and server rules
+    assert sleeps == [2.0, 1.0]
+    assert model.breaker.state == CIRCUIT_CLOSED
+
+def test_malformed_json_is_asked_again(clock, sleeps):
+    stub = StubModel(Response('{"LineItems": ['), Response())
+    model = make_model(stub, clock, sleeps)
+
+    response = model.generate_content("page", generation_config=JSON_CONFIG)
+
+    assert stub.calls == 2
+    assert response.attempts == 2
+    assert not response.throttled
+
+def test_malformed_json_gives_up_after_its_attempts(clock, sleeps):
+    stub = StubModel(Response("{"), Response("{"))
+    model = make_model(stub, clock, sleeps)
+
+    with pytest.raises(json.JSONDecodeError):
+        model.generate_content("page", generation_config=JSON_CONFIG)
+    assert stub.calls == 2
+
+def test_answer_off_schema_is_asked_again(clock, sleeps):
+    stub = StubModel(Response('{"LineItems": [{"Rate": [1]}]}'), Response())
+    policy = RetryPolicy(sleep=sleeps.append, random=lambda: 1.0)
+    model = RetryingModel(stub, policy, CircuitBreaker(clock=clock), validate=validate_response)
+
+    response = model.generate_content("page", generation_config={**JSON_CONFIG, "response_schema": LINE_ITEMS_SCHEMA})
+
+    assert stub.calls == 2
+    assert response.attempts == 2
+
+def test_error_given_up_on_carries_the_attempts(clock, sleeps):
+    stub = StubModel(APIError(429), APIError(503), APIError(400))
+    model = make_model(stub, clock, sleeps)
+
+    with pytest.raises(APIError) as raised:
+        model.generate_content("page", generation_config=JSON_CONFIG)
+    assert raised.value.attempts == 3
+    assert raised.value.throttled
+
+def test_bad_request_is_not_retried(clock, sleeps):
+    stub = StubModel(APIError(400), Response())
+    model = make_model(stub, clock, sleeps)
+
+    with pytest.raises(APIError):
+        model.generate_content("page", generation_config=JSON_CONFIG)
+    assert stub.calls == 1
+    assert sleeps == []
+
+def test_breaker_opens_after_consecutive_failures(clock, sleeps):
+    stub = StubModel(APIError(503), APIError(503), Response())
+    model = make_model(stub, clock, sleeps, failure_threshold=2)
+
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+    assert stub.calls == 2
+    assert model.breaker.state == CIRCUIT_OPEN
+
+    # Still within the reset timeout, the API is not called at all
+    clock.now = 10.0
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+    assert stub.calls == 2
+
+def test_successful_probe_closes_the_breaker(clock, sleeps):
+    stub = StubModel(APIError(503), APIError(503), Response())
+    model = make_model(stub, clock, sleeps, failure_threshold=2)
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+
+    clock.now = 30.0
+    response = model.generate_content("page")
+
+    assert response.attempts == 1
+    assert model.breaker.state == CIRCUIT_CLOSED
+
+def test_probe_refused_by_the_api_closes_the_breaker(clock, sleeps):
+    stub = StubModel(APIError(503), APIError(503), APIError(400), Response())
+    model = make_model(stub, clock, sleeps, failure_threshold=2)
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+
+    clock.now = 30.0
+    with pytest.raises(APIError):
+        model.generate_content("page")
+    assert model.breaker.state == CIRCUIT_CLOSED
+
+    clock.now = 130.0
+    assert model.generate_content("page").attempts == 1
+
+def test_probe_with_transient_error_reopens_the_breaker(clock, sleeps):
+    stub = StubModel(APIError(503), APIError(503), APIError(503), Response())
+    model = make_model(stub, clock, sleeps, failure_threshold=2)
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+
+    clock.now = 30.0
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+    assert model.breaker.state == CIRCUIT_OPEN
+
+    # The reset timeout counts again from the failed probe
+    clock.now = 59.0
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+    clock.now = 60.0
+    assert model.generate_content("page").attempts == 1
+
+def test_interrupted_probe_does_not_leave_the_breaker_half_open(clock, sleeps):
+    stub = StubModel(APIError(503), APIError(503), KeyboardInterrupt(), Response())
+    model = make_model(stub, clock, sleeps, failure_threshold=2)
+    with pytest.raises(CircuitOpenError):
+        model.generate_content("page")
+
+    clock.now = 30.0
+    with pytest.raises(KeyboardInterrupt):
+        model.generate_content("page")
+    assert model.breaker.state == CIRCUIT_OPEN
+
+    clock.now = 60.0
+    assert model.generate_content("page").attempts == 1
+
+def test_only_one_probe_at_a_time(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30.0, clock=clock)
+    breaker.record_failure()
+    clock.now = 30.0
+
+    assert breaker.before_call()
+    assert breaker.state == CIRCUIT_HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert not breaker.before_call()
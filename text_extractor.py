@@ -0,0 +1,212 @@
+import re
+from arithmetic_checks import DEFAULT_TOLERANCE, any_arithmetic_errors
+from line_items import LINE_ITEM_FIELDS, normalize_date
+
+# Minimum number of words for a page to count as having a text layer
+MIN_TEXT_WORDS = 20
+
+# Normalized header text -> line item field
+HEADER_ALIASES = {
+    "description of goods": "Description of Goods",
+    "description of goods services": "Description of Goods",
+    "description": "Description of Goods",
+    "particulars": "Description of Goods",
+    "product": "Description of Goods",
+    "product name": "Description of Goods",
+    "item": "Description of Goods",
+    "item name": "Description of Goods",
+    "hsn sac": "HSN/SAC",
+    "hsn": "HSN/SAC",
+    "hsn code": "HSN/SAC",
+    "sac": "HSN/SAC",
+    "batch": "Batch No",
+    "batch no": "Batch No",
+    "batch number": "Batch No",
+    "mfg": "Mfg Date",
+    "mfg date": "Mfg Date",
+    "mfg dt": "Mfg Date",
+    "manufacturing date": "Mfg Date",
+    "exp": "Expiry Date",
+    "exp date": "Expiry Date",
+    "exp dt": "Expiry Date",
+    "expiry": "Expiry Date",
+    "expiry date": "Expiry Date",
+    "mrp": "MRP",
+    "qty": "QTY",
+    "quantity": "QTY",
+    "uom": "UOM",
+    "unit": "UOM",
+    "per": "UOM",
+    "rate": "Rate",
+    "price": "Rate",
+    "unit price": "Rate",
+    "disc": "Discount%",
+    "disc %": "Discount%",
+    "discount %": "Discount%",
+    "disc amt": "Discount Value",
+    "disc value": "Discount Value",
+    "discount": "Discount Value",
+    "discount amt": "Discount Value",
+    "discount amount": "Discount Value",
+    "discount value": "Discount Value",
+    "taxable": "Taxable Value",
+    "taxable amt": "Taxable Value",
+    "taxable amount": "Taxable Value",
+    "taxable value": "Taxable Value",
+    "igst": "IGST Rate",
+    "igst %": "IGST Rate",
+    "igst rate": "IGST Rate",
+    "igst amt": "IGST Amount",
+    "igst amount": "IGST Amount",
+    "total": "Total",
+    "amount": "Total",
+    "total amount": "Total",
+    "net amount": "Total",
+}
+
+DATE_FIELDS = ("Mfg Date", "Expiry Date")
+
+def normalize_header(text):
+    """Lower-cases a header cell and collapses punctuation so aliases match"""
+    text = (text or "").lower().replace("%", " % ")
+    text = re.sub(r"[^a-z0-9%]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def has_text_layer(page, min_words=MIN_TEXT_WORDS):
+    """True when the page carries enough extractable words to try the text path"""
+    return len(page.get_text("words")) >= min_words
+
+def map_header(header_cells):
+    """
+    Maps table header cells to line item fields.
+
+    Returns:
+        Dict of column index -> field, only for recognised columns
+    """
+    columns = {}
+    for col_index, cell in enumerate(header_cells):
+        field = HEADER_ALIASES.get(normalize_header(cell))
+        if field and field not in columns.values():
+            columns[col_index] = field
+    return columns
+
+def _merge_subheader(header_cells, subheader_cells):
+    """
+    Combines a two-row header such as "IGST" over "Rate | Amount" into
+    "IGST Rate", "IGST Amount", carrying the parent label to empty cells.
+    """
+    merged = []
+    parent = ""
+    for header, sub in zip(header_cells, subheader_cells):
+        if header:
+            parent = header
+        merged.append(f"{parent} {sub}".strip() if sub else (header or ""))
+    return merged
+
+def _looks_like_subheader(cells):
+    """A subheader row has labels but no numbers"""
+    texts = [cell for cell in cells if cell]
+    return bool(texts) and not any(re.search(r"\d", cell) for cell in texts)
+
+def rows_to_line_items(header_cells, rows):
+    """
+    Converts table rows into line items using the table header.
+
+    Returns:
+        List of line items, or None when the header does not describe a line item table
+    """
+    columns = map_header(header_cells)
+    if rows and _looks_like_subheader(rows[0]):
+        merged = map_header(_merge_subheader(header_cells, rows[0]))
+        if len(merged) > len(columns):
+            columns, rows = merged, rows[1:]
+    # Without these the columns cannot be a line item table
+    if not {"Description of Goods", "QTY", "Total"} <= set(columns.values()):
+        return None
+
+    line_items = []
+    for row in rows:
+        item = {field: "" for field in LINE_ITEM_FIELDS}
+        for col_index, field in columns.items():
+            if col_index < len(row) and row[col_index]:
+                item[field] = row[col_index].strip()
+        # Skip separators, sub-totals and carried-forward rows that have no quantity
+        if not item["Description of Goods"] or not item["QTY"]:
+            continue
+        for field in DATE_FIELDS:
+            item[field] = normalize_date(item[field])
+        line_items.append(item)
+    return line_items
+
+def extract_text_line_items(page, tolerance=DEFAULT_TOLERANCE):
+    """
+    Deterministically extracts line items from a page's text layer with
+    PyMuPDF table detection, without calling the model. tolerance is the
+    ArithmeticTolerance of the arithmetic checks.
+
+    Returns:
+        List of line items when a line item table was found and every row
+        passes the arithmetic checks, otherwise None
+    """
+    if not has_text_layer(page):
+        return None
+
+    line_items = []
+    for table in page.find_tables().tables:
+        rows = table.extract()
+        header_cells = table.header.names
+        if not table.header.external and rows:
+            rows = rows[1:]
+        table_items = rows_to_line_items(header_cells, rows)
+        if table_items:
+            line_items.extend(table_items)
+
+    if not line_items:
+        return None
+    if any_arithmetic_errors(line_items, tolerance):
+        return None
+    return line_items
+
+def group_words_into_lines(words):
+    """
+    Groups PyMuPDF words into visual lines by their vertical position.
+
+    Returns:
+        List of (y_center, words sorted left to right), top to bottom
+    """
+    if not words:
+        return []
+    heights = sorted(word[3] - word[1] for word in words)
+    line_tolerance = heights[len(heights) // 2] / 2
+
+    lines = []
+    for word in sorted(words, key=lambda word: ((word[1] + word[3]) / 2, word[0])):
+        y_center = (word[1] + word[3]) / 2
+        if lines and abs(lines[-1][0] - y_center) <= line_tolerance:
+            lines[-1][1].append(word)
+        else:
+            lines.append([y_center, [word]])
+    return [(y_center, sorted(line_words, key=lambda word: word[0])) for y_center, line_words in lines]
+
+def page_layout_text(page):
+    """
+    Reconstructs the page as plain text that keeps the visual column layout,
+    so it can be sent to the model in place of the page image.
+    Words are grouped into lines by their vertical position and placed at a
+    character column proportional to their x coordinate.
+    """
+    words = page.get_text("words")
+    if not words:
+        return ""
+
+    char_width = sum((word[2] - word[0]) / max(len(word[4]), 1) for word in words) / len(words)
+    left_margin = min(word[0] for word in words)
+
+    text_lines = []
+    for _, line_words in group_words_into_lines(words):
+        text = ""
+        for word in line_words:
+            column = int((word[0] - left_margin) / char_width)
+            text += " " * max(column - len(text), 1 if text else 0) + word[4]
+        text_lines.append(text.rstrip())
+    return "\n".join(text_lines)